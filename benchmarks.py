@@ -0,0 +1,559 @@
+"""Micro-benchmarks for Protector.
+
+Run one with:
+
+    python benchmarks.py <name> [options]
+
+Each benchmark runs in a scratch directory, so it never touches the real
+database, keys or shared files.
+"""
+import argparse
+import atexit
+import logging
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
+
+BENCHMARKS = {}
+
+
+def benchmark(func):
+    BENCHMARKS[func.__name__.replace('bench_', '')] = func
+    return func
+
+
+def scratch_dir():
+    """Switch into a fresh temporary directory, removed on exit, returning its path"""
+    path = tempfile.mkdtemp(prefix='protector_bench_')
+    atexit.register(shutil.rmtree, path, ignore_errors=True)
+    os.chdir(path)
+    return path
+
+
+def start_server(app, pooled=False):
+    """Serve a WSGI app on a free local port in a background thread.
+
+    pooled serves it with the production server (wsgi_server), which sends
+    whole files with sendfile; otherwise Werkzeug's development server is used.
+    """
+    from werkzeug.serving import make_server
+    logging.getLogger('werkzeug').setLevel(logging.ERROR)
+    if pooled:
+        import wsgi_server
+        server = wsgi_server.PooledWSGIServer('127.0.0.1', 0, app)
+    else:
+        server = make_server('127.0.0.1', 0, app, threaded=True)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f"http://127.0.0.1:{server.server_port}"
+
+
+def start_smtp_server(handshake_delay=0.0, drop_after=None):
+    """Run a minimal SMTP server on a free local port that accepts any login and message.
+
+    handshake_delay stands in for the TCP/TLS setup and login round trips of
+    a real server and is paid on connect and again on AUTH. With drop_after,
+    the server hangs up after that many messages on a connection. Returns
+    (server, port); server.messages counts messages received.
+    """
+    import socketserver
+
+    class Handler(socketserver.StreamRequestHandler):
+        def reply(self, line):
+            self.wfile.write(line.encode() + b'\r\n')
+
+        def handle(self):
+            time.sleep(handshake_delay)
+            self.reply('220 localhost ESMTP stand-in')
+            received = 0
+            for line in self.rfile:
+                command = line[:4].upper()
+                if command == b'EHLO':
+                    self.reply('250-localhost\r\n250-AUTH PLAIN LOGIN\r\n250 OK')
+                elif command == b'AUTH':
+                    time.sleep(handshake_delay)
+                    self.reply('235 2.7.0 Authentication successful')
+                elif command == b'DATA':
+                    self.reply('354 End data with <CR><LF>.<CR><LF>')
+                    for data in self.rfile:
+                        if data == b'.\r\n':
+                            break
+                    with self.server.lock:
+                        self.server.messages += 1
+                    self.reply('250 OK')
+                    received += 1
+                    if drop_after and received >= drop_after:
+                        return
+                elif command == b'QUIT':
+                    self.reply('221 Bye')
+                    return
+                else:
+                    self.reply('250 OK')
+
+    server = socketserver.ThreadingTCPServer(('127.0.0.1', 0), Handler)
+    server.daemon_threads = True
+    server.messages = 0
+    server.lock = threading.Lock()
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, server.server_address[1]
+
+
+def report(label, seconds, cpu, nbytes=0, requests=0):
+    line = f"{label:<32} {seconds:8.3f}s"
+    if nbytes:
+        gb = nbytes / 1024 ** 3
+        line += f"  {nbytes / seconds / 1024 ** 2:10.1f} MB/s  {cpu / gb:7.2f} CPU-s/GB"
+    if requests:
+        line += f"  {requests / seconds:10.1f} req/s  {cpu / requests * 1000:7.3f} CPU-ms/req"
+    print(line)
+
+
+@benchmark
+def bench_download(args):
+    """Full downloads vs. resumed Range and 304 revalidation on /download.
+
+    Served by the production server. Shares are encrypted at rest, so their
+    full download is decrypted segment by segment; the unencrypted row is a
+    share stored before that, which is the only kind sent with sendfile.
+    """
+    import requests
+    from datetime import datetime
+
+    sys.path.insert(0, args.repo)
+    scratch_dir()
+    import share_server
+
+    # Lift the upload limit so the payload size isn't capped at MAX_FILE_SIZE
+    share_server.MAX_FILE_SIZE = args.size_mb * 1024 * 1024
+    share_server.app.config['MAX_CONTENT_LENGTH'] = None
+    server, base_url = start_server(share_server.app, pooled=True)
+    session = requests.Session()
+    size = args.size_mb * 1024 * 1024
+
+    def download_url(file_id):
+        response = session.post(f"{base_url}/download/{file_id}",
+                                data={'password': 'bench'},
+                                allow_redirects=False)
+        return base_url + response.headers['Location']
+
+    def run(label, url, headers, expected_status, expected_bytes):
+        start, cpu = time.perf_counter(), time.process_time()
+        for _ in range(args.rounds):
+            with session.get(url, headers=headers, stream=True) as r:
+                assert r.status_code == expected_status, r.status_code
+                received = sum(len(chunk) for chunk in r.iter_content(1024 * 1024))
+                assert received == expected_bytes
+        report(label, time.perf_counter() - start, time.process_time() - cpu,
+               expected_bytes * args.rounds, args.rounds)
+        return r
+
+    try:
+        payload = os.urandom(1024 * 1024)
+        with tempfile.TemporaryFile() as f:
+            for _ in range(args.size_mb):
+                f.write(payload)
+            f.seek(0)
+            start, cpu = time.perf_counter(), time.process_time()
+            link = session.post(f"{base_url}/share",
+                                files={'file': ('bench.zip', f)},
+                                data={'password': 'bench'}).json()['link']
+            report("share upload", time.perf_counter() - start, time.process_time() - cpu,
+                   size, 1)
+        url = download_url(link.rsplit('/', 1)[1])
+
+        full = run("full download (decrypted)", url, {}, 200, size)
+        run("resume second half (Range)", url, {'Range': f"bytes={size // 2}-"}, 206,
+            size - size // 2)
+        run("revalidate (If-None-Match)", url, {'If-None-Match': full.headers['ETag']}, 304, 0)
+
+        # A share from before encryption at rest: a plain file in the upload folder
+        legacy_id = 'legacy_bench.zip'
+        with open(os.path.join(share_server.UPLOAD_FOLDER, legacy_id), 'wb') as f:
+            for _ in range(args.size_mb):
+                f.write(payload)
+        share_server.shared_files.add(legacy_id, {
+            'filename': 'bench.zip',
+            'username': 'bench',
+            'password': share_server.password_hasher.hash('bench'),
+            'timestamp': datetime.now().isoformat(),
+            'size': size,
+            'etag': 'legacy',
+        })
+        run("full download (plain, sendfile)", download_url(legacy_id), {}, 200, size)
+    finally:
+        server.shutdown()
+
+
+@benchmark
+def bench_client(args):
+    """Requests to the share server: a new connection each (old behaviour) vs. the keep-alive HttpClient"""
+    import requests
+
+    sys.path.insert(0, args.repo)
+    scratch_dir()
+    import share_server
+    from http_client import HttpClient
+
+    server, base_url = start_server(share_server.app, pooled=True)
+    client = HttpClient(base_url)
+    try:
+        start, cpu = time.perf_counter(), time.process_time()
+        for _ in range(args.requests):
+            assert requests.get(f"{base_url}/health").status_code == 200
+        report("connection per request", time.perf_counter() - start,
+               time.process_time() - cpu, requests=args.requests)
+
+        start, cpu = time.perf_counter(), time.process_time()
+        for _ in range(args.requests):
+            assert client.get('/health').status_code == 200
+        report("HttpClient", time.perf_counter() - start,
+               time.process_time() - cpu, requests=args.requests)
+        stats = client.stats()
+        print(f"  {stats['requests']} requests over {stats['connections_opened']} connection(s), "
+              f"{stats['connection_reuse']:.1%} reused, {stats['retries']} retried, "
+              f"{stats['failures']} failed")
+    finally:
+        client.close()
+        server.shutdown()
+
+
+@benchmark
+def bench_view(args):
+    """Uncached /view rendering (old behaviour) vs. the page cache and 304 revalidation"""
+    import requests
+    from concurrent.futures import ThreadPoolExecutor
+    from flask import render_template
+
+    sys.path.insert(0, args.repo)
+    scratch_dir()
+    import share_server
+
+    @share_server.app.route('/legacy_view/<file_id>')
+    def legacy_view(file_id):
+        # The handler as it was: registry lookup, disk probe and a full render every time
+        file_info = share_server.shared_files.get(file_id)
+        if file_info is None or not os.path.exists(os.path.join(share_server.UPLOAD_FOLDER, file_id)):
+            return "File not found", 404
+        return render_template('view_file.html',
+                               filename=file_info['filename'],
+                               username=file_info['username'],
+                               timestamp=file_info['timestamp'],
+                               file_id=file_id)
+
+    server, base_url = start_server(share_server.app)
+    local = threading.local()
+    try:
+        link = requests.post(f"{base_url}/share",
+                             files={'file': ('bench.txt', b'hot share link')},
+                             data={'password': 'bench'}).json()['link']
+        file_id = link.rsplit('/', 1)[1]
+        etag = requests.get(f"{base_url}/view/{file_id}").headers['ETag']
+
+        def fetch(url, headers, expected_status):
+            session = getattr(local, 'session', None)
+            if session is None:
+                session = local.session = requests.Session()
+            r = session.get(url, headers=headers)
+            assert r.status_code == expected_status, r.status_code
+
+        def run(label, path, headers, expected_status):
+            count = args.requests
+            start, cpu = time.perf_counter(), time.process_time()
+            with ThreadPoolExecutor(args.threads) as pool:
+                list(pool.map(lambda _: fetch(base_url + path, headers, expected_status), range(count)))
+            report(label, time.perf_counter() - start, time.process_time() - cpu, requests=count)
+
+        run("render every hit (before)", f"/legacy_view/{file_id}", {}, 200)
+        run("cached page", f"/view/{file_id}", {}, 200)
+        run("revalidate (If-None-Match)", f"/view/{file_id}", {'If-None-Match': etag}, 304)
+    finally:
+        server.shutdown()
+
+
+@benchmark
+def bench_guessing(args):
+    """A password-guessing client on /download: attempts shed by the rate limiter vs. checked"""
+    import requests
+    from concurrent.futures import ThreadPoolExecutor
+
+    sys.path.insert(0, args.repo)
+    scratch_dir()
+    import share_server
+    from rate_limiter import RateLimiter
+
+    limiter = RateLimiter('bench_limits.bin', rate=1e9, burst=1e9)
+
+    def check(thread):
+        for i in range(args.requests):
+            limiter.take(f"10.{thread}.{i // 250 % 250}.{i % 250}")
+
+    start, cpu = time.perf_counter(), time.process_time()
+    with ThreadPoolExecutor(args.threads) as pool:
+        list(pool.map(check, range(args.threads)))
+    report("limiter check", time.perf_counter() - start, time.process_time() - cpu,
+           requests=args.requests * args.threads)
+
+    server, base_url = start_server(share_server.app)
+    local = threading.local()
+    try:
+        link = requests.post(f"{base_url}/share",
+                             files={'file': ('bench.txt', b'guess me')},
+                             data={'password': 'correct horse'}).json()['link']
+        file_id = link.rsplit('/', 1)[1]
+        statuses = []
+
+        def guess(i):
+            session = getattr(local, 'session', None)
+            if session is None:
+                session = local.session = requests.Session()
+            r = session.post(f"{base_url}/download/{file_id}", data={'password': f"guess{i}"},
+                             allow_redirects=False)
+            statuses.append(r.status_code)
+
+        start, cpu = time.perf_counter(), time.process_time()
+        with ThreadPoolExecutor(args.threads) as pool:
+            list(pool.map(guess, range(args.requests)))
+        report("wrong-password attempts", time.perf_counter() - start,
+               time.process_time() - cpu, requests=args.requests)
+        print(f"  checked (403): {statuses.count(403)}  shed (429): {statuses.count(429)}")
+    finally:
+        server.shutdown()
+
+
+@benchmark
+def bench_sweep(args):
+    """Reclaiming expired shares: sweeper throughput without pauses and with the default batching"""
+    sys.path.insert(0, args.repo)
+    scratch_dir()
+    import share_server
+    from share_sweeper import ShareSweeper
+
+    payload = os.urandom(64 * 1024)
+
+    def expire_shares(count):
+        for i in range(count):
+            file_id = f"bench_{i}.zip"
+            with open(os.path.join(share_server.UPLOAD_FOLDER, file_id), 'wb') as f:
+                f.write(payload)
+            share_server.shared_files.add(file_id, {
+                'filename': file_id, 'password': None, 'username': 'bench',
+                'timestamp': '', 'size': len(payload), 'etag': '', 'expires_at': time.time() - 1
+            })
+
+    for label, sweeper in (("sweep, no pauses", ShareSweeper(share_server.shared_files,
+                                                             share_server.upload_sessions, pause=0)),
+                           ("sweep, default batching", ShareSweeper(share_server.shared_files,
+                                                                    share_server.upload_sessions))):
+        expire_shares(args.requests)
+        start, cpu = time.perf_counter(), time.process_time()
+        files, reclaimed = sweeper.sweep()
+        seconds = time.perf_counter() - start
+        assert files == args.requests
+        report(label, seconds, time.process_time() - cpu, reclaimed)
+        print(f"  {files / seconds:.0f} files/s")
+
+
+@benchmark
+def bench_email(args):
+    """OTP emails: a new SMTP connection per email (old behaviour) vs. the queued sender"""
+    import smtplib
+    import contextlib
+    import io
+
+    sys.path.insert(0, args.repo)
+    from email_handler import EmailHandler
+
+    # Roughly one round trip to a distant mail server for each of connect and login
+    server, port = start_smtp_server(handshake_delay=0.05)
+    handler = EmailHandler(host='127.0.0.1', port=port, use_tls=False, queue_size=args.requests)
+    handler.configure('bench@example.com', 'password')
+    old_count = min(args.requests, 100)
+    try:
+        start, cpu = time.perf_counter(), time.process_time()
+        for i in range(old_count):
+            with smtplib.SMTP('127.0.0.1', port) as smtp:
+                smtp.login('bench@example.com', 'password')
+                smtp.send_message(handler.build_message(f"user{i}@example.com", '123456'))
+        report(f"connection per email (before, {old_count})", time.perf_counter() - start,
+               time.process_time() - cpu, requests=old_count)
+
+        # The sender prints a line per email
+        with contextlib.redirect_stdout(io.StringIO()):
+            start, cpu = time.perf_counter(), time.process_time()
+            for i in range(args.requests):
+                handler.send_otp(f"user{i}@example.com")
+            queued = time.perf_counter() - start
+            handler.close()
+            seconds, cpu = time.perf_counter() - start, time.process_time() - cpu
+        report("queued sender", seconds, cpu, requests=args.requests)
+        print(f"  send_otp returned in {queued / args.requests * 1e6:.0f} us on average")
+        print(f"  {handler.sent} sent, {handler.failed} failed over {handler.connections} connection(s)")
+        assert server.messages == old_count + args.requests
+    finally:
+        server.shutdown()
+
+
+@benchmark
+def bench_login(args):
+    """Concurrent check_login throughput: one locked connection (old) vs. per-thread WAL connections"""
+    import hashlib
+    import sqlite3
+    from concurrent.futures import ThreadPoolExecutor
+
+    sys.path.insert(0, args.repo)
+    scratch_dir()
+    from database import Database
+
+    class Sha256Hasher:
+        """Stand-in for bcrypt, so the benchmark measures connection handling rather than hashing"""
+
+        def hash(self, password):
+            return hashlib.sha256(password.encode()).hexdigest()
+
+        def verify(self, password, stored_hash):
+            return self.hash(password) == stored_hash, False
+
+    db = Database()
+    db.hasher = Sha256Hasher()
+    for i in range(args.users):
+        db.add_user(f"user{i}", f"user{i}@example.com", "password")
+
+    # The previous implementation: one shared connection, every call under one lock
+    legacy_lock = threading.Lock()
+    legacy_connection = sqlite3.connect(db.db_path, check_same_thread=False)
+
+    def legacy_check_login(email, password):
+        with legacy_lock:
+            cursor = legacy_connection.cursor()
+            try:
+                hashed_password = hashlib.sha256(password.encode()).hexdigest()
+                cursor.execute('SELECT * FROM users WHERE email = ? AND password = ?',
+                               (email, hashed_password))
+                return cursor.fetchone() is not None
+            finally:
+                cursor.close()
+
+    def run(label, check_login):
+        stop = threading.Event()
+
+        # A concurrent writer, as when users sign up or change passwords
+        def write():
+            while not stop.is_set():
+                db.update_password("user0@example.com", "password")
+
+        def login(i):
+            for j in range(args.logins):
+                assert check_login(f"user{(i + j) % args.users}@example.com", "password")
+
+        writer = threading.Thread(target=write)
+        writer.start()
+        start, cpu = time.perf_counter(), time.process_time()
+        with ThreadPoolExecutor(args.threads) as pool:
+            list(pool.map(login, range(args.threads)))
+        elapsed = time.perf_counter() - start
+        report(label, elapsed, time.process_time() - cpu, requests=args.threads * args.logins)
+        stop.set()
+        writer.join()
+
+    run("single locked connection (before)", legacy_check_login)
+    run("per-thread WAL connections", db.check_login)
+    db.close()
+
+
+@benchmark
+def bench_listing(args):
+    """File list refresh at 1k/10k/100k files: listdir + getsize/getmtime (old) vs. DirectorySnapshot"""
+    sys.path.insert(0, args.repo)
+    root = scratch_dir()
+    from file_index import DirectorySnapshot
+
+    def legacy_list(user_dir):
+        rows = []
+        for file in os.listdir(user_dir):
+            if file.startswith("encrypted_"):
+                file_path = os.path.join(user_dir, file)
+                rows.append((file, os.path.getsize(file_path), os.path.getmtime(file_path)))
+        return rows
+
+    for count in (1000, 10000, 100000):
+        user_dir = os.path.join(root, str(count))
+        os.makedirs(user_dir)
+        for i in range(count):
+            with open(os.path.join(user_dir, f"encrypted_file{i:06d}.bin"), 'wb') as f:
+                f.write(b'x' * (i % 512))
+        # Make the directory mtime old enough to be trusted by the snapshot
+        os.utime(user_dir, (time.time() - 60, time.time() - 60))
+
+        def run(label, func):
+            start, cpu = time.perf_counter(), time.process_time()
+            for _ in range(args.rounds):
+                func()
+            report(f"{count:>6} {label}", (time.perf_counter() - start) / args.rounds,
+                   (time.process_time() - cpu) / args.rounds)
+
+        run("listdir + getsize/getmtime", lambda: legacy_list(user_dir))
+        run("scandir, cold snapshot", lambda: DirectorySnapshot(user_dir).refresh())
+        snapshot = DirectorySnapshot(user_dir)
+        snapshot.refresh()
+        run("snapshot, nothing changed", snapshot.refresh)
+
+        def one_new_file():
+            with open(os.path.join(user_dir, "encrypted_new.bin"), 'wb'):
+                pass
+            snapshot.refresh()
+            os.remove(os.path.join(user_dir, "encrypted_new.bin"))
+        run("snapshot, one file added", one_new_file)
+
+        from database import Database
+        db = Database()
+        owner = f"user{count}"
+        for name, size, mtime in snapshot.entries:
+            db.save_file(user=owner, filename=name, ciphertext_size=size, mtime=mtime,
+                         format_version=1, plaintext_size=size)
+
+        def catalog_page():
+            db.count_user_files(owner)
+            db.get_user_files(owner, order_by='modified', limit=30, offset=count // 2)
+        run("catalog count + page query", catalog_page)
+
+        try:
+            import tkinter as tk
+            from tkinter import ttk
+            tk_root = tk.Tk()
+        except Exception:
+            continue
+        tree = ttk.Treeview(tk_root, columns=('Name', 'Size', 'Modified'), show='headings')
+
+        def insert_all():
+            tree.delete(*tree.get_children())
+            for name, size, mtime in snapshot.entries:
+                tree.insert('', 'end', values=(name, size, mtime))
+
+        def insert_window():
+            tree.delete(*tree.get_children())
+            for name, size, mtime in snapshot.entries[:30]:
+                tree.insert('', 'end', iid=name, values=(name, size, mtime))
+
+        run("Treeview, every row", insert_all)
+        run("Treeview, visible rows only", insert_window)
+        tk_root.destroy()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('name', choices=sorted(BENCHMARKS))
+    parser.add_argument('--size-mb', type=int, default=256, help="Payload size in MB")
+    parser.add_argument('--rounds', type=int, default=5, help="Repetitions per measurement")
+    parser.add_argument('--threads', type=int, default=8, help="Concurrent client threads")
+    parser.add_argument('--users', type=int, default=1000, help="Number of user accounts")
+    parser.add_argument('--logins', type=int, default=2000, help="Logins per thread")
+    parser.add_argument('--requests', type=int, default=2000, help="HTTP requests per measurement")
+    args = parser.parse_args()
+    args.repo = os.path.dirname(os.path.abspath(__file__))
+    BENCHMARKS[args.name](args)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,206 @@
+import os
+import json
+import hmac
+import hashlib
+import random
+from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+from cryptography.exceptions import InvalidTag
+from secure_container import ContainerError
+from database import ThreadConnections
+
+MIN_CHUNK_SIZE = 16 * 1024
+AVG_CHUNK_SIZE = 64 * 1024
+MAX_CHUNK_SIZE = 256 * 1024
+
+# FastCDC gear table and normalized-chunking masks. The table is generated
+# from a fixed seed: changing it would change every chunk boundary and stop
+# new uploads from deduplicating against existing chunks.
+GEAR_SEED = random.Random(0x50524f54)
+GEAR = [GEAR_SEED.getrandbits(64) for _ in range(256)]
+MASK_SMALL = 0x0003590703530000  # 15 bits set: harder to cut before the average size
+MASK_LARGE = 0x0000d90003530000  # 11 bits set: easier to cut after it
+HASH_MASK = (1 << 64) - 1
+
+
+def find_cut_point(data):
+    """Return the length of the first content-defined chunk of data (FastCDC)"""
+    size = len(data)
+    if size <= MIN_CHUNK_SIZE:
+        return size
+    end = min(size, MAX_CHUNK_SIZE)
+    normal = min(AVG_CHUNK_SIZE, end)
+    gear = GEAR
+    h = 0
+    i = MIN_CHUNK_SIZE
+    while i < normal:
+        h = ((h << 1) + gear[data[i]]) & HASH_MASK
+        if not h & MASK_SMALL:
+            return i + 1
+        i += 1
+    while i < end:
+        h = ((h << 1) + gear[data[i]]) & HASH_MASK
+        if not h & MASK_LARGE:
+            return i + 1
+        i += 1
+    return end
+
+
+def iter_chunks(src):
+    """Split the binary stream src into content-defined chunks"""
+    buffer = b''
+    eof = False
+    while True:
+        if not eof and len(buffer) < MAX_CHUNK_SIZE:
+            data = src.read(MAX_CHUNK_SIZE * 4)
+            eof = not data
+            buffer += data
+            continue
+        if not buffer:
+            return
+        cut = find_cut_point(buffer) if not eof or len(buffer) > MIN_CHUNK_SIZE else len(buffer)
+        yield buffer[:cut]
+        buffer = buffer[cut:]
+
+
+class ChunkStore:
+    """Per-user deduplicating store of encrypted, content-addressed chunks.
+
+    Files are split with content-defined chunking, so an edit only changes
+    the chunks around it and the rest of a near-identical upload is stored
+    once. Chunks use a keyed convergent scheme: the address is an HMAC of the
+    plaintext under a key derived from the user's key, and the chunk is
+    encrypted under a key derived from that address. Identical chunks from
+    the same user therefore encrypt identically and are kept once, while
+    addresses reveal nothing to anyone without the user's key.
+
+    Chunks live under <root>/<aa>/<address> and are reference counted in an
+    SQLite index next to them; a file is a manifest listing its chunks.
+    """
+
+    def __init__(self, root, master_key):
+        self.root = root
+        os.makedirs(root, exist_ok=True)
+        self.address_key = hmac.new(master_key, b'protector-chunk-address', hashlib.sha256).digest()
+        self.encryption_key = hmac.new(master_key, b'protector-chunk-encryption', hashlib.sha256).digest()
+        # synchronous stays at SQLite's default, FULL, for the chunk refcounts
+        self.connections = ThreadConnections(os.path.join(root, 'index.db'), synchronous=None)
+        self.connection.execute('''
+            CREATE TABLE IF NOT EXISTS chunks (
+                address TEXT PRIMARY KEY,
+                size INTEGER NOT NULL,
+                stored_size INTEGER NOT NULL,
+                refcount INTEGER NOT NULL
+            )
+        ''')
+
+    @property
+    def connection(self):
+        return self.connections.get()
+
+    def chunk_path(self, address):
+        return os.path.join(self.root, address[:2], address)
+
+    def chunk_cipher(self, address):
+        return AESGCM(hmac.new(self.encryption_key, bytes.fromhex(address), hashlib.sha256).digest())
+
+    def store(self, src, progress=None):
+        """Chunk, deduplicate and store the stream src. Returns its manifest"""
+        chunks = []
+        total = 0
+        try:
+            for data in iter_chunks(src):
+                address = hmac.new(self.address_key, data, hashlib.sha256).hexdigest()
+                self.add_reference(address, data)
+                chunks.append([address, len(data)])
+                total += len(data)
+                if progress:
+                    progress(total)
+        except BaseException:
+            # Don't leak references to the chunks stored before the failure
+            self.release({'size': total, 'chunks': chunks})
+            raise
+        return {'size': total, 'chunks': chunks}
+
+    def add_reference(self, address, data):
+        connection = self.connection
+        connection.execute('BEGIN IMMEDIATE')
+        try:
+            updated = connection.execute('UPDATE chunks SET refcount = refcount + 1 WHERE address = ?',
+                                         (address,)).rowcount
+            if not updated:
+                # Each chunk has its own key, so a fixed nonce is safe
+                sealed = self.chunk_cipher(address).encrypt(bytes(12), data, bytes.fromhex(address))
+                path = self.chunk_path(address)
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                with open(path + '.tmp', 'wb') as f:
+                    f.write(sealed)
+                os.replace(path + '.tmp', path)
+                connection.execute('INSERT INTO chunks (address, size, stored_size, refcount) '
+                                   'VALUES (?, ?, ?, 1)', (address, len(data), len(sealed)))
+            connection.execute('COMMIT')
+        except Exception:
+            connection.execute('ROLLBACK')
+            raise
+
+    def read_chunk(self, address):
+        with open(self.chunk_path(address), 'rb') as f:
+            sealed = f.read()
+        try:
+            return self.chunk_cipher(address).decrypt(bytes(12), sealed, bytes.fromhex(address))
+        except InvalidTag:
+            raise ContainerError(f"Chunk {address} failed authentication")
+
+    def iter_file(self, manifest):
+        """Yield the plaintext of a stored file chunk by chunk"""
+        for address, size in manifest['chunks']:
+            yield self.read_chunk(address)
+
+    def iter_range(self, manifest, offset, length):
+        """Yield bytes [offset, offset + length) of a stored file, reading only the chunks covering it"""
+        end = min(offset + length, manifest['size'])
+        position = 0
+        for address, size in manifest['chunks']:
+            if position >= end:
+                return
+            if position + size > offset:
+                data = self.read_chunk(address)
+                yield data[max(offset - position, 0):end - position]
+            position += size
+
+    def release(self, manifest):
+        """Drop a file's references, deleting chunks nothing else uses"""
+        connection = self.connection
+        for address, size in manifest['chunks']:
+            connection.execute('BEGIN IMMEDIATE')
+            try:
+                connection.execute('UPDATE chunks SET refcount = refcount - 1 WHERE address = ?',
+                                   (address,))
+                orphaned = connection.execute('DELETE FROM chunks WHERE address = ? AND refcount <= 0',
+                                              (address,)).rowcount
+                if orphaned and os.path.exists(self.chunk_path(address)):
+                    os.remove(self.chunk_path(address))
+                connection.execute('COMMIT')
+            except Exception:
+                connection.execute('ROLLBACK')
+                raise
+
+    def stats(self):
+        """Return logical vs. stored bytes, the dedup ratio and the bytes saved"""
+        logical, stored, unique = self.connection.execute(
+            'SELECT COALESCE(SUM(size * refcount), 0), COALESCE(SUM(stored_size), 0), COUNT(*) '
+            'FROM chunks').fetchone()
+        return {
+            'logical_bytes': logical,
+            'stored_bytes': stored,
+            'unique_chunks': unique,
+            'dedup_ratio': logical / stored if stored else 1.0,
+            'bytes_saved': max(logical - stored, 0)
+        }
+
+    @staticmethod
+    def encode_manifest(manifest):
+        return json.dumps(manifest, separators=(',', ':')).encode()
+
+    @staticmethod
+    def decode_manifest(data):
+        return json.loads(data)
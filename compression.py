@@ -0,0 +1,100 @@
+import os
+import struct
+import zlib
+
+# Already-compressed formats that won't shrink any further
+INCOMPRESSIBLE_EXTENSIONS = {
+    'zip', 'gz', 'tgz', 'bz2', 'xz', '7z', 'rar', 'zst',
+    'jpg', 'jpeg', 'png', 'gif', 'webp', 'heic',
+    'mp3', 'mp4', 'm4a', 'mkv', 'mov', 'avi', 'webm',
+    'docx', 'xlsx', 'pptx', 'odt', 'ods', 'odp', 'epub', 'jar', 'apk'
+}
+SAMPLE_LEVEL = 1
+MIN_SAVING = 0.1  # Only compress if the sample shrinks by at least 10%
+COMPRESSION_LEVEL = 6
+TRAILER_FORMAT = '>Q'  # Plaintext length, appended after the compressed stream
+TRAILER_SIZE = struct.calcsize(TRAILER_FORMAT)
+
+
+def should_compress(filename, sample):
+    """Decide whether a file is worth compressing from its name and first segment"""
+    extension = os.path.splitext(filename)[1].lstrip('.').lower()
+    if extension in INCOMPRESSIBLE_EXTENSIONS or not sample:
+        return False
+    return len(zlib.compress(sample, SAMPLE_LEVEL)) <= len(sample) * (1 - MIN_SAVING)
+
+
+class PrefixedReader:
+    """Replays bytes already read from a stream before reading the rest of it"""
+
+    def __init__(self, prefix, src):
+        self.prefix = prefix
+        self.src = src
+
+    def read(self, size=-1):
+        if not self.prefix:
+            return self.src.read(size)
+        if size < 0:
+            data, self.prefix = self.prefix + self.src.read(), b''
+            return data
+        data, self.prefix = self.prefix[:size], self.prefix[size:]
+        if len(data) < size:
+            data += self.src.read(size - len(data))
+        return data
+
+
+class CompressingReader:
+    """Reads a stream as zlib-compressed bytes followed by the plaintext length.
+
+    The trailer lets the plaintext size be read back from the end of the
+    container without decompressing it.
+    """
+
+    def __init__(self, src, level=COMPRESSION_LEVEL):
+        self.src = src
+        self.compressor = zlib.compressobj(level)
+        self.buffer = b''
+        self.consumed = 0
+        self.produced = 0
+        self.finished = False
+
+    def read(self, size):
+        while len(self.buffer) < size and not self.finished:
+            data = self.src.read(max(size, 64 * 1024))
+            if data:
+                self.consumed += len(data)
+                self.buffer += self.compressor.compress(data)
+            else:
+                self.buffer += self.compressor.flush() + struct.pack(TRAILER_FORMAT, self.consumed)
+                self.finished = True
+        data, self.buffer = self.buffer[:size], self.buffer[size:]
+        self.produced += len(data)
+        return data
+
+
+def iter_decompressed(chunks, max_size):
+    """Decompress a stream written by CompressingReader, checking its length trailer.
+
+    No piece yielded is longer than max_size, however well the stream compressed.
+    """
+    decompressor = zlib.decompressobj()
+    total = 0
+    trailer = b''
+    for chunk in chunks:
+        if decompressor.eof:
+            trailer += chunk
+            continue
+        while True:
+            data = decompressor.decompress(chunk, max_size)
+            total += len(data)
+            if data:
+                yield data
+            # Input that would have decompressed past max_size is kept for the next call
+            chunk = decompressor.unconsumed_tail
+            if decompressor.eof or not chunk and len(data) < max_size:
+                break
+        if decompressor.eof:
+            trailer = decompressor.unused_data
+    if not decompressor.eof or len(trailer) != TRAILER_SIZE or \
+            struct.unpack(TRAILER_FORMAT, trailer)[0] != total:
+        raise ValueError("Compressed stream is truncated or corrupt")
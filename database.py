@@ -1,27 +1,89 @@
 import sqlite3
 from sqlite3 import Error
 import threading
-import hashlib
 import os
+from datetime import datetime
+from password_hasher import PasswordHasher
+
+class ThreadConnections:
+    """One SQLite connection per thread, opened on first use.
+
+    The database runs in WAL mode, so any number of threads or processes can
+    read while one of them writes. Every connection opened is remembered so
+    close() can shut them all, whichever thread opened them.
+    """
+
+    def __init__(self, db_path, timeout=30, isolation_level=None, row_factory=None,
+                 synchronous='NORMAL'):
+        self.db_path = db_path
+        self.timeout = timeout
+        self.isolation_level = isolation_level
+        self.row_factory = row_factory
+        self.synchronous = synchronous
+        self.local = threading.local()
+        self.lock = threading.Lock()
+        self.opened = []
+
+    def get(self):
+        """The calling thread's connection"""
+        connection = getattr(self.local, 'connection', None)
+        if connection is None:
+            connection = sqlite3.connect(self.db_path, timeout=self.timeout,
+                                         isolation_level=self.isolation_level,
+                                         check_same_thread=False)
+            if self.row_factory is not None:
+                connection.row_factory = self.row_factory
+            connection.execute('PRAGMA journal_mode=WAL')
+            if self.synchronous:
+                connection.execute(f'PRAGMA synchronous={self.synchronous}')
+            self.local.connection = connection
+            with self.lock:
+                self.opened.append(connection)
+        return connection
+
+    def close(self):
+        with self.lock:
+            for connection in self.opened:
+                connection.close()
+            self.opened = []
+        self.local = threading.local()
+
 
 class Database:
+    """Singleton access to the application database.
+
+    Each thread gets its own connection, and the database runs in WAL mode so
+    readers never wait for the writer. Only writes go through _lock, which
+    keeps this process from queueing up behind SQLite's busy timeout.
+    """
     _instance = None
     _lock = threading.Lock()
+    db_path = 'secure_file_system.db'
+    busy_timeout = 30  # seconds to wait for another writer before giving up
     
     def __new__(cls):
         if cls._instance is None:
             cls._instance = super(Database, cls).__new__(cls)
-            cls._instance.connection = None
+            cls._instance.initialized = False
         return cls._instance
 
     def __init__(self):
-        if not self.connection:
+        if not self.initialized:
+            # Transactions are explicit commit()/rollback() calls, as sqlite3 does by default
+            self.connections = ThreadConnections(self.db_path, timeout=self.busy_timeout,
+                                                 isolation_level='')
+            self.hasher = PasswordHasher()
+            self.initialized = True
             try:
-                self.connection = sqlite3.connect('secure_file_system.db', check_same_thread=False)
                 self.create_tables()
             except Error as e:
                 print(f"Database error: {e}")
 
+    @property
+    def connection(self):
+        """The calling thread's connection, opened on first use"""
+        return self.connections.get()
+
     def create_tables(self):
         try:
             cursor = self.connection.cursor()
@@ -34,6 +96,21 @@ class Database:
                     verified BOOLEAN DEFAULT 0
                 )
             ''')
+            cursor.execute('''
+                CREATE TABLE IF NOT EXISTS files (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    owner TEXT NOT NULL,
+                    name TEXT NOT NULL,
+                    plaintext_size INTEGER,
+                    ciphertext_size INTEGER NOT NULL,
+                    mtime REAL NOT NULL,
+                    content_hash TEXT,
+                    format_version INTEGER NOT NULL,
+                    security_level TEXT DEFAULT 'Private',
+                    UNIQUE (owner, name)
+                )
+            ''')
+            cursor.execute('CREATE INDEX IF NOT EXISTS idx_files_owner_mtime ON files (owner, mtime)')
             self.connection.commit()
         except Error as e:
             print(f"Error creating tables: {e}")
@@ -41,10 +118,11 @@ class Database:
             cursor.close()
 
     def add_user(self, username, email, password):
+        """Create a user. Hashing is slow, so call this via self.hasher.submit from the UI"""
+        hashed_password = self.hasher.hash(password)
         with self._lock:
             try:
                 cursor = self.connection.cursor()
-                hashed_password = hashlib.sha256(password.encode()).hexdigest()
                 cursor.execute('INSERT INTO users (username, email, password) VALUES (?, ?, ?)',
                              (username, email, hashed_password))
                 self.connection.commit()
@@ -69,35 +147,165 @@ class Database:
                 cursor.close()
 
     def check_login(self, email, password):
+        """Verify a login, upgrading legacy SHA-256 hashes to bcrypt on success.
+
+        Hashing is slow, so call this via self.hasher.submit from the UI.
+        """
+        try:
+            cursor = self.connection.cursor()
+            cursor.execute('SELECT password FROM users WHERE email = ?', (email,))
+            user = cursor.fetchone()
+        except Error as e:
+            print(f"Error checking login: {e}")
+            return False
+        finally:
+            cursor.close()
+        
+        if user is None:
+            return False
+        matches, needs_rehash = self.hasher.verify(password, user[0])
+        if needs_rehash:
+            self.update_password(email, password)
+        return matches
+
+    def update_password(self, email, new_password):
+        hashed_password = self.hasher.hash(new_password)
         with self._lock:
             try:
                 cursor = self.connection.cursor()
-                hashed_password = hashlib.sha256(password.encode()).hexdigest()
-                cursor.execute('SELECT * FROM users WHERE email = ? AND password = ?',
-                             (email, hashed_password))
-                user = cursor.fetchone()
-                return user is not None
+                cursor.execute('UPDATE users SET password = ? WHERE email = ?',
+                             (hashed_password, email))
+                self.connection.commit()
+                return True
             except Error as e:
-                print(f"Error checking login: {e}")
+                print(f"Error updating password: {e}")
                 return False
             finally:
                 cursor.close()
 
-    def update_password(self, email, new_password):
+    # Columns the file list may be sorted by; name and mtime are indexed per owner
+    FILE_SORT_COLUMNS = {'name': 'name', 'size': 'plaintext_size', 'modified': 'mtime'}
+
+    SAVE_FILE_SQL = '''
+        INSERT INTO files (owner, name, plaintext_size, ciphertext_size, mtime,
+                           content_hash, format_version, security_level)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+        ON CONFLICT (owner, name) DO UPDATE SET
+            plaintext_size = excluded.plaintext_size,
+            ciphertext_size = excluded.ciphertext_size,
+            mtime = excluded.mtime,
+            content_hash = excluded.content_hash,
+            format_version = excluded.format_version,
+            security_level = excluded.security_level
+    '''
+
+    def save_file(self, user, filename, ciphertext_size, mtime, format_version,
+                  plaintext_size=None, content_hash=None, security_level='Private'):
+        """Record (or replace) a stored file's metadata in the catalog"""
+        return self.save_files(user, [{
+            'filename': filename,
+            'ciphertext_size': ciphertext_size,
+            'mtime': mtime,
+            'format_version': format_version,
+            'plaintext_size': plaintext_size,
+            'content_hash': content_hash,
+            'security_level': security_level
+        }])
+
+    def save_files(self, user, files):
+        """Record a batch of files (dicts of save_file's arguments) in one transaction"""
+        rows = [(user, f['filename'], f.get('plaintext_size'), f['ciphertext_size'], f['mtime'],
+                 f.get('content_hash'), f['format_version'], f.get('security_level', 'Private'))
+                for f in files]
         with self._lock:
             try:
                 cursor = self.connection.cursor()
-                hashed_password = hashlib.sha256(new_password.encode()).hexdigest()
-                cursor.execute('UPDATE users SET password = ? WHERE email = ?',
-                             (hashed_password, email))
+                cursor.executemany(self.SAVE_FILE_SQL, rows)
                 self.connection.commit()
                 return True
             except Error as e:
-                print(f"Error updating password: {e}")
+                self.connection.rollback()
+                print(f"Error saving files: {e}")
                 return False
             finally:
                 cursor.close()
 
+    def delete_file(self, user, filename):
+        with self._lock:
+            try:
+                cursor = self.connection.cursor()
+                cursor.execute('DELETE FROM files WHERE owner = ? AND name = ?', (user, filename))
+                self.connection.commit()
+                return True
+            except Error as e:
+                print(f"Error deleting file: {e}")
+                return False
+            finally:
+                cursor.close()
+
+    FILE_COLUMNS = ('name, plaintext_size, ciphertext_size, mtime, content_hash, '
+                    'format_version, security_level')
+
+    @staticmethod
+    def file_row(row):
+        name, plaintext_size, ciphertext_size, mtime, content_hash, format_version, security_level = row
+        return {
+            'name': name,
+            'size': ciphertext_size if plaintext_size is None else plaintext_size,
+            'ciphertext_size': ciphertext_size,
+            'modified': mtime,
+            'modified_date': datetime.fromtimestamp(mtime).strftime('%Y-%m-%d %H:%M'),
+            'content_hash': content_hash,
+            'format_version': format_version,
+            'security_level': security_level
+        }
+
+    def get_user_files(self, user, order_by='name', descending=False, limit=-1, offset=0):
+        """Return one page of a user's files, sorted by 'name', 'size' or 'modified'"""
+        column = self.FILE_SORT_COLUMNS[order_by]
+        direction = 'DESC' if descending else 'ASC'
+        try:
+            cursor = self.connection.cursor()
+            cursor.execute(f'''
+                SELECT {self.FILE_COLUMNS} FROM files WHERE owner = ?
+                ORDER BY {column} {direction}, name
+                LIMIT ? OFFSET ?
+            ''', (user, limit, offset))
+            return [self.file_row(row) for row in cursor.fetchall()]
+        except Error as e:
+            print(f"Error listing files: {e}")
+            return []
+        finally:
+            cursor.close()
+
+    def count_user_files(self, user):
+        try:
+            cursor = self.connection.cursor()
+            cursor.execute('SELECT COUNT(*) FROM files WHERE owner = ?', (user,))
+            return cursor.fetchone()[0]
+        except Error as e:
+            print(f"Error counting files: {e}")
+            return 0
+        finally:
+            cursor.close()
+
+    def get_file_data(self, filename, user):
+        """Return the catalog entry for one of a user's files, or None"""
+        try:
+            cursor = self.connection.cursor()
+            cursor.execute(f'SELECT {self.FILE_COLUMNS} FROM files WHERE owner = ? AND name = ?',
+                           (user, filename))
+            row = cursor.fetchone()
+            return None if row is None else self.file_row(row)
+        except Error as e:
+            print(f"Error reading file: {e}")
+            return None
+        finally:
+            cursor.close()
+
+    def close(self):
+        self.connections.close()
+
     def __del__(self):
-        if self.connection:
-            self.connection.close() 
\ No newline at end of file
+        if self.initialized:
+            self.close() 
\ No newline at end of file
@@ -1,53 +1,190 @@
+import atexit
 import smtplib
 import random
+import queue
+import threading
+import time
 from email.mime.text import MIMEText
 from email.mime.multipart import MIMEMultipart
 
+SMTP_HOST = 'smtp.gmail.com'
+SMTP_PORT = 587
+SMTP_TIMEOUT = 30  # Seconds to wait on the SMTP server before giving up on a connection
+QUEUE_SIZE = 100  # OTP emails waiting to be sent
+BATCH_SIZE = 20  # Emails taken off the queue and sent together
+MAX_RETRIES = 3
+RETRY_DELAY = 1  # Seconds before the first retry, doubling after that
+IDLE_TIMEOUT = 60  # Seconds without mail before the connection is closed
+CLOSE_TIMEOUT = 30  # Seconds the process waits at exit for queued mail to go out
+
+STOP = object()  # Queued by close() to end the sender thread
+
+
 class EmailHandler:
-    def __init__(self):
+    """Sends OTP emails from a background thread over one persistent SMTP connection.
+
+    send_otp() only queues the email, so it returns straight away on the Tk
+    thread. The sender thread takes up to batch_size emails off the queue at
+    a time and sends them over the same logged-in connection, which is only
+    opened when there is mail and closed after idle_timeout seconds without
+    any. If the server drops the connection the sender reconnects and
+    retries with exponential backoff; emails the server refuses outright are
+    not retried. Mail still queued when the process exits is sent first,
+    for up to CLOSE_TIMEOUT seconds.
+    """
+
+    def __init__(self, host=SMTP_HOST, port=SMTP_PORT, use_tls=True, queue_size=QUEUE_SIZE,
+                 batch_size=BATCH_SIZE, max_retries=MAX_RETRIES, retry_delay=RETRY_DELAY,
+                 idle_timeout=IDLE_TIMEOUT):
         # Initialize without requiring .env file
         self.sender_email = None
         self.app_password = None
-    
+        self.host = host
+        self.port = port
+        self.use_tls = use_tls
+        self.batch_size = batch_size
+        self.max_retries = max_retries
+        self.retry_delay = retry_delay
+        self.idle_timeout = idle_timeout
+        self.queue = queue.Queue(maxsize=queue_size)
+        self.lock = threading.Lock()
+        self.thread = None
+        self.connection = None
+        self.credentials_changed = False
+        self.sent = 0
+        self.failed = 0
+        self.connections = 0
+        atexit.register(self.close, CLOSE_TIMEOUT)
+
     def configure(self, email, password):
         """Configure email credentials"""
         self.sender_email = email
         self.app_password = password
-        
+        # Log in again with the new credentials before the next batch
+        self.credentials_changed = True
+
     def send_otp(self, receiver_email):
+        """Queue an OTP email to receiver_email and return the OTP without waiting for it to be sent"""
         # Skip email sending if credentials aren't configured
         if not self.sender_email or not self.app_password:
             print("Email credentials not configured - skipping email send")
             return "123456"  # Return default OTP for testing
-            
+
+        otp = str(random.randint(100000, 999999))
         try:
-            otp = str(random.randint(100000, 999999))
-            
-            msg = MIMEMultipart()
-            msg['From'] = self.sender_email
-            msg['To'] = receiver_email
-            msg['Subject'] = "Secure File System - Your OTP Verification"
-            
-            body = f"""
-            <html>
-              <body style='font-family: Arial, sans-serif;'>
-                <h2 style='color: #2C3E50;'>Email Verification</h2>
-                <p>Your OTP for verification is:</p>
-                <h1 style='color: #3498DB; font-size: 32px;'>{otp}</h1>
-                <p>This OTP will expire in 10 minutes.</p>
-                <p>If you didn't request this, please ignore this email.</p>
-              </body>
-            </html>
-            """
-            msg.attach(MIMEText(body, 'html'))
-            
-            with smtplib.SMTP('smtp.gmail.com', 587) as server:
-                server.starttls()
+            self.queue.put_nowait(self.build_message(receiver_email, otp))
+        except queue.Full:
+            print("Too many emails waiting to be sent - skipping email send")
+            return "123456"  # Return default OTP for testing if email fails
+        self.start()
+        return otp
+
+    def build_message(self, receiver_email, otp):
+        msg = MIMEMultipart()
+        msg['From'] = self.sender_email
+        msg['To'] = receiver_email
+        msg['Subject'] = "Secure File System - Your OTP Verification"
+
+        body = f"""
+        <html>
+          <body style='font-family: Arial, sans-serif;'>
+            <h2 style='color: #2C3E50;'>Email Verification</h2>
+            <p>Your OTP for verification is:</p>
+            <h1 style='color: #3498DB; font-size: 32px;'>{otp}</h1>
+            <p>This OTP will expire in 10 minutes.</p>
+            <p>If you didn't request this, please ignore this email.</p>
+          </body>
+        </html>
+        """
+        msg.attach(MIMEText(body, 'html'))
+        return msg
+
+    def start(self):
+        with self.lock:
+            # Also replaces a sender that died, so mail never queues up unsent
+            if self.thread is None or not self.thread.is_alive():
+                self.thread = threading.Thread(target=self.run, name='email-sender', daemon=True)
+                self.thread.start()
+
+    def close(self, timeout=None):
+        """Send everything already queued, then stop the sender thread"""
+        with self.lock:
+            thread, self.thread = self.thread, None
+        if thread is not None:
+            self.queue.put(STOP)
+            thread.join(timeout)
+
+    def run(self):
+        while True:
+            try:
+                message = self.queue.get(timeout=self.idle_timeout)
+            except queue.Empty:
+                self.disconnect()
+                continue
+            batch = [message]
+            while len(batch) < self.batch_size and batch[-1] is not STOP:
+                try:
+                    batch.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+
+            if self.credentials_changed:
+                self.credentials_changed = False
+                self.disconnect()
+            for message in batch:
+                if message is STOP:
+                    self.disconnect()
+                    return
+                try:
+                    self.deliver(message)
+                except Exception as e:
+                    # One bad message mustn't stop the mail behind it
+                    print(f"Error sending email to {message['To']}: {e}")
+                    self.failed += 1
+                    self.disconnect()
+
+    def connect(self):
+        if self.connection is None:
+            server = smtplib.SMTP(self.host, self.port, timeout=SMTP_TIMEOUT)
+            try:
+                if self.use_tls:
+                    server.starttls()
                 server.login(self.sender_email, self.app_password)
-                server.send_message(msg)
-                print(f"OTP sent successfully to {receiver_email}")
-                
-            return otp
-        except Exception as e:
-            print(f"Error sending email: {e}")
-            return "123456"  # Return default OTP for testing if email fails 
\ No newline at end of file
+            except BaseException:
+                server.close()
+                raise
+            self.connection = server
+            self.connections += 1
+        return self.connection
+
+    def disconnect(self):
+        if self.connection is None:
+            return
+        try:
+            self.connection.quit()
+        except (smtplib.SMTPException, OSError):
+            self.connection.close()
+        self.connection = None
+
+    def deliver(self, message):
+        """Send one email, reconnecting and retrying if the connection fails. Returns True if it was sent"""
+        error = None
+        for attempt in range(self.max_retries + 1):
+            if attempt:
+                time.sleep(self.retry_delay * 2 ** (attempt - 1))
+            try:
+                self.connect().send_message(message)
+                print(f"OTP sent successfully to {message['To']}")
+                self.sent += 1
+                return True
+            except (smtplib.SMTPAuthenticationError, smtplib.SMTPSenderRefused,
+                    smtplib.SMTPRecipientsRefused) as e:
+                # Retrying can't change the answer
+                error = e
+                break
+            except (smtplib.SMTPException, OSError) as e:
+                error = e
+                self.disconnect()
+        print(f"Error sending email to {message['To']}: {error}")
+        self.failed += 1
+        return False
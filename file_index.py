@@ -0,0 +1,59 @@
+import os
+import time
+
+
+class DirectorySnapshot:
+    """Cached listing of the encrypted files in a directory.
+
+    refresh() lists the directory with a single os.scandir pass and only
+    stats entries it hasn't seen before. Stored files are only ever created,
+    replaced (under a new inode) or removed, so an entry's size and mtime
+    can be reused as long as its inode is unchanged. If the directory's own
+    mtime hasn't moved, the listing is reused without touching the disk
+    again.
+    """
+
+    # Directory mtimes this recent might hide a change on filesystems with
+    # coarse timestamps, so they always trigger a rescan
+    SETTLE_SECONDS = 2
+
+    def __init__(self, path, prefix='encrypted_'):
+        self.path = path
+        self.prefix = prefix
+        self.dir_mtime = None
+        self.stats = {}  # name -> (inode, size, mtime)
+        self.entries = []  # (name, size, mtime), sorted by name
+
+    def refresh(self):
+        """Bring the snapshot up to date. Returns True if the listing changed"""
+        try:
+            dir_mtime = os.stat(self.path).st_mtime_ns
+        except FileNotFoundError:
+            changed = bool(self.entries)
+            self.dir_mtime, self.stats, self.entries = None, {}, []
+            return changed
+
+        settled = time.time_ns() - dir_mtime > self.SETTLE_SECONDS * 1_000_000_000
+        if dir_mtime == self.dir_mtime and settled:
+            return False
+
+        stats = {}
+        with os.scandir(self.path) as scan:
+            for entry in scan:
+                if not entry.name.startswith(self.prefix):
+                    continue
+                cached = self.stats.get(entry.name)
+                try:
+                    inode = entry.inode()
+                    if cached is None or cached[0] != inode:
+                        stat = entry.stat()
+                        cached = (inode, stat.st_size, stat.st_mtime)
+                except FileNotFoundError:
+                    # Removed between readdir and stat
+                    continue
+                stats[entry.name] = cached
+
+        entries = sorted((name, size, mtime) for name, (inode, size, mtime) in stats.items())
+        changed = entries != self.entries
+        self.dir_mtime, self.stats, self.entries = dir_mtime, stats, entries
+        return changed
@@ -2,12 +2,48 @@ import tkinter as tk
 from tkinter import ttk, filedialog, messagebox, simpledialog
 import os
 from cryptography.fernet import Fernet
+from secure_container import (ChunkedCipher, ContainerError, is_container, container_flags,
+                              container_version, FORMAT_VERSION, DIRECT_KEY_VERSION,
+                              FLAG_CHUNK_MANIFEST)
+from chunk_store import ChunkStore
+from key_ring import KeyRing
+from compression import should_compress, PrefixedReader
+from database import Database
+from task_runner import TaskScheduler, TaskQueueFull
+from file_index import DirectorySnapshot
+from upload_pipeline import UploadPipeline, UploadJob
+from http_client import HttpClient
 import requests
 import random
 import string
 from github import Github, InputFileContent
 from datetime import datetime
 import time
+import threading
+import hashlib
+import io
+import base64
+
+# Held for the whole of a key rotation, since every rewrap goes through the
+# user's one rotation journal
+ROTATION_LOCK = threading.Lock()
+
+
+class HashingReader:
+    """Wraps a binary file, hashing everything read through it"""
+
+    def __init__(self, file):
+        self.file = file
+        self.digest = hashlib.sha256()
+
+    def read(self, size=-1):
+        data = self.file.read(size)
+        self.digest.update(data)
+        return data
+
+    def hexdigest(self):
+        return self.digest.hexdigest()
+
 
 class FileManager:
     def __init__(self, root, username, go_back_callback):
@@ -16,6 +52,22 @@ class FileManager:
         self.go_back_callback = go_back_callback
         self.key = self.load_or_generate_key()
         self.cipher = Fernet(self.key)
+        # Each file has its own data key, wrapped by the current version of the user's key
+        self.key_ring = KeyRing(os.path.join("keys", f"{username}_keyring.json"),
+                                base64.urlsafe_b64decode(self.key))
+        self.rotation_journal = os.path.join("keys", f"{username}_rotation.journal")
+        ChunkedCipher.recover_rewrap(self.rotation_journal)
+        # Segments are encrypted on this many worker threads (defaults to one per core)
+        self.crypto_workers = os.cpu_count() or 1
+        self.stream_cipher = ChunkedCipher(self.key, workers=self.crypto_workers,
+                                           key_ring=self.key_ring)
+        self.rewrap_rate = 200  # Files rewrapped per second at most during key rotation
+        self.rotation_task = None
+        
+        # Uploads, downloads and shares run in the background so the window stays responsive
+        self.tasks = TaskScheduler(self.root, on_update=self.show_task_progress)
+        # Closing the window cancels them, so their threads don't keep the process alive
+        self.root.protocol("WM_DELETE_WINDOW", self.close_window)
         
         # Create main container
         self.main_frame = ttk.Frame(self.root, padding="40")
@@ -33,6 +85,18 @@ class FileManager:
         if not os.path.exists(self.user_dir):
             os.makedirs(self.user_dir)
         
+        # Deduplicated uploads keep their chunks here, shared between files
+        self.chunk_store = ChunkStore(os.path.join(self.user_dir, ".chunks"),
+                                      self.stream_cipher.master_key)
+        
+        # File metadata comes from the catalog, so listing never walks the directory
+        self.db = Database()
+        self.file_count = 0
+        self.file_offset = 0  # Index of the first file shown in the tree
+        self.visible_rows = 10
+        self.sort_by = 'name'
+        self.sort_descending = False
+        
         # GitHub configuration
         self.github_token = "ghp_your_github_token_here"  # Get this from GitHub
         try:
@@ -47,6 +111,9 @@ class FileManager:
         self.server_url = "http://127.0.0.1:5000"  # Flask server URL
         self.max_retries = 3
         self.retry_delay = 1  # seconds
+        # Shared by every request to the server, so connections are kept alive and reused
+        self.http = HttpClient(self.server_url, max_retries=self.max_retries,
+                               retry_delay=self.retry_delay)
 
     def setup_styles(self):
         style = ttk.Style()
@@ -99,14 +166,32 @@ class FileManager:
         button_frame.pack(fill='x', pady=(0, 20))
         
         ttk.Button(button_frame, 
-                   text="Upload File",
+                   text="Upload Files",
                    command=self.upload_file).pack(side='left', padx=5)
+        ttk.Button(button_frame,
+                   text="Upload Folder",
+                   command=self.upload_folder).pack(side='left', padx=5)
         ttk.Button(button_frame,
                    text="Download File",
                    command=self.download_file).pack(side='left', padx=5)
         ttk.Button(button_frame,
                    text="Share File",
                    command=self.share_file).pack(side='left', padx=5)
+        ttk.Button(button_frame,
+                   text="Delete File",
+                   command=self.delete_file).pack(side='left', padx=5)
+        ttk.Button(button_frame,
+                   text="Rotate Key",
+                   command=self.rotate_key).pack(side='left', padx=5)
+        
+        self.dedup_uploads = tk.BooleanVar(value=False)
+        ttk.Checkbutton(button_frame,
+                        text="Deduplicate uploads",
+                        variable=self.dedup_uploads).pack(side='left', padx=5)
+        self.compress_uploads = tk.BooleanVar(value=False)
+        ttk.Checkbutton(button_frame,
+                        text="Compress uploads",
+                        variable=self.compress_uploads).pack(side='left', padx=5)
         
         # File list frame
         list_frame = ttk.Frame(self.main_frame)
@@ -123,23 +208,56 @@ class FileManager:
                                      height=10)
         
         # Configure columns
-        self.file_tree.heading('Name', text='File Name')
-        self.file_tree.heading('Size', text='Size')
-        self.file_tree.heading('Modified', text='Last Modified')
+        self.file_tree.heading('Name', text='File Name',
+                               command=lambda: self.sort_files('name'))
+        self.file_tree.heading('Size', text='Size',
+                               command=lambda: self.sort_files('size'))
+        self.file_tree.heading('Modified', text='Last Modified',
+                               command=lambda: self.sort_files('modified'))
         
         self.file_tree.column('Name', width=250)
         self.file_tree.column('Size', width=100)
         self.file_tree.column('Modified', width=150)
         
-        # Add scrollbar
-        scrollbar = ttk.Scrollbar(list_frame,
-                                 orient='vertical',
-                                 command=self.file_tree.yview)
-        self.file_tree.configure(yscrollcommand=scrollbar.set)
+        # Add scrollbar. Only the visible rows exist in the tree, so the
+        # scrollbar moves a window over the file list instead of the tree
+        self.file_scrollbar = ttk.Scrollbar(list_frame,
+                                           orient='vertical',
+                                           command=self.scroll_files)
         
         # Pack tree and scrollbar
         self.file_tree.pack(side='left', fill='both', expand=True)
-        scrollbar.pack(side='right', fill='y')
+        self.file_scrollbar.pack(side='right', fill='y')
+        
+        self.file_tree.bind('<Configure>', self.resize_file_list)
+        self.file_tree.bind('<MouseWheel>', lambda e: self.scroll_files('scroll', -e.delta // 120, 'units'))
+        self.file_tree.bind('<Button-4>', lambda e: self.scroll_files('scroll', -1, 'units'))
+        self.file_tree.bind('<Button-5>', lambda e: self.scroll_files('scroll', 1, 'units'))
+        
+        # Background task list
+        tasks_frame = ttk.Frame(self.main_frame)
+        tasks_frame.pack(fill='x', pady=(20, 0))
+        
+        self.task_tree = ttk.Treeview(tasks_frame,
+                                     columns=('Task', 'Progress', 'Speed', 'Status'),
+                                     show='headings',
+                                     height=3)
+        
+        self.task_tree.heading('Task', text='Task')
+        self.task_tree.heading('Progress', text='Progress')
+        self.task_tree.heading('Speed', text='Speed')
+        self.task_tree.heading('Status', text='Status')
+        
+        self.task_tree.column('Task', width=250)
+        self.task_tree.column('Progress', width=100)
+        self.task_tree.column('Speed', width=100)
+        self.task_tree.column('Status', width=100)
+        
+        self.task_tree.pack(side='left', fill='x', expand=True)
+        
+        ttk.Button(tasks_frame,
+                   text="Cancel",
+                   command=self.cancel_task).pack(side='left', padx=5)
         
         # Bottom button frame
         bottom_frame = ttk.Frame(self.main_frame)
@@ -149,29 +267,200 @@ class FileManager:
                    text="Go Back",
                    command=self.go_back).pack()
         
-        # Update file list
+        # Update file list, then pick up any files the catalog doesn't know about yet
         self.update_file_list()
+        self.start_task("Index files", self.sync_catalog,
+                        on_done=lambda _: self.update_file_list())
 
     def upload_file(self):
-        file_path = filedialog.askopenfilename(title="Select a file to upload")
-        if file_path:
-            try:
-                # Read and encrypt file
-                with open(file_path, "rb") as file:
-                    encrypted_data = self.cipher.encrypt(file.read())
-                
-                # Save to user's directory
-                filename = os.path.basename(file_path)
-                save_path = os.path.join(self.user_dir, f"encrypted_{filename}")
-                
-                with open(save_path, "wb") as encrypted_file:
-                    encrypted_file.write(encrypted_data)
-                
-                messagebox.showinfo("Success", "File uploaded and encrypted successfully!")
-                self.update_file_list()
-                
-            except Exception as e:
-                messagebox.showerror("Error", f"Upload failed: {str(e)}")
+        file_paths = filedialog.askopenfilenames(title="Select files to upload")
+        if len(file_paths) > 1:
+            self.upload_batch([(path, os.path.basename(path)) for path in file_paths])
+        elif file_paths:
+            file_path = file_paths[0]
+            filename = os.path.basename(file_path)
+            dedup = self.dedup_uploads.get()
+            self.start_task(f"Upload {filename}", self.encrypt_upload, file_path, dedup,
+                            self.compress_uploads.get(),
+                            total_bytes=os.path.getsize(file_path),
+                            on_done=lambda result: self.finish_upload(result, dedup),
+                            on_error=lambda e: messagebox.showerror("Error", f"Upload failed: {str(e)}"))
+
+    def upload_folder(self):
+        folder = filedialog.askdirectory(title="Select a folder to upload")
+        if not folder:
+            return
+        self.start_task(f"Upload {os.path.basename(folder)}", self.encrypt_folder, folder,
+                        self.dedup_uploads.get(), self.compress_uploads.get(),
+                        on_done=self.finish_batch,
+                        on_error=lambda e: messagebox.showerror("Error", f"Upload failed: {str(e)}"))
+
+    def upload_batch(self, files):
+        """Upload several (path, name) files as one background task"""
+        self.start_task(f"Upload {len(files)} files", self.encrypt_batch, files,
+                        self.dedup_uploads.get(), self.compress_uploads.get(),
+                        on_done=self.finish_batch,
+                        on_error=lambda e: messagebox.showerror("Error", f"Upload failed: {str(e)}"))
+
+    @staticmethod
+    def folder_files(folder):
+        """List (path, name) for every file under folder.
+
+        Files are stored flat, so each name is the file's path from the folder
+        with separators turned into '_'. Paths that come out the same, such as
+        a/b_c and a_b/c, are numbered instead of overwriting each other.
+        """
+        files = []
+        taken = set()
+        for dirpath, dirnames, filenames in os.walk(folder):
+            dirnames.sort()
+            for filename in sorted(filenames):
+                path = os.path.join(dirpath, filename)
+                name = os.path.relpath(path, os.path.dirname(folder)).replace(os.sep, '_')
+                stem, extension = os.path.splitext(name)
+                number = 1
+                # Compared without case, since Windows and macOS don't tell them apart either
+                while name.lower() in taken:
+                    number += 1
+                    name = f"{stem} ({number}){extension}"
+                taken.add(name.lower())
+                files.append((path, name))
+        return files
+
+    def encrypt_folder(self, task, folder, dedup=False, compress=False):
+        """Walk folder and upload every file in it as a batch. Runs on a worker thread"""
+        files = self.folder_files(folder)
+        if not files:
+            raise ValueError("The selected folder has no files")
+        return self.encrypt_batch(task, files, dedup, compress)
+
+    def encrypt_batch(self, task, files, dedup=False, compress=False):
+        """Encrypt a batch of files through the upload pipeline. Runs on a worker thread.
+
+        Each file is recorded in the catalog, and the chunks of any dedup
+        manifest it replaced are released, as soon as it is in place, so a
+        failure part way through leaves every finished file catalogued.
+        Dedup uploads go through the chunk store one file at a time.
+        Returns the file count, bytes read and elapsed time.
+        """
+        started = time.monotonic()
+        task.report(0, sum(os.path.getsize(path) for path, name in files))
+        if dedup:
+            done = 0
+            for path, name in files:
+                self.encrypt_upload(task, path, dedup=True, compress=compress,
+                                    name=name, offset=done)
+                done += os.path.getsize(path)
+            return {'files': len(files), 'bytes': done, 'elapsed': time.monotonic() - started}
+
+        jobs = [UploadJob(path, name, self.stored_path(name),
+                          os.path.join(self.user_dir, f".partial_{name}"), compress)
+                for path, name in files]
+        replaced = {job.save_path: self.read_manifest(job.save_path)
+                    for job in jobs if os.path.exists(job.save_path)}
+
+        def stored(job):
+            self.db.save_file(self.username, job.name, job.stored_size, job.mtime, FORMAT_VERSION,
+                              plaintext_size=job.size, content_hash=job.content_hash)
+            manifest = replaced.get(job.save_path)
+            if manifest:
+                self.chunk_store.release(manifest)
+
+        UploadPipeline(self.stream_cipher).run(jobs, progress=task.report, on_stored=stored)
+        return {'files': len(jobs), 'bytes': sum(job.size for job in jobs),
+                'elapsed': time.monotonic() - started}
+
+    def finish_batch(self, result):
+        elapsed = max(result['elapsed'], 1e-9)
+        messagebox.showinfo("Success",
+                            f"Uploaded and encrypted {result['files']} files "
+                            f"({self.format_size(result['bytes'])})\n\n"
+                            f"{result['files'] / elapsed:.1f} files/s, "
+                            f"{self.format_size(result['bytes'] / elapsed)}/s")
+        self.update_file_list()
+
+    def finish_upload(self, result, dedup=False):
+        message = "File uploaded and encrypted successfully!"
+        if result['compressed']:
+            ratio = result['stored_size'] / result['size'] if result['size'] else 1.0
+            message += (f"\n\nCompressed to {ratio:.0%} of its size"
+                        f" at {self.format_size(result['bytes_per_second'])}/s")
+        if dedup:
+            stats = self.chunk_store.stats()
+            message += (f"\n\nDeduplication ratio: {stats['dedup_ratio']:.2f}x"
+                        f"\nSpace saved: {self.format_size(stats['bytes_saved'])}")
+        messagebox.showinfo("Success", message)
+        self.update_file_list()
+
+    def encrypt_upload(self, task, file_path, dedup=False, compress=False, name=None, offset=0):
+        """Encrypt file_path into the user's directory. Runs on a worker thread.
+
+        With dedup, the contents go to the chunk store and only the encrypted
+        chunk manifest is written to the user's directory. With compress, the
+        file is compressed before encryption if its type and first segment
+        suggest it's worth it. name overrides the stored name, and offset is
+        added to reported progress when the upload is part of a batch.
+        Returns the sizes and throughput of the upload.
+        """
+        # Save to user's directory
+        filename = name or os.path.basename(file_path)
+
+        def report(done):
+            task.report(offset + done)
+
+        save_path = self.stored_path(filename)
+        partial_path = os.path.join(self.user_dir, f".partial_{filename}")
+        replaced_manifest = self.read_manifest(save_path) if os.path.exists(save_path) else None
+        manifest = None
+        compressed = False
+        started = time.monotonic()
+        
+        # Encrypt segment by segment so memory use doesn't grow with file size
+        try:
+            with open(file_path, "rb") as file, open(partial_path, "wb") as encrypted_file:
+                reader = HashingReader(file)
+                if dedup:
+                    manifest = self.chunk_store.store(reader, progress=report)
+                    plaintext_size = manifest['size']
+                    self.stream_cipher.encrypt_stream(io.BytesIO(ChunkStore.encode_manifest(manifest)),
+                                                      encrypted_file, flags=FLAG_CHUNK_MANIFEST)
+                else:
+                    source = reader
+                    if compress:
+                        # Sample the first segment, then replay it ahead of the rest
+                        sample = reader.read(self.stream_cipher.segment_size)
+                        compressed = should_compress(filename, sample)
+                        source = PrefixedReader(sample, reader)
+                    plaintext_size = self.stream_cipher.encrypt_stream(source, encrypted_file,
+                                                                       progress=report,
+                                                                       compress=compressed)
+            os.replace(partial_path, save_path)
+        except BaseException:
+            if manifest:
+                self.chunk_store.release(manifest)
+            raise
+        finally:
+            if os.path.exists(partial_path):
+                os.remove(partial_path)
+        
+        if replaced_manifest:
+            self.chunk_store.release(replaced_manifest)
+        
+        stat = os.stat(save_path)
+        self.db.save_file(user=self.username,
+                          filename=filename,
+                          ciphertext_size=stat.st_size,
+                          mtime=stat.st_mtime,
+                          format_version=FORMAT_VERSION,
+                          plaintext_size=plaintext_size,
+                          content_hash=reader.hexdigest())
+        elapsed = time.monotonic() - started
+        return {
+            'size': plaintext_size,
+            'stored_size': stat.st_size,
+            'compressed': compressed,
+            'bytes_per_second': plaintext_size / elapsed if elapsed > 0 else 0.0
+        }
 
     def download_file(self):
         selected = self.file_tree.selection()
@@ -179,45 +468,242 @@ class FileManager:
             messagebox.showwarning("Warning", "Please select a file to download")
             return
         
-        try:
-            file_name = self.file_tree.item(selected[0])['values'][0]
-            file_path = os.path.join(self.user_dir, file_name)
-            
-            save_path = filedialog.asksaveasfilename(
-                defaultextension="",
-                initialfile=file_name.replace("encrypted_", "")
-            )
-            
-            if save_path:
-                with open(file_path, "rb") as encrypted_file:
-                    decrypted_data = self.cipher.decrypt(encrypted_file.read())
-                
-                with open(save_path, "wb") as decrypted_file:
-                    decrypted_file.write(decrypted_data)
-                
-                messagebox.showinfo("Success", "File downloaded successfully!")
+        file_name = selected[0]
+        file_path = self.stored_path(file_name)
         
+        save_path = filedialog.asksaveasfilename(
+            defaultextension="",
+            initialfile=file_name
+        )
+        
+        if save_path:
+            self.start_task(f"Download {file_name}",
+                            lambda task: self.decrypt_to_path(file_path, save_path, progress=task.report),
+                            on_done=lambda _: messagebox.showinfo("Success", "File downloaded successfully!"),
+                            on_error=lambda e: messagebox.showerror("Error", f"Download failed: {str(e)}"))
+
+    def stored_path(self, filename):
+        return os.path.join(self.user_dir, f"encrypted_{filename}")
+
+    def delete_file(self):
+        selected = self.file_tree.selection()
+        if not selected:
+            messagebox.showwarning("Warning", "Please select a file to delete")
+            return
+        
+        file_name = selected[0]
+        if not messagebox.askyesno("Confirm", f"Delete {file_name}?"):
+            return
+        
+        try:
+            file_path = self.stored_path(file_name)
+            if os.path.exists(file_path):
+                manifest = self.read_manifest(file_path)
+                os.remove(file_path)
+                if manifest:
+                    self.chunk_store.release(manifest)
+            self.db.delete_file(self.username, file_name)
+            self.update_file_list()
         except Exception as e:
-            messagebox.showerror("Error", f"Download failed: {str(e)}")
+            messagebox.showerror("Error", f"Delete failed: {str(e)}")
+
+    def sync_catalog(self, task):
+        """Reconcile the catalog with the files on disk. Runs on a worker thread.
+
+        Files stored before the catalog existed are added, and entries whose
+        file has gone are dropped. This is the only place the user directory
+        is walked; everything else reads the catalog.
+        """
+        snapshot = DirectorySnapshot(self.user_dir)
+        snapshot.refresh()
+        on_disk = {name[len("encrypted_"):]: (size, mtime) for name, size, mtime in snapshot.entries}
+        cataloged = {file['name'] for file in self.db.get_user_files(self.username)}
+        
+        for name in cataloged - set(on_disk):
+            # Recheck, in case an upload finished after the directory was read
+            if not os.path.exists(self.stored_path(name)):
+                self.db.delete_file(self.username, name)
+        
+        for done, name in enumerate(set(on_disk) - cataloged):
+            task.report(done, len(on_disk))
+            size, mtime = on_disk[name]
+            file_path = self.stored_path(name)
+            # Files from before key rotation are still version 1 containers
+            version = container_version(file_path)
+            plaintext_size = None
+            if version is not None:
+                try:
+                    plaintext_size = self.plaintext_size(file_path)
+                except ContainerError:
+                    pass
+            self.db.save_file(user=self.username,
+                              filename=name,
+                              ciphertext_size=size,
+                              mtime=mtime,
+                              format_version=version or 0,
+                              plaintext_size=plaintext_size)
+
+    def rotate_key(self):
+        if self.rotation_task is not None and not self.rotation_task.future.done():
+            messagebox.showinfo("Rotate Key", "A key rotation is already running")
+            return
+        if not messagebox.askyesno("Rotate Key",
+                                   "Create a new encryption key and rewrap every file's "
+                                   "data key with it?"):
+            return
+        self.rotation_task = self.start_task(
+            "Rotate key", self.rotate_files,
+            on_done=self.finish_rotation,
+            on_error=lambda e: messagebox.showerror("Error", f"Key rotation failed: {str(e)}"))
+
+    def finish_rotation(self, result):
+        message = f"Rewrapped the keys of {result['rewrapped']} files"
+        if result['upgraded']:
+            message += f"\nRe-encrypted {result['upgraded']} older files under new keys"
+        if result['retired']:
+            message += f"\nRetired {len(result['retired'])} old key versions no file uses any more"
+        if result['legacy']:
+            message += (f"\n\n{result['legacy']} files from before chunked encryption are still "
+                        f"encrypted with your original key. Download and upload them again "
+                        f"to move them to the new key.")
+        messagebox.showinfo("Rotate Key", message)
+        self.update_file_list()
+
+    def rotate_files(self, task):
+        """Create a new key, rewrap every file under it and retire unused versions. Runs on a worker thread.
+
+        The version that was current before is kept until the next rotation,
+        since uploads that started before this one still wrap their keys with it.
+        """
+        with ROTATION_LOCK:
+            previous = self.key_ring.current_version
+            self.key_ring.rotate()
+            result = self.rewrap_files(task)
+            result['retired'] = self.key_ring.retire(self.key_versions_in_use() | {previous})
+            return result
+
+    def rewrap_files(self, task):
+        """Move every stored file onto the current key. Runs on a worker thread.
+
+        Envelope containers only have their header rewritten, so this takes
+        time proportional to the number of files rather than their size.
+        Version 1 containers are keyed from the original key and have to be
+        re-encrypted, which is done once. Legacy Fernet files are counted but
+        left alone. It is throttled to rewrap_rate files a second to leave
+        the disk free for other work. Returns the counts of each.
+        """
+        with os.scandir(self.user_dir) as scan:
+            paths = [entry.path for entry in scan if entry.name.startswith("encrypted_")]
+        result = {'rewrapped': 0, 'upgraded': 0, 'legacy': 0}
+        for done, path in enumerate(paths):
+            task.report(done, len(paths))
+            started = time.monotonic()
+            try:
+                version = container_version(path)
+                if version is None:
+                    result['legacy'] += 1
+                elif version == DIRECT_KEY_VERSION:
+                    if self.upgrade_file(path):
+                        result['upgraded'] += 1
+                elif self.stream_cipher.rewrap(path, self.rotation_journal):
+                    result['rewrapped'] += 1
+            except FileNotFoundError:
+                # Deleted since the directory was listed
+                continue
+            time.sleep(max(0.0, 1 / self.rewrap_rate - (time.monotonic() - started)))
+        task.report(len(paths), len(paths))
+        return result
+
+    def upgrade_file(self, path):
+        """Re-encrypt a version 1 container under a fresh data key and update its catalog entry"""
+        name = os.path.basename(path)[len("encrypted_"):]
+        partial_path = os.path.join(self.user_dir, f".upgrade_{name}")
+        if not self.stream_cipher.upgrade(path, partial_path):
+            return False
+        entry = self.db.get_file_data(name, self.username) or {}
+        stat = os.stat(path)
+        self.db.save_file(self.username, name, stat.st_size, stat.st_mtime, FORMAT_VERSION,
+                          plaintext_size=self.plaintext_size(path),
+                          content_hash=entry.get('content_hash'),
+                          security_level=entry.get('security_level', 'Private'))
+        return True
+
+    def key_versions_in_use(self):
+        """Key versions wrapping any file in the user's directory, finished or not"""
+        versions = set()
+        with os.scandir(self.user_dir) as scan:
+            for entry in scan:
+                if not entry.is_file():
+                    continue
+                try:
+                    version = self.stream_cipher.key_version(entry.path)
+                except (ContainerError, OSError):
+                    continue  # Just created or just removed
+                if version is not None:
+                    versions.add(version)
+        return versions
 
     def update_file_list(self):
-        # Clear existing items
+        self.file_count = self.db.count_user_files(self.username)
+        self.render_file_list()
+
+    def sort_files(self, column):
+        if self.sort_by == column:
+            self.sort_descending = not self.sort_descending
+        else:
+            self.sort_by, self.sort_descending = column, False
+        self.file_offset = 0
+        self.render_file_list()
+
+    def render_file_list(self):
+        """Show the page of files starting at file_offset, touching only rows that changed"""
+        self.file_offset = max(0, min(self.file_offset, self.file_count - self.visible_rows))
+        window = self.db.get_user_files(self.username,
+                                        order_by=self.sort_by,
+                                        descending=self.sort_descending,
+                                        limit=self.visible_rows,
+                                        offset=self.file_offset)
+        
+        wanted = {file['name'] for file in window}
         for item in self.file_tree.get_children():
-            self.file_tree.delete(item)
-        
-        # List files in user's directory
-        if os.path.exists(self.user_dir):
-            for file in os.listdir(self.user_dir):
-                if file.startswith("encrypted_"):
-                    file_path = os.path.join(self.user_dir, file)
-                    size = os.path.getsize(file_path)
-                    modified = os.path.getmtime(file_path)
-                    
-                    self.file_tree.insert('', 'end', values=(
-                        file,
-                        self.format_size(size),
-                        self.format_date(modified)
-                    ))
+            if item not in wanted:
+                self.file_tree.delete(item)
+        
+        for index, file in enumerate(window):
+            name = file['name']
+            values = (name, self.format_size(file['size']), file['modified_date'])
+            if not self.file_tree.exists(name):
+                self.file_tree.insert('', index, iid=name, values=values)
+                continue
+            if tuple(self.file_tree.item(name, 'values')) != values:
+                self.file_tree.item(name, values=values)
+            if self.file_tree.index(name) != index:
+                self.file_tree.move(name, '', index)
+        
+        if self.file_count:
+            self.file_scrollbar.set(self.file_offset / self.file_count,
+                                    (self.file_offset + len(window)) / self.file_count)
+        else:
+            self.file_scrollbar.set(0, 1)
+
+    def scroll_files(self, action, amount, unit=None):
+        """Scrollbar and mouse wheel handler for the virtual file list"""
+        total = self.file_count
+        if action == 'moveto':
+            self.file_offset = int(float(amount) * total)
+        elif unit == 'pages':
+            self.file_offset += int(amount) * self.visible_rows
+        else:
+            self.file_offset += int(amount)
+        self.render_file_list()
+
+    def resize_file_list(self, event):
+        row_height = ttk.Style().lookup('Treeview', 'rowheight') or 20
+        # Leave room for the heading row
+        visible_rows = max(1, event.height // int(row_height) - 1)
+        if visible_rows != self.visible_rows:
+            self.visible_rows = visible_rows
+            self.render_file_list()
 
     def format_size(self, size):
         for unit in ['B', 'KB', 'MB', 'GB']:
@@ -236,58 +722,117 @@ class FileManager:
             messagebox.showwarning("Warning", "Please select a file to share")
             return
         
+        file_name = selected[0]
+        file_path = self.stored_path(file_name)
+        
+        # Generate random password
+        password = self.generate_password()
+        
+        self.start_task(f"Share {file_name}", self.upload_share, file_path, file_name, password,
+                        on_done=lambda share_url: self.show_share_dialog(share_url, password),
+                        on_error=lambda e: messagebox.showerror("Error", f"Sharing failed: {str(e)}"))
+
+    def upload_share(self, task, file_path, file_name, password):
+        """Upload a stored file to the share server and return its link. Runs on a worker thread.
+
+        The file goes up in chunks through the server's resumable upload
+        protocol. Retrying is left to self.http: a chunk PUT that fails is
+        sent again, and the server acknowledges a chunk it already has, so a
+        dropped connection costs one chunk rather than the whole upload.
+        """
+        size = self.plaintext_size(file_path)
+        task.total_bytes = size
+        response = self.http.post('/uploads', json={
+            'filename': file_name,
+            'size': size,
+            'username': self.username,
+            'password': password
+        })
+        if response.status_code != 201:
+            raise Exception(f"Server error: {response.text}")
+        session = response.json()
+        upload_url = f"/uploads/{session['upload_id']}"
+        
+        self.send_share_chunks(task, file_path, upload_url, session['chunk_size'], size)
+        
+        # Finalizing twice returns the same link, so it is safe to retry. A 202
+        # means an earlier attempt is still publishing the share
+        for attempt in range(self.max_retries + 1):
+            response = self.http.post(f"{upload_url}/finalize", idempotent=True)
+            if response.status_code != 202:
+                break
+            time.sleep(self.http.backoff(attempt, response))
+        if response.status_code != 200:
+            raise Exception(f"Server error: {response.text}")
+        
+        share_url = response.json()["link"]
+        # Ensure URL is HTTP
+        if share_url.startswith('https://'):
+            share_url = 'http://' + share_url[8:]
+        return share_url
+
+    def send_share_chunks(self, task, file_path, upload_url, chunk_size, size):
+        """PUT the file's chunks until the server has all of them"""
+        offset = 0
+        buffer = b''
+        pieces = self.iter_range(file_path, offset, size)
+        while offset < size:
+            for piece in pieces:
+                buffer += piece
+                if len(buffer) >= chunk_size:
+                    break
+            chunk, buffer = buffer[:chunk_size], buffer[chunk_size:]
+            response = self.http.put(f"{upload_url}/chunks/{offset // chunk_size}",
+                                     data=chunk,
+                                     headers={'X-Chunk-Sha256': hashlib.sha256(chunk).hexdigest()})
+            if response.status_code == 409 and response.json().get('offset', offset) != offset:
+                # The server is at a different chunk than we are; carry on from its offset
+                offset = response.json()['offset']
+                buffer = b''
+                pieces = self.iter_range(file_path, offset, size - offset)
+                continue
+            if response.status_code != 200:
+                raise Exception(f"Server error: {response.text}")
+            offset = response.json()['offset']
+            task.report(offset)
+
+    def start_task(self, name, func, *args, **kwargs):
+        """Run func in the background. Returns its Task, or None if too many are running"""
         try:
-            file_name = self.file_tree.item(selected[0])['values'][0]
-            file_path = os.path.join(self.user_dir, file_name)
-            
-            # Decrypt the file
-            with open(file_path, 'rb') as encrypted_file:
-                encrypted_data = encrypted_file.read()
-                decrypted_data = self.cipher.decrypt(encrypted_data)
-            
-            # Create temporary decrypted file
-            temp_path = os.path.join(self.user_dir, f"temp_{file_name}")
-            with open(temp_path, 'wb') as temp_file:
-                temp_file.write(decrypted_data)
-            
-            try:
-                # Generate random password
-                password = self.generate_password()
-                
-                # Create multipart form data
-                files = {
-                    'file': (file_name.replace('encrypted_', ''), 
-                            open(temp_path, 'rb'), 
-                            'application/octet-stream')
-                }
-                data = {
-                    'username': self.username,
-                    'password': password
-                }
-                
-                # Send to server using HTTP
-                response = requests.post(
-                    'http://127.0.0.1:5000/share',
-                    files=files,
-                    data=data
-                )
-                
-                if response.status_code == 200:
-                    share_url = response.json()["link"]
-                    # Ensure URL is HTTP
-                    if share_url.startswith('https://'):
-                        share_url = 'http://' + share_url[8:]
-                    self.show_share_dialog(share_url, password)
-                else:
-                    raise Exception(f"Server error: {response.text}")
-                
-            finally:
-                # Clean up temporary file
-                if os.path.exists(temp_path):
-                    os.remove(temp_path)
-                
-        except Exception as e:
-            messagebox.showerror("Error", f"Sharing failed: {str(e)}")
+            return self.tasks.submit(name, func, *args, **kwargs)
+        except TaskQueueFull as e:
+            messagebox.showwarning("Busy", str(e))
+            return None
+
+    def show_task_progress(self, task):
+        """Reflect a background task's state in the task list. Called on the Tk thread"""
+        if not self.task_tree.winfo_exists():
+            return
+        if task.fraction is None:
+            progress = self.format_size(task.done_bytes)
+        else:
+            progress = f"{task.fraction:.0%}"
+        values = (task.name, progress, f"{self.format_size(task.bytes_per_second)}/s", task.state)
+        
+        row = str(id(task))
+        if self.task_tree.exists(row):
+            self.task_tree.item(row, values=values)
+        else:
+            self.task_tree.insert('', 'end', iid=row, values=values)
+        
+        if task.future.done():
+            # Leave finished tasks visible briefly before removing them
+            self.root.after(3000, self.remove_task_row, row)
+
+    def remove_task_row(self, row):
+        if self.task_tree.winfo_exists() and self.task_tree.exists(row):
+            self.task_tree.delete(row)
+
+    def cancel_task(self):
+        selected = set(self.task_tree.selection())
+        for task in self.tasks.tasks:
+            if not selected or str(id(task)) in selected:
+                task.cancel()
 
     def show_share_dialog(self, share_url, password):
         # Create custom dialog
@@ -296,7 +841,7 @@ class FileManager:
         
         # Center the dialog
         dialog_width = 500
-        dialog_height = 200
+        dialog_height = 230
         screen_width = self.root.winfo_screenwidth()
         screen_height = self.root.winfo_screenheight()
         x = (screen_width - dialog_width) // 2
@@ -321,6 +866,13 @@ class FileManager:
         pass_entry.insert(0, password)
         pass_entry.pack(pady=(0, 10))
         
+        # How well the keep-alive client is doing, over this session's requests
+        stats = self.http.stats()
+        ttk.Label(main_frame, foreground='gray',
+                  text=f"{stats['requests']} server requests over {stats['connections_opened']} "
+                       f"connection(s), {stats['connection_reuse']:.0%} reused, "
+                       f"{stats['retries']} retried").pack()
+        
         def copy_link():
             self.root.clipboard_clear()
             self.root.clipboard_append(share_url)
@@ -359,6 +911,65 @@ class FileManager:
         share_dialog.grab_set()
         self.root.wait_window(share_dialog)
 
+    def read_manifest(self, file_path):
+        """Return the chunk manifest stored at file_path, or None if it holds the file itself"""
+        flags = container_flags(file_path)
+        if flags is None or not flags & FLAG_CHUNK_MANIFEST:
+            return None
+        with open(file_path, "rb") as encrypted_file:
+            return ChunkStore.decode_manifest(b''.join(self.stream_cipher.iter_decrypt(encrypted_file)))
+
+    def plaintext_size(self, file_path):
+        manifest = self.read_manifest(file_path)
+        if manifest:
+            return manifest['size']
+        with open(file_path, "rb") as encrypted_file:
+            if is_container(file_path):
+                return self.stream_cipher.plaintext_size(encrypted_file)
+            return len(self.cipher.decrypt(encrypted_file.read()))
+
+    def decrypt_to_path(self, file_path, save_path, progress=None):
+        """Decrypt a stored file to save_path, writing plaintext as each segment is verified"""
+        partial_path = save_path + ".part"
+        manifest = self.read_manifest(file_path)
+        try:
+            with open(file_path, "rb") as encrypted_file, open(partial_path, "wb") as decrypted_file:
+                if manifest:
+                    written = 0
+                    for chunk in self.chunk_store.iter_file(manifest):
+                        decrypted_file.write(chunk)
+                        written += len(chunk)
+                        if progress:
+                            progress(written, manifest['size'])
+                elif is_container(file_path):
+                    if progress:
+                        progress(0, self.stream_cipher.plaintext_size(encrypted_file))
+                        encrypted_file.seek(0)
+                    self.stream_cipher.decrypt_stream(encrypted_file, decrypted_file, progress=progress)
+                else:
+                    decrypted_file.write(self.cipher.decrypt(encrypted_file.read()))
+            # Only expose the file once every segment has been authenticated
+            os.replace(partial_path, save_path)
+        finally:
+            if os.path.exists(partial_path):
+                os.remove(partial_path)
+
+    def iter_range(self, file_path, offset, length):
+        """Yield the decrypted bytes [offset, offset + length) of a stored file piece by piece"""
+        manifest = self.read_manifest(file_path)
+        if manifest:
+            yield from self.chunk_store.iter_range(manifest, offset, length)
+            return
+        with open(file_path, "rb") as encrypted_file:
+            if is_container(file_path):
+                yield from self.stream_cipher.iter_range(encrypted_file, offset, length)
+            else:
+                yield self.cipher.decrypt(encrypted_file.read())[offset:offset + length]
+
+    def read_range(self, file_path, offset, length):
+        """Decrypt only bytes [offset, offset + length) of a stored file, e.g. for previews"""
+        return b''.join(self.iter_range(file_path, offset, length))
+
     def load_or_generate_key(self):
         key_file = os.path.join("keys", f"{self.username}_key.key")
         os.makedirs("keys", exist_ok=True)
@@ -376,9 +987,21 @@ class FileManager:
         chars = string.ascii_letters + string.digits + string.punctuation
         return ''.join(random.choice(chars) for _ in range(12))
 
+    def release_resources(self):
+        """Cancel background tasks and stop the worker pools and connections"""
+        self.tasks.shutdown()
+        self.stream_cipher.close()
+        self.http.close()
+
     def go_back(self):
+        self.release_resources()
+        self.root.protocol("WM_DELETE_WINDOW", self.root.destroy)
         self.go_back_callback()
 
+    def close_window(self):
+        self.release_resources()
+        self.root.destroy()
+
     def create_github_gist(self, file_path, file_name, password):
         try:
             # Read file content
@@ -415,13 +1038,8 @@ class FileManager:
 
     def connect_to_server(self):
         """Attempt to connect to the server with retries"""
-        for attempt in range(self.max_retries):
-            try:
-                response = requests.get(f"{self.server_url}/health")
-                if response.status_code == 200:
-                    return True
-            except requests.exceptions.ConnectionError:
-                if attempt < self.max_retries - 1:
-                    time.sleep(self.retry_delay)
-                continue
-        return False
+        try:
+            # /health answers 503 until the server is ready, which the client retries
+            return self.http.get("/health", timeout=(self.retry_delay, 5)).status_code == 200
+        except requests.exceptions.RequestException:
+            return False
@@ -0,0 +1,118 @@
+import time
+import random
+import threading
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.exceptions import NewConnectionError
+
+IDEMPOTENT_METHODS = {'GET', 'HEAD', 'PUT', 'DELETE', 'OPTIONS'}
+RETRY_STATUSES = {429, 502, 503, 504}
+DEFAULT_TIMEOUT = (3.05, 60)  # (connect, read) seconds
+
+
+def connection_not_established(error):
+    """True if a request failed before reaching the server, so retrying can't repeat it"""
+    if isinstance(error, requests.exceptions.ConnectTimeout):
+        return True
+    cause = error.args[0] if error.args else None
+    return isinstance(getattr(cause, 'reason', cause), NewConnectionError)
+
+
+class HttpClient:
+    """Keep-alive HTTP client for the share server.
+
+    One requests session is shared by every caller, so connections are
+    pooled and reused rather than opened per request. Failed requests are
+    retried with exponential backoff and full jitter: on connection errors,
+    timeouts and 429/502/503/504 responses for idempotent methods, and only
+    on failures to connect for everything else, so a POST is never sent
+    twice. Pass idempotent=True for POSTs the server makes safe to repeat.
+    Bodies that can't be replayed should be passed as a callable returning
+    a fresh body for each attempt.
+    """
+
+    def __init__(self, base_url, max_retries=3, retry_delay=1, max_delay=10,
+                 timeout=DEFAULT_TIMEOUT, pool_size=4):
+        self.base_url = base_url.rstrip('/')
+        self.max_retries = max_retries
+        self.retry_delay = retry_delay
+        self.max_delay = max_delay
+        self.timeout = timeout
+        self.session = requests.Session()
+        # Retries are handled here, not by urllib3, so backoff applies to all of them
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size, max_retries=0)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+        self.lock = threading.Lock()
+        self.requests_sent = 0
+        self.retries = 0
+        self.failures = 0
+
+    def backoff(self, attempt, response=None):
+        """Seconds to wait before retry number attempt (0-based)"""
+        if response is not None and response.headers.get('Retry-After', '').isdigit():
+            return min(int(response.headers['Retry-After']), self.max_delay)
+        return random.uniform(0, min(self.max_delay, self.retry_delay * 2 ** attempt))
+
+    def request(self, method, path, data=None, timeout=None, idempotent=None, **kwargs):
+        """Send a request to base_url + path, retrying as described above.
+
+        Returns the response; a retriable status is returned as-is once the
+        retries run out. The last exception is raised if every attempt failed.
+        """
+        method = method.upper()
+        if idempotent is None:
+            idempotent = method in IDEMPOTENT_METHODS
+        url = self.base_url + path
+        for attempt in range(self.max_retries + 1):
+            last_attempt = attempt == self.max_retries
+            with self.lock:
+                self.requests_sent += 1
+            try:
+                response = self.session.request(method, url,
+                                                data=data() if callable(data) else data,
+                                                timeout=timeout or self.timeout, **kwargs)
+            except (requests.exceptions.ConnectionError, requests.exceptions.Timeout) as e:
+                if last_attempt or not (idempotent or connection_not_established(e)):
+                    with self.lock:
+                        self.failures += 1
+                    raise
+                delay = self.backoff(attempt)
+            else:
+                if last_attempt or not idempotent or response.status_code not in RETRY_STATUSES:
+                    return response
+                delay = self.backoff(attempt, response)
+                response.close()
+            with self.lock:
+                self.retries += 1
+            time.sleep(delay)
+
+    def get(self, path, **kwargs):
+        return self.request('GET', path, **kwargs)
+
+    def post(self, path, **kwargs):
+        return self.request('POST', path, **kwargs)
+
+    def put(self, path, **kwargs):
+        return self.request('PUT', path, **kwargs)
+
+    def stats(self):
+        """Requests sent, connections opened, and how often a pooled connection was reused"""
+        opened = 0
+        for adapter in set(self.session.adapters.values()):
+            for key in adapter.poolmanager.pools.keys():
+                pool = adapter.poolmanager.pools.get(key)
+                if pool is not None:
+                    opened += pool.num_connections
+        with self.lock:
+            sent, retries, failures = self.requests_sent, self.retries, self.failures
+        return {
+            'requests': sent,
+            'connections_opened': opened,
+            'connection_reuse': 1 - opened / sent if sent else 0.0,
+            'retries': retries,
+            'failures': failures
+        }
+
+    def close(self):
+        self.session.close()
@@ -0,0 +1,112 @@
+import os
+import json
+import base64
+import struct
+from cryptography.hazmat.primitives import hashes
+from cryptography.hazmat.primitives.kdf.hkdf import HKDF
+from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+from cryptography.exceptions import InvalidTag
+
+DATA_KEY_SIZE = 32
+WRAP_NONCE_SIZE = 12
+# Wrapped key field: key version(4) | nonce(12) | AES-GCM(data key) + tag(16)
+WRAPPED_KEY_FORMAT = f'>I{WRAP_NONCE_SIZE}s{DATA_KEY_SIZE + 16}s'
+WRAPPED_KEY_SIZE = struct.calcsize(WRAPPED_KEY_FORMAT)
+
+
+class KeyRingError(Exception):
+    """Raised when a data key can't be unwrapped"""
+
+
+class KeyRing:
+    """A user's versioned key-encryption keys.
+
+    Files are encrypted with their own random data key, which is stored in
+    the file header wrapped (AES-GCM) under one version of the user's key.
+    Rotating adds a new version and makes it current; existing files keep
+    working with the version they were wrapped under until their header is
+    rewrapped. Once no file needs an old version any more, retire() drops it,
+    so a leaked old key stops exposing anything.
+
+    The ring is a JSON file next to the user's original key, which becomes
+    version 1 so files written before the ring existed stay readable.
+    """
+
+    def __init__(self, path, initial_key):
+        self.path = path
+        if os.path.exists(path):
+            with open(path) as f:
+                data = json.load(f)
+            self.keys = {int(version): base64.urlsafe_b64decode(key)
+                         for version, key in data['keys'].items()}
+            self.current_version = data['current']
+        else:
+            self.keys = {1: initial_key}
+            self.current_version = 1
+            self.save()
+
+    def save(self):
+        data = {
+            'current': self.current_version,
+            'keys': {str(version): base64.urlsafe_b64encode(key).decode()
+                     for version, key in self.keys.items()}
+        }
+        temp_path = self.path + '.tmp'
+        with open(temp_path, 'w') as f:
+            json.dump(data, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temp_path, self.path)
+
+    def rotate(self):
+        """Add a new key version and make it current. Returns the new version"""
+        version = max(self.keys) + 1
+        self.keys[version] = os.urandom(32)
+        self.current_version = version
+        self.save()
+        return version
+
+    def retire(self, keep):
+        """Drop every key version except the current one and those in keep. Returns the versions dropped"""
+        dropped = sorted(version for version in self.keys
+                         if version != self.current_version and version not in keep)
+        for version in dropped:
+            del self.keys[version]
+        if dropped:
+            self.save()
+        return dropped
+
+    def wrapping_key(self, version):
+        try:
+            key = self.keys[version]
+        except KeyError:
+            raise KeyRingError(f"Unknown key version: {version}")
+        return HKDF(algorithm=hashes.SHA256(),
+                    length=32,
+                    salt=None,
+                    info=b'protector-key-wrap').derive(key)
+
+    def wrap(self, data_key, context, version=None):
+        """Wrap data_key under a key version (the current one by default).
+
+        context is authenticated with the wrapped key, binding it to the
+        header it's stored in.
+        """
+        version = self.current_version if version is None else version
+        nonce = os.urandom(WRAP_NONCE_SIZE)
+        sealed = AESGCM(self.wrapping_key(version)).encrypt(nonce, data_key,
+                                                             context + struct.pack('>I', version))
+        return struct.pack(WRAPPED_KEY_FORMAT, version, nonce, sealed)
+
+    def unwrap(self, wrapped, context):
+        """Return the data key from a wrapped key field"""
+        version, nonce, sealed = struct.unpack(WRAPPED_KEY_FORMAT, wrapped)
+        try:
+            return AESGCM(self.wrapping_key(version)).decrypt(nonce, sealed,
+                                                               context + struct.pack('>I', version))
+        except InvalidTag:
+            raise KeyRingError(f"Data key failed to unwrap under key version {version}")
+
+    @staticmethod
+    def wrapped_version(wrapped):
+        return struct.unpack(WRAPPED_KEY_FORMAT, wrapped)[0]
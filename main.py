@@ -4,26 +4,45 @@ from file_manager import FileManager
 import subprocess
 import sys
 import threading
+import wsgi_server
 from flask import Flask
 
 def start_share_server():
     try:
-        # Start the Flask server in a separate process
-        subprocess.Popen([sys.executable, 'share_server.py'],
-                        stdout=subprocess.PIPE,
-                        stderr=subprocess.PIPE)
+        # Start the share server in production mode in a separate process. Its
+        # output goes to a log file: a pipe nobody reads would fill up and
+        # stall the server.
+        log_file = open('share_server.log', 'ab')
+        server = subprocess.Popen([sys.executable, 'share_server.py'],
+                                  stdout=log_file,
+                                  stderr=subprocess.STDOUT)
+        log_file.close()
         print("Share server started successfully")
+        return server
     except Exception as e:
         print(f"Error starting share server: {e}")
+        return None
+
+def stop_share_server(server):
+    # SIGTERM lets the workers finish in-flight requests before exiting
+    if server is not None and server.poll() is None:
+        server.terminate()
+        try:
+            server.wait(timeout=wsgi_server.SHUTDOWN_TIMEOUT + 5)
+        except subprocess.TimeoutExpired:
+            server.kill()
 
 def main():
-    start_share_server()
+    server = start_share_server()
     
     root = tk.Tk()
     root.title("Secure File Manager")
     root.geometry("800x600")  # Increased initial size
     app = AuthWindow(root, lambda username: go_to_file_manager(root, username))
-    root.mainloop()
+    try:
+        root.mainloop()
+    finally:
+        stop_share_server(server)
 
 def go_to_file_manager(root, username):
     for widget in root.winfo_children():
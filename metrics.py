@@ -0,0 +1,287 @@
+import os
+import json
+import time
+import atexit
+import bisect
+import threading
+
+# Upper bounds of the request latency histogram buckets, in seconds
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+FLUSH_INTERVAL = 1.0  # Seconds between snapshots of this process's metrics
+
+PREFIX = 'protector_http_'
+COUNTERS = {
+    'requests_total': "Requests handled, by endpoint, method and status",
+    'request_bytes_total': "Request body bytes received",
+    'response_bytes_total': "Response body bytes sent",
+}
+GAUGES = {
+    'requests_in_flight': "Requests currently being handled",
+}
+HISTOGRAM = 'request_duration_seconds'
+HISTOGRAM_HELP = "Time from receiving a request to sending the last byte of its response"
+
+
+def process_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def format_labels(labels):
+    return ','.join(f'{name}="{value}"' for name, value in labels)
+
+
+class Metrics:
+    """Request metrics for a WSGI app, shared across worker processes.
+
+    Each process counts in memory under a single lock, which costs a few
+    dictionary updates per request, and a background thread writes a
+    snapshot to <directory>/<pid>.json about once a second. render() merges
+    every snapshot in the directory, so whichever worker answers /metrics
+    reports totals for the whole server. Snapshots of exited workers are
+    kept so counters never go backwards across reloads; their gauges are
+    ignored.
+    """
+
+    def __init__(self, directory, flush_interval=FLUSH_INTERVAL):
+        self.directory = directory
+        self.flush_interval = flush_interval
+        self.lock = threading.Lock()
+        self.counters = {}  # (name, labels) -> value
+        self.gauges = {}
+        self.histograms = {}  # labels -> [bucket counts..., sum, count]
+        self.flusher = None
+        self.dirty = False
+
+    @staticmethod
+    def reset(directory):
+        """Clear snapshots left by a previous run of the server"""
+        os.makedirs(directory, exist_ok=True)
+        for name in os.listdir(directory):
+            if name.endswith('.json'):
+                os.remove(os.path.join(directory, name))
+
+    def start(self):
+        if self.flusher is None:
+            os.makedirs(self.directory, exist_ok=True)
+            self.flusher = threading.Thread(target=self.flush_loop, name='metrics-flush', daemon=True)
+            self.flusher.start()
+            atexit.register(self.flush)
+
+    def add(self, table, name, labels, amount):
+        key = (name, labels)
+        table[key] = table.get(key, 0) + amount
+
+    def request_started(self, endpoint):
+        with self.lock:
+            self.add(self.gauges, 'requests_in_flight', (('endpoint', endpoint),), 1)
+            self.dirty = True
+
+    def request_finished(self, endpoint, method, status, duration, bytes_in, bytes_out):
+        labels = (('endpoint', endpoint),)
+        bucket = bisect.bisect_left(LATENCY_BUCKETS, duration)
+        with self.lock:
+            self.add(self.gauges, 'requests_in_flight', labels, -1)
+            self.add(self.counters, 'requests_total',
+                     labels + (('method', method), ('status', status)), 1)
+            self.add(self.counters, 'request_bytes_total', labels, bytes_in)
+            self.add(self.counters, 'response_bytes_total', labels, bytes_out)
+            histogram = self.histograms.get(labels)
+            if histogram is None:
+                histogram = self.histograms[labels] = [0] * (len(LATENCY_BUCKETS) + 3)
+            histogram[bucket] += 1  # The bucket after the last bound is +Inf
+            histogram[-2] += duration
+            histogram[-1] += 1
+            self.dirty = True
+
+    def snapshot(self):
+        with self.lock:
+            return {
+                'pid': os.getpid(),
+                'counters': [[name, labels, value] for (name, labels), value in self.counters.items()],
+                'gauges': [[name, labels, value] for (name, labels), value in self.gauges.items()],
+                'histograms': [[labels, values] for labels, values in self.histograms.items()],
+            }
+
+    def flush(self):
+        with self.lock:
+            if not self.dirty:
+                return
+            self.dirty = False
+        path = os.path.join(self.directory, f'{os.getpid()}.json')
+        with open(path + '.tmp', 'w') as f:
+            json.dump(self.snapshot(), f)
+        os.replace(path + '.tmp', path)
+
+    def flush_loop(self):
+        while True:
+            time.sleep(self.flush_interval)
+            try:
+                self.flush()
+            except OSError as e:
+                print(f"Error writing metrics: {e}")
+
+    def collect(self):
+        """Snapshots of every process, with this one's taken live"""
+        own = self.snapshot()
+        snapshots = [own]
+        try:
+            names = os.listdir(self.directory)
+        except FileNotFoundError:
+            names = []
+        for name in names:
+            if not name.endswith('.json') or name == f"{own['pid']}.json":
+                continue
+            try:
+                with open(os.path.join(self.directory, name)) as f:
+                    snapshots.append(json.load(f))
+            except (OSError, ValueError):
+                continue  # Removed or being replaced
+        return snapshots
+
+    def render(self):
+        """Return the merged metrics in the Prometheus text exposition format"""
+        counters, gauges, histograms = {}, {}, {}
+        for snapshot in self.collect():
+            alive = snapshot['pid'] == os.getpid() or process_alive(snapshot['pid'])
+            for name, labels, value in snapshot['counters']:
+                self.add(counters, name, tuple(map(tuple, labels)), value)
+            if alive:
+                for name, labels, value in snapshot['gauges']:
+                    self.add(gauges, name, tuple(map(tuple, labels)), value)
+            for labels, values in snapshot['histograms']:
+                merged = histograms.setdefault(tuple(map(tuple, labels)), [0] * len(values))
+                for i, value in enumerate(values):
+                    merged[i] += value
+
+        lines = []
+        for kind, table, descriptions in (('counter', counters, COUNTERS), ('gauge', gauges, GAUGES)):
+            for name, description in descriptions.items():
+                lines.append(f'# HELP {PREFIX}{name} {description}')
+                lines.append(f'# TYPE {PREFIX}{name} {kind}')
+                for (metric, labels), value in sorted(table.items()):
+                    if metric == name:
+                        lines.append(f'{PREFIX}{name}{{{format_labels(labels)}}} {value}')
+
+        name = PREFIX + HISTOGRAM
+        lines.append(f'# HELP {name} {HISTOGRAM_HELP}')
+        lines.append(f'# TYPE {name} histogram')
+        for labels, values in sorted(histograms.items()):
+            cumulative = 0
+            for bound, count in zip(LATENCY_BUCKETS + ('+Inf',), values):
+                cumulative += count
+                lines.append(f'{name}_bucket{{{format_labels(labels + (("le", bound),))}}} {cumulative}')
+            lines.append(f'{name}_sum{{{format_labels(labels)}}} {values[-2]}')
+            lines.append(f'{name}_count{{{format_labels(labels)}}} {values[-1]}')
+        return '\n'.join(lines) + '\n'
+
+
+class MetricsMiddleware:
+    """WSGI middleware that records every request to a Metrics instance.
+
+    Requests are labelled by Flask endpoint, so label values are bounded by
+    the number of routes. Duration and bytes out are recorded when the
+    response body is closed, so they cover streamed downloads in full.
+    Bodies made by the server's wsgi.file_wrapper are passed through
+    unwrapped so the server can still send them with sendfile (see
+    wsgi_server.SendfileWrapper); those are recorded when the server closes
+    them, with bytes out taken from their Content-Length.
+    """
+
+    def __init__(self, app, flask_app, metrics, skip=()):
+        self.app = app
+        self.url_map = flask_app.url_map
+        self.metrics = metrics
+        self.skip = skip
+
+    def endpoint(self, environ):
+        try:
+            return self.url_map.bind_to_environ(environ).match()[0]
+        except Exception:
+            return 'unmatched'
+
+    def __call__(self, environ, start_response):
+        endpoint = self.endpoint(environ)
+        if endpoint in self.skip:
+            return self.app(environ, start_response)
+
+        self.metrics.start()
+        started = time.perf_counter()
+        status = []
+        content_length = []
+
+        def record_status(status_line, headers, exc_info=None):
+            status[:] = [status_line.split(' ', 1)[0]]
+            content_length[:] = [value for name, value in headers if name.lower() == 'content-length']
+            return start_response(status_line, headers, exc_info)
+
+        def finished(bytes_out):
+            self.metrics.request_finished(endpoint, environ.get('REQUEST_METHOD', ''),
+                                          status[0] if status else '500',
+                                          time.perf_counter() - started,
+                                          int(environ.get('CONTENT_LENGTH') or 0), bytes_out)
+
+        self.metrics.request_started(endpoint)
+        try:
+            body = self.app(environ, record_status)
+        except BaseException:
+            status[:] = ['500']
+            finished(0)
+            raise
+        file_wrapper = environ.get('wsgi.file_wrapper')
+        if isinstance(file_wrapper, type) and isinstance(body, file_wrapper):
+            # Left as the server's own type so it can still sendfile it; the
+            # request is recorded when the server closes the body after sending
+            body.close = RecordingClose(body.close, finished,
+                                        int(content_length[0]) if content_length else 0)
+            return body
+        return CountingBody(body, finished)
+
+
+class RecordingClose:
+    """Replacement for a passed-through body's close() that records the request once"""
+
+    def __init__(self, close, on_close, length):
+        self.close = close
+        self.on_close = on_close
+        self.length = length
+        self.closed = False
+
+    def __call__(self):
+        if self.closed:
+            return
+        self.closed = True
+        try:
+            self.close()
+        finally:
+            self.on_close(self.length)
+
+
+class CountingBody:
+    """Response iterable that counts the bytes sent and reports them on close"""
+
+    def __init__(self, body, on_close):
+        self.body = body
+        self.on_close = on_close
+        self.sent = 0
+        self.closed = False
+
+    def __iter__(self):
+        for chunk in self.body:
+            self.sent += len(chunk)
+            yield chunk
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        try:
+            if hasattr(self.body, 'close'):
+                self.body.close()
+        finally:
+            self.on_close(self.sent)
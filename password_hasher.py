@@ -0,0 +1,70 @@
+import bcrypt
+import hashlib
+import hmac
+import math
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+MIN_COST = 10
+MAX_COST = 16
+TARGET_SECONDS = 0.25  # Aim for a hash to take about this long on this machine
+
+
+class PasswordHasher:
+    """Hashes and verifies passwords with bcrypt on a small worker pool.
+
+    bcrypt is deliberately slow and releases the GIL while it runs, so work is
+    handed to background threads with submit() to keep the Tk main loop
+    responsive. The cost factor is calibrated on this host in the background
+    when the hasher is created, so hashes take roughly TARGET_SECONDS.
+    """
+
+    def __init__(self, workers=2, max_pending=16, target_seconds=TARGET_SECONDS):
+        self.executor = ThreadPoolExecutor(max_workers=workers,
+                                           thread_name_prefix='password-hasher')
+        self.pending = threading.BoundedSemaphore(max_pending)
+        self.calibration = self.executor.submit(self.calibrate, target_seconds)
+
+    @property
+    def cost(self):
+        return self.calibration.result()
+
+    @staticmethod
+    def calibrate(target_seconds):
+        """Return the bcrypt cost whose hashing time is closest to target_seconds"""
+        sample_cost = 8
+        start = time.perf_counter()
+        bcrypt.hashpw(b'calibration', bcrypt.gensalt(sample_cost))
+        elapsed = max(time.perf_counter() - start, 1e-6)
+        # Each extra cost step doubles the work
+        cost = sample_cost + round(math.log2(target_seconds / elapsed))
+        return min(max(cost, MIN_COST), MAX_COST)
+
+    def submit(self, func, *args):
+        """Run func(*args) on the worker pool and return a Future for its result"""
+        if not self.pending.acquire(blocking=False):
+            raise RuntimeError("Too many password operations in progress")
+        future = self.executor.submit(func, *args)
+        future.add_done_callback(lambda _: self.pending.release())
+        return future
+
+    def hash(self, password):
+        return bcrypt.hashpw(password.encode(), bcrypt.gensalt(self.cost)).decode()
+
+    def verify(self, password, stored_hash):
+        """Check password against a stored hash.
+
+        Returns (matches, needs_rehash). Legacy unsalted SHA-256 hashes and
+        bcrypt hashes below the calibrated cost need rehashing after a
+        successful check.
+        """
+        if stored_hash.startswith('$2'):
+            matches = bcrypt.checkpw(password.encode(), stored_hash.encode())
+            return matches, matches and int(stored_hash.split('$')[2]) < self.cost
+        legacy_hash = hashlib.sha256(password.encode()).hexdigest()
+        matches = hmac.compare_digest(legacy_hash, stored_hash)
+        return matches, matches
+
+    def shutdown(self):
+        self.executor.shutdown(wait=False, cancel_futures=True)
@@ -0,0 +1,103 @@
+import os
+import mmap
+import time
+import struct
+import hashlib
+import threading
+from contextlib import contextmanager
+try:
+    import fcntl
+except ImportError:  # Windows serves from a single process, so thread locks are enough
+    fcntl = None
+
+SLOT_FORMAT = '<Qdd'  # key hash (0 = empty), tokens left, time of last use
+SLOT_SIZE = struct.calcsize(SLOT_FORMAT)
+DEFAULT_SETS = 4096
+DEFAULT_WAYS = 8
+DEFAULT_STRIPES = 64
+
+
+def key_hash(key):
+    digest = int.from_bytes(hashlib.blake2b(key.encode(), digest_size=8).digest(), 'little')
+    return digest or 1
+
+
+class RateLimiter:
+    """Token buckets keyed by strings, shared by every worker process.
+
+    The buckets live in a fixed-size table in a memory-mapped file, so a
+    check is a few memory operations with no disk access, and every worker
+    counts against the same buckets. Each key hashes to a set of `ways`
+    slots; a key without a slot takes an empty one or evicts the least
+    recently used bucket in its set, so the table never grows past
+    sets * ways slots however many clients there are. An evicted key starts
+    again with a full bucket.
+
+    Threads lock one of `stripes` locks and processes lock the set's bytes
+    with a POSIX record lock, so checks on different keys rarely wait for
+    each other.
+    """
+
+    def __init__(self, path, rate, burst, sets=DEFAULT_SETS, ways=DEFAULT_WAYS,
+                 stripes=DEFAULT_STRIPES):
+        self.rate = rate  # Tokens added per second
+        self.burst = burst  # Bucket capacity
+        self.sets = sets
+        self.ways = ways
+        self.set_size = ways * SLOT_SIZE
+        size = sets * self.set_size
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self.fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o600)
+        if os.fstat(self.fd).st_size != size:
+            os.ftruncate(self.fd, size)
+        self.table = mmap.mmap(self.fd, size)
+        self.locks = [threading.Lock() for _ in range(stripes)]
+
+    @contextmanager
+    def locked(self, set_index):
+        start = set_index * self.set_size
+        with self.locks[set_index % len(self.locks)]:
+            if fcntl is None:
+                yield
+                return
+            fcntl.lockf(self.fd, fcntl.LOCK_EX, self.set_size, start)
+            try:
+                yield
+            finally:
+                fcntl.lockf(self.fd, fcntl.LOCK_UN, self.set_size, start)
+
+    def take(self, key, cost=1):
+        """Take cost tokens from key's bucket.
+
+        Returns 0 if they were available, otherwise the number of seconds
+        until they will be (nothing is taken in that case).
+        """
+        digest = key_hash(key)
+        set_index = digest % self.sets
+        base = set_index * self.set_size
+        now = time.time()
+        with self.locked(set_index):
+            victim, victim_used = None, None
+            for way in range(self.ways):
+                offset = base + way * SLOT_SIZE
+                slot_key, tokens, used = struct.unpack_from(SLOT_FORMAT, self.table, offset)
+                if slot_key == digest:
+                    tokens = min(self.burst, tokens + max(now - used, 0) * self.rate)
+                    break
+                # Empty slots were last used at time 0, so they go first
+                if victim is None or used < victim_used:
+                    victim, victim_used = offset, used
+            else:
+                offset, tokens = victim, self.burst
+
+            if tokens >= cost:
+                struct.pack_into(SLOT_FORMAT, self.table, offset, digest, tokens - cost, now)
+                return 0
+            struct.pack_into(SLOT_FORMAT, self.table, offset, digest, tokens, now)
+            return (cost - tokens) / self.rate
+
+    def close(self):
+        self.table.close()
+        os.close(self.fd)
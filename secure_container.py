@@ -0,0 +1,565 @@
+import io
+import os
+import json
+import struct
+import base64
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from cryptography.hazmat.primitives import hashes
+from cryptography.hazmat.primitives.kdf.hkdf import HKDF
+from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+from cryptography.exceptions import InvalidTag
+from compression import CompressingReader, iter_decompressed, TRAILER_FORMAT, TRAILER_SIZE
+from key_ring import KeyRingError, WRAPPED_KEY_SIZE, DATA_KEY_SIZE
+
+# Container layout
+#
+#   header:   magic(6) | version(1) | flags(1) | segment_size(4) | salt(16)
+#             [version 2: wrapped data key (see key_ring.py)]
+#   segments: AES-256-GCM(segment plaintext) + tag(16), repeated
+#
+# Every segment is sealed with a key derived from the per-file salt and, in
+# version 1, the user's Fernet key or, in version 2, a random per-file data
+# key wrapped by the user's key ring. The nonce encodes the segment index and
+# whether it is the last segment, and the fixed part of the header is
+# authenticated with every segment, so segments cannot be reordered, dropped,
+# truncated or moved between files. The wrapped key is left out of the
+# segments' associated data so key rotation can rewrap it in place.
+MAGIC = b'PRTCTR'
+DIRECT_KEY_VERSION = 1
+ENVELOPE_VERSION = 2
+FORMAT_VERSION = ENVELOPE_VERSION
+HEADER_FORMAT = '>6sBBI16s'
+HEADER_SIZE = struct.calcsize(HEADER_FORMAT)
+SALT_SIZE = 16
+TAG_SIZE = 16
+DEFAULT_SEGMENT_SIZE = 1024 * 1024  # 1MB of plaintext per segment
+MAX_SEGMENT_SIZE = 64 * 1024 * 1024
+
+# Header flags
+FLAG_CHUNK_MANIFEST = 0x01  # Plaintext is a chunk store manifest, not file contents
+FLAG_ZLIB = 0x02  # Plaintext is a zlib stream followed by its uncompressed length
+
+
+class ContainerError(Exception):
+    """Raised when a container is malformed or fails authentication"""
+
+
+def segment_nonce(index, final):
+    return struct.pack('>QI', index, 1 if final else 0)
+
+
+def seal_segment(key, header, index, final, data):
+    return AESGCM(key).encrypt(segment_nonce(index, final), data, header[:HEADER_SIZE])
+
+
+def open_segment(key, header, index, final, data):
+    try:
+        return AESGCM(key).decrypt(segment_nonce(index, final), data, header[:HEADER_SIZE])
+    except InvalidTag:
+        raise ContainerError(f"Segment {index} failed authentication")
+
+
+def reseal_segment(keys, headers, index, final, data):
+    """Open a segment sealed under keys[0] and headers[0] and seal it again under keys[1] and headers[1]"""
+    return seal_segment(keys[1], headers[1], index, final,
+                        open_segment(keys[0], headers[0], index, final, data))
+
+
+def header_flags(header):
+    return struct.unpack(HEADER_FORMAT, header[:HEADER_SIZE])[2]
+
+
+def is_container(file_path):
+    """Return True if file_path holds a chunked container rather than a legacy Fernet token"""
+    with open(file_path, 'rb') as f:
+        return f.read(len(MAGIC)) == MAGIC
+
+
+def container_version(file_path):
+    """Return the format version of a container, or None for a legacy Fernet token"""
+    with open(file_path, 'rb') as f:
+        header = f.read(HEADER_SIZE)
+    if len(header) != HEADER_SIZE or not header.startswith(MAGIC):
+        return None
+    return struct.unpack(HEADER_FORMAT, header)[1]
+
+
+def container_flags(file_path):
+    """Return the header flags of a container, or None for a legacy Fernet token"""
+    with open(file_path, 'rb') as f:
+        header = f.read(HEADER_SIZE)
+    if len(header) != HEADER_SIZE or not header.startswith(MAGIC):
+        return None
+    return header_flags(header)
+
+
+class ChunkedCipher:
+    """Encrypts and decrypts chunked containers.
+
+    Segments are independent, so with workers > 1 they are fanned out to a
+    thread pool (or a process pool with use_processes=True) and written back
+    in order. At most two segments per worker are in flight at a time, which
+    keeps memory bounded however large the file is.
+
+    With a key_ring, new containers use envelope encryption (version 2);
+    without one they are keyed directly from key (version 1). Both versions
+    can be read as long as the key they need is available.
+    """
+
+    def __init__(self, key, segment_size=DEFAULT_SEGMENT_SIZE, workers=1, use_processes=False,
+                 key_ring=None):
+        if not 0 < segment_size <= MAX_SEGMENT_SIZE:
+            raise ValueError(f"Invalid segment size: {segment_size}")
+        self.master_key = base64.urlsafe_b64decode(key)
+        self.segment_size = segment_size
+        self.workers = max(1, workers or os.cpu_count() or 1)
+        self.use_processes = use_processes
+        self.key_ring = key_ring
+        self.executor = None
+
+    def derive_key(self, salt, key_material=None):
+        return HKDF(algorithm=hashes.SHA256(),
+                    length=32,
+                    salt=salt,
+                    info=b'protector-container').derive(key_material or self.master_key)
+
+    def get_executor(self):
+        if self.executor is None:
+            pool = ProcessPoolExecutor if self.use_processes else ThreadPoolExecutor
+            self.executor = pool(max_workers=self.workers)
+        return self.executor
+
+    def close(self):
+        if self.executor is not None:
+            self.executor.shutdown(wait=True, cancel_futures=True)
+            self.executor = None
+
+    def map_segments(self, func, key, header, segments):
+        """Apply func to (index, final, data) segments, yielding results in order"""
+        if self.workers == 1:
+            for index, final, data in segments:
+                yield func(key, header, index, final, data)
+            return
+
+        executor = self.get_executor()
+        pending = deque()
+        try:
+            for index, final, data in segments:
+                pending.append(executor.submit(func, key, header, index, final, data))
+                if len(pending) >= self.workers * 2:
+                    yield pending.popleft().result()
+            while pending:
+                yield pending.popleft().result()
+        finally:
+            for future in pending:
+                future.cancel()
+
+    @staticmethod
+    def split_segments(src, size):
+        """Yield (index, final, data) for consecutive reads of size bytes from src.
+
+        Always yields at least one segment, and reads one segment ahead so the
+        last one can be flagged as final.
+        """
+        index = 0
+        current = src.read(size)
+        while True:
+            following = src.read(size) if len(current) == size else b''
+            final = not following
+            yield index, final, current
+            if final:
+                return
+            current = following
+            index += 1
+
+    def new_header(self, flags=0, segment_size=None):
+        """Return a fresh container header and the segment key for it"""
+        salt = os.urandom(SALT_SIZE)
+        segment_size = segment_size or self.segment_size
+        if self.key_ring is None:
+            header = struct.pack(HEADER_FORMAT, MAGIC, DIRECT_KEY_VERSION, flags, segment_size, salt)
+            return header, self.derive_key(salt)
+        header = struct.pack(HEADER_FORMAT, MAGIC, ENVELOPE_VERSION, flags, segment_size, salt)
+        data_key = os.urandom(DATA_KEY_SIZE)
+        return header + self.key_ring.wrap(data_key, header), self.derive_key(salt, data_key)
+
+    def encrypt_stream(self, src, dst, progress=None, flags=0, compress=False):
+        """Encrypt the readable binary stream src into dst one segment at a time.
+
+        progress, if given, is called with the running plaintext byte count
+        after each segment. flags are stored in the header. With compress=True
+        the stream is zlib-compressed before it is encrypted and FLAG_ZLIB is
+        set. Returns the number of plaintext bytes read from src.
+        """
+        if compress:
+            src = CompressingReader(src)
+            flags |= FLAG_ZLIB
+        header, key = self.new_header(flags)
+        dst.write(header)
+
+        total = 0
+        for sealed in self.map_segments(seal_segment, key, header,
+                                        self.split_segments(src, self.segment_size)):
+            dst.write(sealed)
+            total += len(sealed) - TAG_SIZE
+            if progress:
+                progress(src.consumed if compress else total)
+        return src.consumed if compress else total
+
+    def read_header(self, src):
+        header = src.read(HEADER_SIZE)
+        if len(header) != HEADER_SIZE:
+            raise ContainerError("Truncated container header")
+        magic, version, flags, segment_size, salt = struct.unpack(HEADER_FORMAT, header)
+        if magic != MAGIC:
+            raise ContainerError("Not a chunked container")
+        if version not in (DIRECT_KEY_VERSION, ENVELOPE_VERSION):
+            raise ContainerError(f"Unsupported container version: {version}")
+        if not 0 < segment_size <= MAX_SEGMENT_SIZE:
+            raise ContainerError(f"Invalid segment size: {segment_size}")
+        if version == DIRECT_KEY_VERSION:
+            return header, segment_size, self.derive_key(salt)
+
+        wrapped = src.read(WRAPPED_KEY_SIZE)
+        if len(wrapped) != WRAPPED_KEY_SIZE:
+            raise ContainerError("Truncated container header")
+        if self.key_ring is None:
+            raise ContainerError("Container needs a key ring to decrypt")
+        try:
+            data_key = self.key_ring.unwrap(wrapped, header)
+        except KeyRingError as e:
+            raise ContainerError(str(e))
+        return header + wrapped, segment_size, self.derive_key(salt, data_key)
+
+    def iter_decrypt(self, src):
+        """Yield verified plaintext from the container stream src, decompressing it if needed"""
+        header, segment_size, key = self.read_header(src)
+        segments = self.map_segments(open_segment, key, header,
+                                     self.split_sealed(src, segment_size + TAG_SIZE))
+        if header_flags(header) & FLAG_ZLIB:
+            segments = self.decompress(segments, segment_size)
+        for segment in segments:
+            yield segment
+
+    @staticmethod
+    def decompress(segments, segment_size):
+        try:
+            yield from iter_decompressed(segments, segment_size)
+        except ValueError as e:
+            raise ContainerError(str(e))
+
+    def split_sealed(self, src, sealed_size):
+        for index, final, data in self.split_segments(src, sealed_size):
+            if len(data) < TAG_SIZE:
+                raise ContainerError("Truncated container segment")
+            yield index, final, data
+
+    def plaintext_size(self, src):
+        """Return the plaintext size of the seekable container stream src without decrypting it"""
+        src.seek(0)
+        header, segment_size, key = self.read_header(src)
+        count, size = self.layout(src, segment_size, len(header))
+        if not header_flags(header) & FLAG_ZLIB:
+            return size
+        # The uncompressed length is the trailer at the very end of the stream
+        trailer = b''
+        for index in range(count - 1, max(count - 3, -1), -1):
+            trailer = self.read_segment(src, header, key, segment_size, index, count) + trailer
+            if len(trailer) >= TRAILER_SIZE:
+                return struct.unpack(TRAILER_FORMAT, trailer[-TRAILER_SIZE:])[0]
+        raise ContainerError("Truncated compressed container")
+
+    @staticmethod
+    def read_segment(src, header, key, segment_size, index, count):
+        sealed_size = segment_size + TAG_SIZE
+        src.seek(len(header) + index * sealed_size)
+        return open_segment(key, header, index, index == count - 1, src.read(sealed_size))
+
+    @staticmethod
+    def layout(src, segment_size, header_size=HEADER_SIZE):
+        """Return (segment count, plaintext size) for a seekable container stream"""
+        body = src.seek(0, os.SEEK_END) - header_size
+        sealed_size = segment_size + TAG_SIZE
+        count = max(1, -(-body // sealed_size))
+        if body < count * TAG_SIZE:
+            raise ContainerError("Truncated container segment")
+        return count, body - count * TAG_SIZE
+
+    def iter_range(self, src, offset, length):
+        """Yield the verified plaintext of bytes [offset, offset + length) of src.
+
+        Only the segments covering the range are read and decrypted, so the
+        cost depends on the size of the range rather than the size of the file.
+        Compressed containers can't be entered mid-stream, so for those the
+        plaintext before the range is decompressed and skipped. src must be
+        seekable.
+        """
+        if offset < 0 or length < 0:
+            raise ValueError("offset and length must not be negative")
+        src.seek(0)
+        header, segment_size, key = self.read_header(src)
+        if header_flags(header) & FLAG_ZLIB:
+            src.seek(0)
+            yield from self.skip_range(self.iter_decrypt(src), offset, length)
+            return
+        count, size = self.layout(src, segment_size, len(header))
+        end = min(offset + length, size)
+        if offset >= end:
+            return
+
+        sealed_size = segment_size + TAG_SIZE
+        first = offset // segment_size
+        last = (end - 1) // segment_size
+
+        def segments():
+            for index in range(first, last + 1):
+                src.seek(len(header) + index * sealed_size)
+                yield index, index == count - 1, src.read(sealed_size)
+
+        for index, plaintext in zip(range(first, last + 1),
+                                    self.map_segments(open_segment, key, header, segments())):
+            start = index * segment_size
+            yield plaintext[max(offset - start, 0):end - start]
+
+    @staticmethod
+    def skip_range(chunks, offset, length):
+        position = 0
+        end = offset + length
+        for chunk in chunks:
+            if position >= end:
+                return
+            if position + len(chunk) > offset:
+                yield chunk[max(offset - position, 0):end - position]
+            position += len(chunk)
+
+    def decrypt_range(self, src, offset, length):
+        """Return the plaintext of bytes [offset, offset + length) of the container stream src"""
+        return b''.join(self.iter_range(src, offset, length))
+
+    def decrypt_stream(self, src, dst, progress=None):
+        """Decrypt the container stream src into dst. Returns plaintext bytes written.
+
+        progress, if given, is called with the running plaintext byte count
+        after each segment.
+        """
+        total = 0
+        for segment in self.iter_decrypt(src):
+            dst.write(segment)
+            total += len(segment)
+            if progress:
+                progress(total)
+        return total
+
+    def key_version(self, file_path):
+        """Return the key version a container's data key is wrapped under, or None if it has none"""
+        with open(file_path, 'rb') as f:
+            header = f.read(HEADER_SIZE)
+            if len(header) != HEADER_SIZE or not header.startswith(MAGIC) or \
+                    struct.unpack(HEADER_FORMAT, header)[1] != ENVELOPE_VERSION:
+                return None
+            wrapped = f.read(WRAPPED_KEY_SIZE)
+        if len(wrapped) != WRAPPED_KEY_SIZE:
+            raise ContainerError("Truncated container header")
+        return self.key_ring.wrapped_version(wrapped)
+
+    def rewrap(self, file_path, journal_path):
+        """Rewrap a container's data key under the current key version.
+
+        Only the wrapped key field in the header is rewritten; the data is
+        untouched. The old field is journaled first, so if the write is
+        interrupted recover_rewrap() can put it back. Returns True if the
+        file was rewrapped.
+        """
+        version = self.key_version(file_path)
+        if version is None or version == self.key_ring.current_version:
+            return False
+        with open(file_path, 'r+b') as f:
+            header = f.read(HEADER_SIZE)
+            wrapped = f.read(WRAPPED_KEY_SIZE)
+            try:
+                data_key = self.key_ring.unwrap(wrapped, header)
+            except KeyRingError as e:
+                raise ContainerError(str(e))
+            rewrapped = self.key_ring.wrap(data_key, header)
+
+            with open(journal_path, 'w') as journal:
+                json.dump({'path': file_path, 'wrapped': wrapped.hex()}, journal)
+                journal.flush()
+                os.fsync(journal.fileno())
+            f.seek(HEADER_SIZE)
+            f.write(rewrapped)
+            f.flush()
+            os.fsync(f.fileno())
+        os.remove(journal_path)
+        return True
+
+    def upgrade(self, file_path, partial_path):
+        """Re-encrypt a version 1 container as version 2 under a fresh data key.
+
+        Version 1 segments are keyed from the user's original key, which a
+        rewrap can't change, so every segment is opened and sealed again, one
+        for one and still compressed if it was. The new container is written
+        to partial_path and then moved over the file, unless the file was
+        replaced in the meantime. Returns True if the file was upgraded.
+        """
+        if container_version(file_path) != DIRECT_KEY_VERSION:
+            return False
+        if self.key_ring is None:
+            raise ContainerError("Upgrading a container needs a key ring")
+        try:
+            with open(file_path, 'rb') as src, open(partial_path, 'wb') as dst:
+                before = os.fstat(src.fileno())
+                header, segment_size, key = self.read_header(src)
+                new_header, new_key = self.new_header(header_flags(header), segment_size)
+                dst.write(new_header)
+                for sealed in self.map_segments(reseal_segment, (key, new_key), (header, new_header),
+                                                self.split_sealed(src, segment_size + TAG_SIZE)):
+                    dst.write(sealed)
+                dst.flush()
+                os.fsync(dst.fileno())
+            after = os.stat(file_path)
+            if (after.st_ino, after.st_mtime_ns) != (before.st_ino, before.st_mtime_ns):
+                return False  # Uploaded again while this ran; the new file is already version 2
+            os.replace(partial_path, file_path)
+            return True
+        finally:
+            if os.path.exists(partial_path):
+                os.remove(partial_path)
+
+    @staticmethod
+    def recover_rewrap(journal_path):
+        """Undo a rewrap interrupted part way through, if there was one.
+
+        The journaled field is wrapped under a key version the ring still
+        has, so putting it back always leaves a readable file.
+        """
+        if not os.path.exists(journal_path):
+            return False
+        with open(journal_path) as journal:
+            try:
+                entry = json.load(journal)
+            except ValueError:
+                # Crashed while writing the journal, before touching the file
+                entry = None
+        if entry and os.path.exists(entry['path']):
+            with open(entry['path'], 'r+b') as f:
+                f.seek(HEADER_SIZE)
+                f.write(bytes.fromhex(entry['wrapped']))
+                f.flush()
+                os.fsync(f.fileno())
+        os.remove(journal_path)
+        return True
+
+    @staticmethod
+    def container_size(size, segment_size, header_size=HEADER_SIZE):
+        """Return the size of a container holding size bytes of uncompressed plaintext"""
+        count = max(1, -(-size // segment_size))
+        return header_size + size + count * TAG_SIZE
+
+
+class ContainerWriter:
+    """Encrypts into a container as data is written to it.
+
+    The counterpart of encrypt_stream() for data that is pushed rather than
+    read, such as an upload being parsed. Writes are collected until they
+    add up to more than a segment and then joined once, so at most about one
+    segment is buffered. finish() seals the last segment; dst is left open.
+    """
+
+    def __init__(self, cipher, dst, flags=0):
+        self.dst = dst
+        self.segment_size = cipher.segment_size
+        self.header, self.key = cipher.new_header(flags)
+        self.pieces = []
+        self.pending = 0
+        self.index = 0
+        self.written = 0
+        dst.write(self.header)
+
+    def write(self, data):
+        self.pieces.append(data)
+        self.pending += len(data)
+        self.written += len(data)
+        # A full segment is only sealed once a byte after it arrives, since
+        # the last segment has to be marked as final
+        if self.pending > self.segment_size:
+            buffered = b''.join(self.pieces)
+            view = memoryview(buffered)
+            start = 0
+            while len(buffered) - start > self.segment_size:
+                self.seal(view[start:start + self.segment_size], final=False)
+                start += self.segment_size
+            self.pieces = [buffered[start:]]
+            self.pending = len(buffered) - start
+        return len(data)
+
+    def seal(self, data, final):
+        self.dst.write(seal_segment(self.key, self.header, self.index, final, data))
+        self.index += 1
+
+    def finish(self):
+        """Seal the last segment. Returns the number of plaintext bytes written"""
+        self.seal(b''.join(self.pieces), final=True)
+        self.pieces = []
+        self.pending = 0
+        return self.written
+
+
+class DecryptingReader(io.RawIOBase):
+    """Seekable, read-only file over the plaintext of an uncompressed container.
+
+    Only the segment under the read position is decrypted and held in
+    memory, so the reader can be handed to anything that expects a file,
+    such as a WSGI file wrapper answering Range requests. src is closed
+    with the reader.
+    """
+
+    def __init__(self, cipher, src):
+        super().__init__()
+        self.src = src
+        self.header, self.segment_size, self.key = cipher.read_header(src)
+        if header_flags(self.header) & FLAG_ZLIB:
+            raise ContainerError("Compressed containers can't be read at random")
+        self.count, self.size = cipher.layout(src, self.segment_size, len(self.header))
+        self.position = 0
+        self.segment_index = None
+        self.segment = b''
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def seek(self, offset, whence=os.SEEK_SET):
+        if whence == os.SEEK_CUR:
+            offset += self.position
+        elif whence == os.SEEK_END:
+            offset += self.size
+        if offset < 0:
+            raise ValueError("Negative seek position")
+        self.position = offset
+        return offset
+
+    def tell(self):
+        return self.position
+
+    def readinto(self, buffer):
+        if self.position >= self.size:
+            return 0
+        index = self.position // self.segment_size
+        if index != self.segment_index:
+            self.segment = ChunkedCipher.read_segment(self.src, self.header, self.key,
+                                                      self.segment_size, index, self.count)
+            self.segment_index = index
+        start = self.position - index * self.segment_size
+        length = min(len(buffer), len(self.segment) - start)
+        buffer[:length] = self.segment[start:start + length]
+        self.position += length
+        return length
+
+    def close(self):
+        if not self.closed:
+            self.src.close()
+        super().close()
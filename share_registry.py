@@ -0,0 +1,257 @@
+import sqlite3
+import threading
+import hashlib
+import os
+import re
+import time
+from collections import OrderedDict
+from datetime import datetime
+from database import ThreadConnections
+
+SCHEMA_VERSION = 5
+FILE_ID_PREFIX = re.compile(r'^\d{8}_\d{6}_(?:[0-9a-f]{32}_)?')
+
+
+class LRUCache:
+    """Small thread-safe LRU cache whose entries expire after ttl seconds.
+
+    The TTL bounds how long another worker process's delete can go unnoticed,
+    since each process keeps its own cache.
+    """
+
+    def __init__(self, max_size=1024, ttl=30):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return None
+            value, stored_at = entry
+            if time.monotonic() - stored_at > self.ttl:
+                del self.entries[key]
+                return None
+            self.entries.move_to_end(key)
+            return value
+
+    def put(self, key, value):
+        with self.lock:
+            self.entries[key] = (value, time.monotonic())
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+
+    def discard(self, key):
+        with self.lock:
+            self.entries.pop(key, None)
+
+
+class ShareRegistry:
+    """Persistent record of shared files, stored in SQLite.
+
+    Every thread gets its own connection and the database runs in WAL mode,
+    so lookups from any number of threads or worker processes never block
+    each other or the writer. Hot lookups are answered from an LRU cache.
+    Functions in listeners are called with the file_id of every share that
+    is added or deleted, so caches built on top can drop stale entries.
+    """
+
+    def __init__(self, db_path, upload_folder, cache_size=1024, cache_ttl=30):
+        self.db_path = db_path
+        self.upload_folder = upload_folder
+        self.connections = ThreadConnections(db_path, row_factory=sqlite3.Row)
+        self.cache = LRUCache(cache_size, cache_ttl)
+        self.listeners = []
+        self.migrate()
+
+    @property
+    def connection(self):
+        return self.connections.get()
+
+    def migrate(self):
+        """Create the schema and, on first start, rebuild entries from the upload folder"""
+        connection = self.connection
+        connection.execute('BEGIN IMMEDIATE')
+        try:
+            version = connection.execute('PRAGMA user_version').fetchone()[0]
+            if version < 1:
+                connection.execute('''
+                    CREATE TABLE IF NOT EXISTS shares (
+                        file_id TEXT PRIMARY KEY,
+                        filename TEXT NOT NULL,
+                        username TEXT NOT NULL,
+                        password TEXT,
+                        timestamp TEXT NOT NULL,
+                        size INTEGER NOT NULL,
+                        etag TEXT NOT NULL,
+                        expires_at REAL
+                    )
+                ''')
+                connection.execute('CREATE INDEX IF NOT EXISTS idx_shares_username ON shares (username)')
+                connection.execute('CREATE INDEX IF NOT EXISTS idx_shares_expires_at ON shares (expires_at)')
+                self.rebuild_from_disk(connection)
+            if version < 2:
+                self.hash_passwords(connection)
+            if version < 3:
+                connection.execute('ALTER TABLE shares ADD COLUMN max_downloads INTEGER')
+                connection.execute('ALTER TABLE shares ADD COLUMN downloads INTEGER NOT NULL DEFAULT 0')
+            if version < 4:
+                # Client address the share counts against for quotas; NULL for older shares
+                connection.execute('ALTER TABLE shares ADD COLUMN owner TEXT')
+                connection.execute('CREATE INDEX IF NOT EXISTS idx_shares_owner ON shares (owner)')
+            if version < 5:
+                # Download links already counted against their share's limit
+                connection.execute('''
+                    CREATE TABLE IF NOT EXISTS download_grants (
+                        grant_id TEXT PRIMARY KEY,
+                        file_id TEXT NOT NULL,
+                        expires_at REAL NOT NULL
+                    )
+                ''')
+                connection.execute('CREATE INDEX IF NOT EXISTS idx_download_grants_expires_at '
+                                   'ON download_grants (expires_at)')
+            connection.execute(f'PRAGMA user_version = {SCHEMA_VERSION}')
+            connection.execute('COMMIT')
+        except Exception:
+            connection.execute('ROLLBACK')
+            raise
+
+    def rebuild_from_disk(self, connection):
+        """Register files left in the upload folder by the old in-memory registry.
+
+        Their passwords were never persisted, so they are registered without
+        one and stay locked until the owner shares them again.
+        """
+        if not os.path.isdir(self.upload_folder):
+            return
+        for entry in os.scandir(self.upload_folder):
+            if not entry.is_file() or entry.name.startswith('.'):
+                continue
+            digest = hashlib.sha256()
+            with open(entry.path, 'rb') as f:
+                for chunk in iter(lambda: f.read(1024 * 1024), b''):
+                    digest.update(chunk)
+            stat = entry.stat()
+            connection.execute(
+                'INSERT OR IGNORE INTO shares (file_id, filename, username, password, timestamp, size, etag) '
+                'VALUES (?, ?, ?, NULL, ?, ?, ?)',
+                (entry.name,
+                 FILE_ID_PREFIX.sub('', entry.name),
+                 'unknown',
+                 datetime.fromtimestamp(stat.st_mtime).isoformat(),
+                 stat.st_size,
+                 digest.hexdigest()))
+
+    def hash_passwords(self, connection):
+        """Replace plaintext share passwords with unsalted SHA-256 hashes.
+
+        That is the legacy format PasswordHasher.verify() accepts, so each
+        share moves on to bcrypt the next time its password is entered.
+        """
+        rows = connection.execute('SELECT file_id, password FROM shares '
+                                  'WHERE password IS NOT NULL').fetchall()
+        for row in rows:
+            connection.execute('UPDATE shares SET password = ? WHERE file_id = ?',
+                               (hashlib.sha256(row['password'].encode()).hexdigest(), row['file_id']))
+
+    def add(self, file_id, info):
+        """Register a new share. Raises sqlite3.IntegrityError if file_id is already taken"""
+        self.connection.execute(
+            'INSERT INTO shares '
+            '(file_id, filename, username, owner, password, timestamp, size, etag, expires_at, '
+            'max_downloads) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+            (file_id, info['filename'], info['username'], info.get('owner'), info['password'],
+             info['timestamp'], info['size'], info['etag'], info.get('expires_at'),
+             info.get('max_downloads')))
+        self.invalidate(file_id)
+
+    def get(self, file_id):
+        """Return the share's details, or None if it doesn't exist or has expired"""
+        info = self.cache.get(file_id)
+        if info is None:
+            row = self.connection.execute('SELECT * FROM shares WHERE file_id = ?',
+                                          (file_id,)).fetchone()
+            if row is None:
+                return None
+            info = dict(row)
+            self.cache.put(file_id, info)
+        if info['expires_at'] is not None and info['expires_at'] <= time.time():
+            return None
+        return info
+
+    def set_password(self, file_id, password_hash):
+        self.connection.execute('UPDATE shares SET password = ? WHERE file_id = ?',
+                                (password_hash, file_id))
+        self.cache.discard(file_id)
+
+    def record_download(self, file_id, grant_id, grace):
+        """Count a download link against the share's limit. Returns False if none are left.
+
+        grant_id identifies the link. It is counted the first time it is
+        used and let through after that, so resuming a download or fetching
+        it in ranges costs one download rather than one per request. Links
+        are remembered for grace seconds, as long as they stay valid, and
+        when the last download is used the share expires grace seconds later
+        so the file isn't swept while that link can still fetch it.
+        """
+        ends = time.time() + grace
+        connection = self.connection
+        connection.execute('BEGIN IMMEDIATE')
+        try:
+            counted = connection.execute('SELECT 1 FROM download_grants WHERE grant_id = ?',
+                                         (grant_id,)).fetchone() is not None
+            if not counted:
+                counted = connection.execute(
+                    'UPDATE shares SET downloads = downloads + 1, '
+                    'expires_at = CASE WHEN downloads + 1 >= max_downloads '
+                    'THEN MIN(COALESCE(expires_at, ?), ?) ELSE expires_at END '
+                    'WHERE file_id = ? AND (max_downloads IS NULL OR downloads < max_downloads)',
+                    (ends, ends, file_id)).rowcount == 1
+                if counted:
+                    connection.execute('INSERT INTO download_grants (grant_id, file_id, expires_at) '
+                                       'VALUES (?, ?, ?)', (grant_id, file_id, ends))
+            connection.execute('COMMIT')
+        except Exception:
+            connection.execute('ROLLBACK')
+            raise
+        self.invalidate(file_id)
+        return counted
+
+    def expire_grants(self, now):
+        """Forget download links that expired before now. Returns how many there were"""
+        return self.connection.execute('DELETE FROM download_grants WHERE expires_at <= ?',
+                                       (now,)).rowcount
+
+    def usage(self, owner):
+        """Bytes taken up by owner's shares that haven't expired"""
+        return self.connection.execute(
+            'SELECT COALESCE(SUM(size), 0) FROM shares WHERE owner = ? '
+            'AND (expires_at IS NULL OR expires_at > ?)', (owner, time.time())).fetchone()[0]
+
+    def expired(self, now, limit):
+        """Return up to limit file_ids of shares that expired before now, oldest first"""
+        return [row['file_id'] for row in self.connection.execute(
+            'SELECT file_id FROM shares WHERE expires_at <= ? ORDER BY expires_at LIMIT ?',
+            (now, limit))]
+
+    def delete(self, file_id):
+        self.connection.execute('DELETE FROM shares WHERE file_id = ?', (file_id,))
+        self.invalidate(file_id)
+
+    def delete_expired(self, file_id, now):
+        """Delete a share if it expired before now. Returns False if it hadn't"""
+        deleted = self.connection.execute('DELETE FROM shares WHERE file_id = ? AND expires_at <= ?',
+                                          (file_id, now)).rowcount == 1
+        self.invalidate(file_id)
+        return deleted
+
+    def invalidate(self, file_id):
+        self.cache.discard(file_id)
+        for listener in self.listeners:
+            listener(file_id)
+
+    def __contains__(self, file_id):
+        return self.get(file_id) is not None
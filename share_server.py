@@ -1,127 +1,708 @@
-from flask import Flask, request, send_file, jsonify, render_template_string, render_template
+from flask import Flask, request, send_file, jsonify, render_template_string, render_template, redirect, url_for, Response
 from flask_cors import CORS
 import os
 import uuid
 from datetime import datetime, timedelta
 from werkzeug.utils import secure_filename
+from werkzeug.http import parse_options_header
+from werkzeug.sansio.multipart import MultipartDecoder, Field, File, Data, Epilogue, NeedData
+from werkzeug.exceptions import RequestEntityTooLarge
+from werkzeug.wsgi import wrap_file
 import ssl
 from cryptography.fernet import Fernet
+from cryptography.hazmat.primitives import hashes
+from cryptography.hazmat.primitives.kdf.hkdf import HKDF
 import base64
 import tempfile
+import hashlib
+import hmac
+import time
+import sys
+import socket
+import argparse
+import subprocess
+import mimetypes
+import math
+import sqlite3
+from share_registry import ShareRegistry, LRUCache
+from upload_sessions import UploadSessions
+from rate_limiter import RateLimiter
+from password_hasher import PasswordHasher
+from share_sweeper import ShareSweeper
+from secure_container import ChunkedCipher, ContainerWriter, DecryptingReader, is_container, seal_segment, TAG_SIZE
+import wsgi_server
+from metrics import Metrics, MetricsMiddleware
 
 app = Flask(__name__)
 CORS(app)
 
 # Configuration
 UPLOAD_FOLDER = 'shared_files'
+REGISTRY_DB = 'share_registry.db'
+UPLOAD_SESSIONS_DB = 'upload_sessions.db'
+METRICS_DIR = 'server_metrics'  # Each worker process publishes its metrics here
+RATE_LIMIT_DIR = 'rate_limits'  # Token buckets shared by the worker processes
 ALLOWED_EXTENSIONS = {'txt', 'pdf', 'png', 'jpg', 'jpeg', 'doc', 'docx', 'zip'}
 MAX_FILE_SIZE = 50 * 1024 * 1024  # 50MB limit
+MAX_FORM_FIELD_SIZE = 64 * 1024  # Limit for the username/password form fields
+INGEST_CHUNK_SIZE = 64 * 1024  # Request body is read and written in chunks of this size
+DOWNLOAD_TOKEN_TTL = 10 * 60  # Seconds a download link can be used to start or resume a download
+DEFAULT_SHARE_TTL = 7 * 24 * 60 * 60  # Seconds a share lasts unless the sharer asks otherwise
+MAX_SHARE_TTL = 30 * 24 * 60 * 60
+# Bytes of live shares and uploads in progress per client address. The
+# username in an upload is whatever the client says it is, so it only labels
+# the share; clients behind one NAT or proxy address share a quota.
+CLIENT_QUOTA = 1024 * 1024 * 1024
+PORTS = [5000, 8081, 8082, 5001]  # Tried in order until one is free
+VIEW_CACHE_SIZE = 4096  # Rendered share pages kept per worker
+VIEW_CACHE_TTL = 30  # Seconds another worker's delete can go unnoticed by this one's cache
+# Password attempts on /download: a burst, then a steady rate per second
+ATTEMPT_BURST_PER_IP = 10
+ATTEMPT_RATE_PER_IP = 10 / 60
+ATTEMPT_BURST_PER_SHARE = 20
+ATTEMPT_RATE_PER_SHARE = 20 / 60
+
+# Reject bodies that can't possibly fit before reading any of them
+app.config['MAX_CONTENT_LENGTH'] = MAX_FILE_SIZE + MAX_FORM_FIELD_SIZE
+
+# Count and time every request except scrapes of the metrics themselves
+metrics = Metrics(METRICS_DIR)
+app.wsgi_app = MetricsMiddleware(app.wsgi_app, app, metrics, skip=('metrics_endpoint',))
 
 # Create upload folder if it doesn't exist
 os.makedirs(UPLOAD_FOLDER, exist_ok=True)
 
-# Store shared file information
-shared_files = {}
+# Store shared file information (persisted in SQLite so links survive restarts)
+shared_files = ShareRegistry(REGISTRY_DB, UPLOAD_FOLDER)
+# Rendered /view pages. A page never changes once its share exists, so
+# entries only go when the share is replaced, deleted or expires.
+view_pages = LRUCache(VIEW_CACHE_SIZE, VIEW_CACHE_TTL)
+shared_files.listeners.append(view_pages.discard)
+
+# Resumable uploads in progress
+upload_sessions = UploadSessions(UPLOAD_SESSIONS_DB, UPLOAD_FOLDER)
+
+# Share passwords are stored as bcrypt hashes, which are slow to check on
+# purpose, so guesses are throttled per client and per share before that
+password_hasher = PasswordHasher()
+attempts_per_ip = RateLimiter(os.path.join(RATE_LIMIT_DIR, 'download_ip.bin'),
+                              rate=ATTEMPT_RATE_PER_IP, burst=ATTEMPT_BURST_PER_IP)
+attempts_per_share = RateLimiter(os.path.join(RATE_LIMIT_DIR, 'download_share.bin'),
+                                 rate=ATTEMPT_RATE_PER_SHARE, burst=ATTEMPT_BURST_PER_SHARE)
+
+# Deletes expired shares; started by the main process only (see __main__)
+sweeper = ShareSweeper(shared_files, upload_sessions)
+
+SERVER_KEY_FILE = 'server_key.key'  # Per-install secret; never commit it (see .gitignore)
 
-# Create a Fernet key for encryption/decryption
 def get_or_create_key():
-    key_file = 'server_key.key'
-    if os.path.exists(key_file):
-        with open(key_file, 'rb') as f:
-            return f.read()
-    else:
-        key = Fernet.generate_key()
-        with open(key_file, 'wb') as f:
-            f.write(key)
-        return key
+    """Return this install's server secret, generating it on first start"""
+    try:
+        fd = os.open(SERVER_KEY_FILE, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+    except FileExistsError:
+        with open(SERVER_KEY_FILE, 'rb') as f:
+            return base64.urlsafe_b64decode(f.read())
+    key = Fernet.generate_key()
+    with os.fdopen(fd, 'wb') as f:
+        f.write(key)
+    return base64.urlsafe_b64decode(key)
+
+def key_is_tracked():
+    """Return True if the server key is committed to a git repository"""
+    folder, name = os.path.split(os.path.abspath(SERVER_KEY_FILE))
+    try:
+        result = subprocess.run(['git', 'ls-files', '--error-unmatch', name], cwd=folder,
+                                stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    except OSError:
+        return False
+    return result.returncode == 0
+
+def derive_subkey(info):
+    """Derive a key for one purpose from the server secret, so no two purposes share a key"""
+    return HKDF(algorithm=hashes.SHA256(), length=32, salt=None, info=info).derive(server_key)
 
-# Initialize Fernet cipher
-cipher = Fernet(get_or_create_key())
+# Download tokens are signed and shared files are stored encrypted under
+# separate subkeys of the server secret. Segments are the size of an upload
+# session chunk, so each chunk is sealed as one segment.
+server_key = get_or_create_key()
+token_key = derive_subkey(b'protector-share-download-token')
+cipher = ChunkedCipher(base64.urlsafe_b64encode(derive_subkey(b'protector-share-storage')),
+                       segment_size=upload_sessions.chunk_size)
 
 def allowed_file(filename):
     return '.' in filename and filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS
 
+class UploadRejected(Exception):
+    def __init__(self, message, status=400):
+        super().__init__(message)
+        self.status = status
+
+def ingest_upload(stream, boundary):
+    """Stream a multipart upload straight to a temporary file in UPLOAD_FOLDER.
+
+    The body is read in INGEST_CHUNK_SIZE pieces, so a worker never holds
+    more than one chunk of the file in memory. The filename is checked
+    against ALLOWED_EXTENSIONS as soon as the file part's headers arrive,
+    before any of its contents are read, and reading stops as soon as the
+    file grows past MAX_FILE_SIZE.
+
+    The file is encrypted into a container as it arrives, one segment at a
+    time, so plaintext never reaches the disk.
+
+    Returns (fields, filename, temp_path, size, etag). The temporary file has
+    been fsynced and is ready to be renamed into place. The ETag is a digest
+    of the contents computed while streaming, so it costs no extra pass.
+    """
+    # The decoder applies its limit to everything it has buffered, including
+    # the chunk just read, so field sizes are checked below instead
+    decoder = MultipartDecoder(boundary, max_form_memory_size=INGEST_CHUNK_SIZE + MAX_FORM_FIELD_SIZE)
+    fields = {}
+    filename = None
+    temp_path = None
+    output = None
+    writer = None
+    size = 0
+    digest = hashlib.sha256()
+    current_part = None
+    field_data = []
+
+    try:
+        while True:
+            chunk = stream.read(INGEST_CHUNK_SIZE)
+            decoder.receive_data(chunk or None)
+            event = decoder.next_event()
+            while not isinstance(event, (Epilogue, NeedData)):
+                if isinstance(event, Field):
+                    current_part = event
+                    field_data = []
+                elif isinstance(event, File):
+                    if event.name != 'file' or output is not None:
+                        raise UploadRejected('Unexpected file field')
+                    filename = secure_filename(event.filename)
+                    if not filename:
+                        raise UploadRejected('No file selected')
+                    if not allowed_file(filename):
+                        raise UploadRejected('File type not allowed', 415)
+                    current_part = event
+                    fd, temp_path = tempfile.mkstemp(dir=UPLOAD_FOLDER, prefix='.upload_')
+                    output = os.fdopen(fd, 'wb')
+                    writer = ContainerWriter(cipher, output)
+                elif isinstance(event, Data):
+                    if isinstance(current_part, File):
+                        size += len(event.data)
+                        if size > MAX_FILE_SIZE:
+                            raise UploadRejected('File too large', 413)
+                        writer.write(event.data)
+                        digest.update(event.data)
+                    else:
+                        field_data.append(event.data)
+                        if sum(map(len, field_data)) > MAX_FORM_FIELD_SIZE:
+                            raise UploadRejected('Form field too large', 413)
+                        if not event.more_data:
+                            fields[current_part.name] = b''.join(field_data).decode('utf-8', 'replace')
+                event = decoder.next_event()
+            if isinstance(event, Epilogue) or not chunk:
+                break
+
+        if output is None:
+            raise UploadRejected('No file provided')
+        writer.finish()
+        output.flush()
+        os.fsync(output.fileno())
+        output.close()
+        return fields, filename, temp_path, size, digest.hexdigest()
+    except ValueError as e:
+        # Raised by the decoder for malformed or truncated bodies
+        raise UploadRejected(f'Malformed upload: {e}')
+    except RequestEntityTooLarge:
+        raise UploadRejected('Form field too large', 413)
+    finally:
+        if output is not None and not output.closed:
+            output.close()
+            os.remove(temp_path)
+
+def parse_share_limits(expires_in, max_downloads):
+    """Validate the lifetime and download limit asked for a share.
+
+    Returns (expires_in, max_downloads), with the default lifetime filled in
+    and max_downloads None for unlimited. Raises UploadRejected if either is
+    invalid.
+    """
+    try:
+        expires_in = DEFAULT_SHARE_TTL if expires_in in (None, '') else int(expires_in)
+        max_downloads = None if max_downloads in (None, '') else int(max_downloads)
+    except (TypeError, ValueError):
+        raise UploadRejected('expires_in and max_downloads must be whole numbers')
+    if not 0 < expires_in <= MAX_SHARE_TTL:
+        raise UploadRejected(f'expires_in must be between 1 and {MAX_SHARE_TTL} seconds')
+    if max_downloads is not None and max_downloads < 1:
+        raise UploadRejected('max_downloads must be at least 1')
+    return expires_in, max_downloads
+
+def new_file_id(filename):
+    """Name a new share: its upload time for readability, then a random part so ids never collide"""
+    return f"{datetime.now().strftime('%Y%m%d_%H%M%S')}_{uuid.uuid4().hex}_{filename}"
+
+def client_address():
+    """The address quotas are charged to, as seen by the server rather than claimed by the client"""
+    return request.remote_addr or 'unknown'
+
+def over_quota(owner, size):
+    return shared_files.usage(owner) + upload_sessions.reserved(owner) + size > CLIENT_QUOTA
+
 @app.route('/share', methods=['POST'])
 def share_file():
-    if 'file' not in request.files:
+    mimetype, options = parse_options_header(request.headers.get('Content-Type', ''))
+    if mimetype != 'multipart/form-data' or 'boundary' not in options:
         return jsonify({'error': 'No file provided'}), 400
     
-    file = request.files['file']
-    username = request.form.get('username', 'anonymous')
-    password = request.form.get('password', '')
-    
-    if file.filename == '':
-        return jsonify({'error': 'No file selected'}), 400
+    try:
+        fields, filename, temp_path, size, etag = ingest_upload(request.stream,
+                                                          options['boundary'].encode())
+    except UploadRejected as e:
+        return jsonify({'error': str(e)}), e.status
     
-    filename = secure_filename(file.filename)
-    file_id = datetime.now().strftime('%Y%m%d_%H%M%S_') + filename
+    username = fields.get('username', 'anonymous')
+    password = fields.get('password', '')
+    # The fields may follow the file in the body, so these are only known now
+    try:
+        expires_in, max_downloads = parse_share_limits(fields.get('expires_in'),
+                                                       fields.get('max_downloads'))
+    except UploadRejected as e:
+        os.remove(temp_path)
+        return jsonify({'error': str(e)}), e.status
+    owner = client_address()
+    if over_quota(owner, size):
+        os.remove(temp_path)
+        return jsonify({'error': 'Storage quota exceeded'}), 413
+    file_id = new_file_id(filename)
+    expires_at = time.time() + expires_in
     
-    # Save file
+    # Atomically move the finished upload into place
     file_path = os.path.join(UPLOAD_FOLDER, file_id)
-    file.save(file_path)
+    os.replace(temp_path, file_path)
     
     # Store file information
-    shared_files[file_id] = {
+    shared_files.add(file_id, {
         'filename': filename,
-        'password': password,
+        'password': password_hasher.hash(password),
         'username': username,
-        'timestamp': datetime.now().isoformat()
-    }
+        'owner': owner,
+        'timestamp': datetime.now().isoformat(),
+        'size': size,
+        'etag': etag,
+        'expires_at': expires_at,
+        'max_downloads': max_downloads
+    })
     
     # Generate share link
     share_link = f"http://{request.host}/view/{file_id}"
-    return jsonify({'link': share_link})
+    return jsonify({'link': share_link, 'expires_at': expires_at})
 
-@app.route('/view/<file_id>', methods=['GET'])
-def view_file(file_id):
-    if file_id not in shared_files:
-        return "File not found", 404
+def upload_state(session):
+    return {
+        'upload_id': session['upload_id'],
+        'chunk_size': session['chunk_size'],
+        'size': session['size'],
+        'offset': session['received'],
+        'next_chunk': session['next_chunk']
+    }
+
+def seal_session_chunk(session, index, data):
+    """Encrypt chunk index of an upload session into its container.
+
+    Chunks are exactly one segment each, so every chunk has a fixed place in
+    the file and a retried chunk overwrites the earlier attempt.
+    """
+    count = max(1, -(-session['size'] // session['chunk_size']))
+    with open(upload_sessions.data_path(session['upload_id']), 'r+b') as f:
+        header, segment_size, key = cipher.read_header(f)
+        f.seek(len(header) + index * (segment_size + TAG_SIZE))
+        f.write(seal_segment(key, header, index, index == count - 1, data))
+        f.flush()
+        os.fsync(f.fileno())
+
+@app.route('/uploads', methods=['POST'])
+def create_upload():
+    """Start a resumable upload.
+
+    The client then PUTs the file to /uploads/<upload_id>/chunks/<n> in
+    chunk_size pieces, in order, each with its SHA-256 in X-Chunk-Sha256.
+    After a dropped connection, GET /uploads/<upload_id> says which chunk to
+    resume from. POST /uploads/<upload_id>/finalize publishes the share.
+    As with /share, expires_in (seconds) and max_downloads limit its life.
+    """
+    info = request.get_json(silent=True) or {}
+    filename = secure_filename(str(info.get('filename', '')))
+    size = info.get('size')
+    if not filename:
+        return jsonify({'error': 'No file selected'}), 400
+    if not allowed_file(filename):
+        return jsonify({'error': 'File type not allowed'}), 415
+    if not isinstance(size, int) or size < 0:
+        return jsonify({'error': 'Invalid size'}), 400
+    if size > MAX_FILE_SIZE:
+        return jsonify({'error': 'File too large'}), 413
+    try:
+        expires_in, max_downloads = parse_share_limits(info.get('expires_in'), info.get('max_downloads'))
+    except UploadRejected as e:
+        return jsonify({'error': str(e)}), e.status
+    owner = client_address()
+    if over_quota(owner, size):
+        return jsonify({'error': 'Storage quota exceeded'}), 413
+    
+    # Abandoned sessions are cleaned up as new ones start
+    upload_sessions.expire(lambda file_id: file_id in shared_files)
+    session = upload_sessions.create(filename,
+                                     str(info.get('username', 'anonymous')),
+                                     password_hasher.hash(str(info.get('password', ''))),
+                                     size,
+                                     expires_in,
+                                     max_downloads,
+                                     owner)
+    # Start the container; an empty file is complete with its one empty segment
+    with open(upload_sessions.data_path(session['upload_id']), 'wb') as f:
+        writer = ContainerWriter(cipher, f)
+        if size == 0:
+            writer.finish()
+    return jsonify(upload_state(session)), 201
+
+@app.route('/uploads/<upload_id>', methods=['GET'])
+def upload_status(upload_id):
+    session = upload_sessions.get(upload_id)
+    if session is None:
+        return jsonify({'error': 'Upload not found'}), 404
+    return jsonify(upload_state(session))
+
+@app.route('/uploads/<upload_id>/chunks/<int:index>', methods=['PUT'])
+def upload_chunk(upload_id, index):
+    session = upload_sessions.get(upload_id)
+    if session is None:
+        return jsonify({'error': 'Upload not found'}), 404
+    if index < session['next_chunk']:
+        # A retry of a chunk that already arrived
+        return jsonify(upload_state(session))
+    if index > session['next_chunk'] or session['file_id'] is not None:
+        return jsonify(dict(upload_state(session), error='Unexpected chunk')), 409
+    
+    length = upload_sessions.expected_length(session, index)
+    checksum = request.headers.get('X-Chunk-Sha256', '').lower()
+    if request.content_length != length:
+        return jsonify({'error': f'Chunk {index} must be {length} bytes'}), 400
+    
+    # A chunk is sealed as a whole, so it is read into memory (one chunk at
+    # most) and only written once its checksum matches
+    digest = hashlib.sha256()
+    data = bytearray()
+    while len(data) < length:
+        piece = request.stream.read(min(INGEST_CHUNK_SIZE, length - len(data)))
+        if not piece:
+            return jsonify({'error': 'Truncated chunk'}), 400
+        data += piece
+        digest.update(piece)
+    if not hmac.compare_digest(digest.hexdigest(), checksum):
+        return jsonify({'error': 'Checksum mismatch'}), 400
+    
+    seal_session_chunk(session, index, bytes(data))
+    upload_sessions.acknowledge(upload_id, index, length,
+                                upload_sessions.chain_hash(session, digest.digest()))
+    return jsonify(upload_state(upload_sessions.get(upload_id)))
+
+def publish_upload(session, file_id):
+    """Move a claimed upload's container into place and register its share.
+
+    Every step can be repeated, so a finalize that takes over from one that
+    died part way through carries on from wherever it stopped.
+    """
+    data_path = upload_sessions.data_path(session['upload_id'])
+    file_path = os.path.join(UPLOAD_FOLDER, file_id)
+    if os.path.exists(data_path):
+        with open(data_path, 'r+b') as f:
+            # Drop anything past the last segment
+            f.truncate(cipher.container_size(session['size'], session['chunk_size']))
+        os.replace(data_path, file_path)
+    elif not os.path.exists(file_path):
+        return  # Published and swept since
+    try:
+        shared_files.add(file_id, {
+            'filename': session['filename'],
+            'password': session['password'],
+            'username': session['username'],
+            'owner': session['owner'],
+            'timestamp': datetime.now().isoformat(),
+            'size': session['size'],
+            # Built from the chunk checksums as they arrived, so the file isn't read again
+            'etag': session['content_hash'] or hashlib.sha256().hexdigest(),
+            'expires_at': time.time() + (session['expires_in'] or DEFAULT_SHARE_TTL),
+            'max_downloads': session['max_downloads']
+        })
+    except sqlite3.IntegrityError:
+        pass  # Registered after all by the request this one took over from
+
+@app.route('/uploads/<upload_id>/finalize', methods=['POST'])
+def finalize_upload(upload_id):
+    """Publish a complete upload as a share. Repeating it returns the same link.
+
+    While another request is still publishing the same upload the answer is
+    202 with Retry-After, since the link would not work yet. If that request
+    failed or its worker died, a finalize once the claim is older than
+    upload_sessions.finalize_timeout takes over.
+    """
+    session = upload_sessions.get(upload_id)
+    if session is None:
+        return jsonify({'error': 'Upload not found'}), 404
+    if session['file_id'] is None:
+        if session['received'] != session['size']:
+            return jsonify(dict(upload_state(session), error='Upload incomplete')), 409
+        file_id = new_file_id(session['filename'])
+        if upload_sessions.claim(upload_id, file_id):
+            publish_upload(session, file_id)
+        session = upload_sessions.get(upload_id)
+    elif session['file_id'] not in shared_files and \
+            upload_sessions.reclaim(upload_id, session['file_id']):
+        publish_upload(session, session['file_id'])
+    
+    file_id = session['file_id']
+    if file_id in shared_files:
+        return jsonify({'link': f"http://{request.host}/view/{file_id}"})
+    if not os.path.exists(os.path.join(UPLOAD_FOLDER, file_id)) and \
+            not os.path.exists(upload_sessions.data_path(upload_id)):
+        return jsonify({'error': 'Share has expired'}), 410
+    response = jsonify(dict(upload_state(session), status='finalizing'))
+    response.status_code = 202
+    response.headers['Retry-After'] = '1'
+    return response
+
+def render_view_page(file_id):
+    """Render the share page for file_id, or return None if there is no such share"""
+    file_info = shared_files.get(file_id)
+    if file_info is None:
+        return None
     
-    file_info = shared_files[file_id]
     file_path = os.path.join(UPLOAD_FOLDER, file_id)
     
     if not os.path.exists(file_path):
-        return "File not found", 404
+        return None
     
     # Render template with file information
-    return render_template('view_file.html',
-                         filename=file_info['filename'],
-                         username=file_info['username'],
-                         timestamp=file_info['timestamp'],
-                         file_id=file_id)
+    body = render_template('view_file.html',
+                           filename=file_info['filename'],
+                           username=file_info['username'],
+                           timestamp=file_info['timestamp'],
+                           file_id=file_id).encode()
+    return {
+        'body': body,
+        'etag': hashlib.sha256(body).hexdigest(),
+        'expires_at': file_info['expires_at']
+    }
+
+@app.route('/view/<file_id>', methods=['GET'])
+def view_file(file_id):
+    page = view_pages.get(file_id)
+    if page is not None and page['expires_at'] is not None and page['expires_at'] <= time.time():
+        view_pages.discard(file_id)
+        page = None
+    if page is None:
+        page = render_view_page(file_id)
+        if page is None:
+            return "File not found", 404
+        view_pages.put(file_id, page)
+    
+    # no-cache makes browsers revalidate every time, which costs a 304 but
+    # means a deleted share stops showing straight away
+    response = Response(page['body'], mimetype='text/html')
+    response.set_etag(page['etag'])
+    response.cache_control.no_cache = True
+    return response.make_conditional(request)
+
+def make_download_token(file_id, expires=None, grant=None):
+    """Sign a short-lived token that lets GET /download/<file_id> skip the password.
+
+    grant is a random id for the one download the token stands for; it is
+    counted against the share's limit only the first time it is used.
+    """
+    expires = expires or int(time.time()) + DOWNLOAD_TOKEN_TTL
+    grant = grant or uuid.uuid4().hex
+    signature = hmac.new(token_key, f"{file_id}:{expires}:{grant}".encode(), hashlib.sha256).hexdigest()
+    return f"{expires}.{grant}.{signature}"
+
+def check_download_token(file_id, token):
+    """Return the grant of a valid, unexpired token for file_id, or None"""
+    parts = token.split('.')
+    if len(parts) != 3:
+        return None
+    expires, grant, signature = parts
+    if not expires.isdigit() or int(expires) < time.time():
+        return None
+    expected = make_download_token(file_id, int(expires), grant).rpartition('.')[2]
+    return grant if hmac.compare_digest(signature, expected) else None
 
-@app.route('/download/<file_id>', methods=['POST'])
+def throttle_attempt(file_id):
+    """Return a 429 response if this password attempt is over the limit, else None"""
+    retry_after = attempts_per_ip.take(request.remote_addr or '') or attempts_per_share.take(file_id)
+    if not retry_after:
+        return None
+    response = Response("Too many attempts, try again later", 429)
+    response.headers['Retry-After'] = str(math.ceil(retry_after))
+    return response
+
+@app.route('/download/<file_id>', methods=['GET', 'POST'])
 def download_file(file_id):
-    if file_id not in shared_files:
+    # Refuse excess guesses and bad links before touching the registry or the body
+    if request.method == 'POST':
+        throttled = throttle_attempt(file_id)
+        if throttled is not None:
+            return throttled
+    else:
+        grant = check_download_token(file_id, request.args.get('token', ''))
+        if grant is None:
+            return "Download link expired", 403
+    
+    file_info = shared_files.get(file_id)
+    if file_info is None:
         return "File not found", 404
     
-    password = request.form.get('password', '')
-    file_info = shared_files[file_id]
+    if request.method == 'POST':
+        password = request.form.get('password', '')
+        # Shares recovered from disk have no password and stay locked
+        if file_info['password'] is None:
+            return "Incorrect password", 403
+        matches, needs_rehash = password_hasher.verify(password, file_info['password'])
+        if not matches:
+            return "Incorrect password", 403
+        if needs_rehash:
+            shared_files.set_password(file_id, password_hasher.hash(password))
+        if file_info['max_downloads'] is not None and \
+                file_info['downloads'] >= file_info['max_downloads']:
+            return "Download limit reached", 410
+        # Range and conditional requests only apply to GET, so hand the
+        # client a signed GET link it can resume or revalidate against
+        return redirect(url_for('download_file', file_id=file_id,
+                                token=make_download_token(file_id)), 303)
     
-    if password != file_info['password']:
-        return "Incorrect password", 403
+    # Flask resolves relative paths against the app root, not the working
+    # directory the upload was written to
+    file_path = os.path.abspath(os.path.join(UPLOAD_FOLDER, file_id))
+    if is_container(file_path):
+        response = send_encrypted(file_path, file_info)
+    else:
+        response = send_plaintext(file_path, file_info)
     
-    file_path = os.path.join(UPLOAD_FOLDER, file_id)
-    return send_file(file_path,
-                    download_name=file_info['filename'],
-                    as_attachment=True)
+    # Each link counts as one download the first time it sends file contents;
+    # resuming it or fetching more ranges with it is free, and revalidations
+    # (304) and unsatisfiable ranges (416) never count
+    if response.status_code in (200, 206) and \
+            not shared_files.record_download(file_id, grant, DOWNLOAD_TOKEN_TTL):
+        response.close()
+        return "Download limit reached", 410
+    return response
 
-if __name__ == '__main__':
+def send_plaintext(file_path, file_info):
+    """Send a share stored before files were encrypted at rest.
+
+    conditional=True answers Range (206) and If-None-Match/If-Modified-Since
+    (304). Under the production server a full (200) body is sent with
+    sendfile (see wsgi_server.SendfileWrapper); ranges and the --debug
+    server read the file in blocks.
+    """
+    response = send_file(file_path,
+                         download_name=file_info['filename'],
+                         as_attachment=True,
+                         conditional=True,
+                         etag=file_info['etag'],
+                         max_age=DOWNLOAD_TOKEN_TTL)
+    response.cache_control.public = False
+    response.cache_control.private = True
+    response.accept_ranges = 'bytes'
+    return response
+
+def send_encrypted(file_path, file_info):
+    """Stream a share's plaintext, decrypting it segment by segment.
+
+    The response body is a seekable view of the plaintext, so Range requests
+    only decrypt the segments they cover and conditional requests work just
+    as they do for send_file().
+    """
+    reader = DecryptingReader(cipher, open(file_path, 'rb'))
     try:
-        # Try different ports if the default is in use
-        ports = [5000,8081, 8082, 5001]
-        
+        response = Response(wrap_file(request.environ, reader, INGEST_CHUNK_SIZE),
+                            mimetype=mimetypes.guess_type(file_info['filename'])[0]
+                            or 'application/octet-stream',
+                            direct_passthrough=True)
+        response.headers.set('Content-Disposition', 'attachment', filename=file_info['filename'])
+        response.content_length = reader.size
+        response.last_modified = int(os.path.getmtime(file_path))
+        response.set_etag(file_info['etag'])
+        response.cache_control.private = True
+        response.cache_control.max_age = DOWNLOAD_TOKEN_TTL
+        response.expires = int(time.time() + DOWNLOAD_TOKEN_TTL)
+        response.accept_ranges = 'bytes'
+        return response.make_conditional(request, accept_ranges=True, complete_length=reader.size)
+    except BaseException:
+        reader.close()
+        raise
+
+@app.route('/health')
+def health():
+    """Readiness check: the registry answers and uploads can be written"""
+    try:
+        shared_files.connection.execute('SELECT 1').fetchone()
+    except Exception as e:
+        return jsonify({'status': 'unavailable', 'error': str(e)}), 503
+    if not os.access(UPLOAD_FOLDER, os.W_OK):
+        return jsonify({'status': 'unavailable', 'error': 'upload folder is not writable'}), 503
+    return jsonify({'status': 'ok', 'pid': os.getpid()})
+
+@app.route('/metrics')
+def metrics_endpoint():
+    """Request metrics for every worker, in the Prometheus text format"""
+    return Response(metrics.render(), mimetype='text/plain; version=0.0.4')
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Protector share server")
+    parser.add_argument('--debug', action='store_true',
+                        help="run Flask's single-process debug server with the reloader")
+    parser.add_argument('--host', default='localhost')
+    parser.add_argument('--port', type=int, help="port to listen on (default: first free of %(default)s)")
+    parser.add_argument('--workers', type=int, default=wsgi_server.DEFAULT_WORKERS,
+                        help="worker processes (default: %(default)s)")
+    parser.add_argument('--threads', type=int, default=wsgi_server.DEFAULT_THREADS,
+                        help="request threads per worker (default: %(default)s)")
+    parser.add_argument('--worker-fd', type=int, help=argparse.SUPPRESS)
+    return parser.parse_args()
+
+if __name__ == '__main__':
+    args = parse_args()
+    ports = [args.port] if args.port else PORTS
+    if key_is_tracked():
+        print(f"Refusing to start: {SERVER_KEY_FILE} is committed to git, so anyone with the "
+              f"repository can forge download links and decrypt shares. Remove it from git "
+              f"(git rm {SERVER_KEY_FILE}) and restart to generate a new one.")
+        sys.exit(1)
+    if args.worker_fd is None:
+        Metrics.reset(METRICS_DIR)
+        sweeper.start()
+    
+    if args.worker_fd is not None:
+        # Started by the supervisor: serve on the socket it bound
+        sock = socket.socket(fileno=args.worker_fd)
+        wsgi_server.serve_socket(app, sock, threads=args.threads)
+    elif args.debug:
         for port in ports:
             try:
-                print(f"Attempting to start server on http://localhost:{port}")
-                app.run(host='localhost', port=port, debug=True)
+                print(f"Attempting to start server on http://{args.host}:{port}")
+                app.run(host=args.host, port=port, debug=True)
                 break  # If successful, break the loop
             except OSError as e:
                 print(f"Port {port} is in use, trying next port...")
                 continue
-            
-    except Exception as e:
-        print(f"Server error: {e}")
+    else:
+        def worker_command(fd):
+            return [sys.executable, os.path.abspath(__file__), '--worker-fd', str(fd),
+                    '--threads', str(args.threads)]
+        
+        wsgi_server.serve(app, worker_command, host=args.host, ports=ports,
+                          workers=args.workers, threads=args.threads)
     
     # Keep SSL code commented out until you have proper certificates
     # ssl_context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
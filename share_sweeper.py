@@ -0,0 +1,78 @@
+import os
+import threading
+import time
+
+SWEEP_INTERVAL = 60  # Seconds between sweeps
+SWEEP_BATCH_SIZE = 100  # Files deleted before pausing
+SWEEP_PAUSE = 0.5  # Seconds between batches, so a backlog can't monopolise the disk
+
+
+class ShareSweeper:
+    """Background thread that deletes expired shares, abandoned uploads and old download links.
+
+    Expired shares are removed in batches of batch_size with a pause in
+    between, which caps the deletion rate however large the backlog is.
+    Each file is deleted before its registry row, so a crash in between
+    leaves a row for the next sweep to finish rather than an orphaned file.
+    Rows are only deleted if they are still expired, so sweepers in several
+    processes never count the same file twice.
+    """
+
+    def __init__(self, registry, upload_sessions, interval=SWEEP_INTERVAL,
+                 batch_size=SWEEP_BATCH_SIZE, pause=SWEEP_PAUSE):
+        self.registry = registry
+        self.upload_sessions = upload_sessions
+        self.interval = interval
+        self.batch_size = batch_size
+        self.pause = pause
+        self.stopped = threading.Event()
+        self.thread = None
+        self.reclaimed_files = 0
+        self.reclaimed_bytes = 0
+
+    def start(self):
+        if self.thread is None:
+            self.thread = threading.Thread(target=self.run, name='share-sweeper', daemon=True)
+            self.thread.start()
+
+    def stop(self):
+        self.stopped.set()
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+
+    def run(self):
+        while not self.stopped.is_set():
+            try:
+                files, reclaimed = self.sweep()
+                if files:
+                    print(f"Reclaimed {files} expired shares ({reclaimed / 1024 ** 2:.1f} MB)")
+            except Exception as e:
+                print(f"Error sweeping expired shares: {e}")
+            self.stopped.wait(self.interval)
+
+    def sweep(self):
+        """Delete every share that has expired. Returns (files, bytes) reclaimed"""
+        files = reclaimed = 0
+        while not self.stopped.is_set():
+            now = time.time()
+            batch = self.registry.expired(now, self.batch_size)
+            for file_id in batch:
+                path = os.path.join(self.registry.upload_folder, file_id)
+                try:
+                    size = os.stat(path).st_size
+                    os.remove(path)
+                except FileNotFoundError:
+                    size = None  # Another sweeper got there first
+                self.registry.delete_expired(file_id, now)
+                if size is not None:
+                    files += 1
+                    reclaimed += size
+            if len(batch) < self.batch_size:
+                break
+            self.stopped.wait(self.pause)
+        self.upload_sessions.expire(lambda file_id: file_id in self.registry)
+        self.registry.expire_grants(time.time())
+        self.reclaimed_files += files
+        self.reclaimed_bytes += reclaimed
+        return files, reclaimed
@@ -0,0 +1,158 @@
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+PENDING = 'Queued'
+RUNNING = 'Running'
+DONE = 'Done'
+FAILED = 'Failed'
+CANCELLED = 'Cancelled'
+
+
+class TaskCancelled(Exception):
+    """Raised inside a task when it has been cancelled"""
+
+
+class TaskQueueFull(Exception):
+    """Raised when too many tasks are already queued or running"""
+
+
+class Task:
+    """A unit of background work and its progress.
+
+    The worker calls report() as it goes; the Tk thread reads the progress
+    fields when the scheduler polls. report() also raises TaskCancelled once
+    the task has been cancelled, so long-running loops stop at the next
+    progress update.
+    """
+
+    def __init__(self, name, total_bytes=None):
+        self.name = name
+        self.total_bytes = total_bytes
+        self.done_bytes = 0
+        self.state = PENDING
+        self.started_at = None
+        self.finished_at = None
+        self.cancel_event = threading.Event()
+        self.future = None
+
+    @property
+    def cancelled(self):
+        return self.cancel_event.is_set()
+
+    def cancel(self):
+        self.cancel_event.set()
+        if self.future is not None:
+            self.future.cancel()
+
+    def report(self, done_bytes, total_bytes=None):
+        if self.cancelled:
+            raise TaskCancelled(self.name)
+        self.done_bytes = done_bytes
+        if total_bytes is not None:
+            self.total_bytes = total_bytes
+
+    @property
+    def fraction(self):
+        if not self.total_bytes:
+            return None
+        return min(self.done_bytes / self.total_bytes, 1.0)
+
+    @property
+    def bytes_per_second(self):
+        if self.started_at is None:
+            return 0.0
+        elapsed = (self.finished_at or time.monotonic()) - self.started_at
+        return self.done_bytes / elapsed if elapsed > 0 else 0.0
+
+
+class TaskScheduler:
+    """Runs blocking jobs on worker threads on behalf of a Tk window.
+
+    Tk may only be touched from the main thread, so workers never call back
+    into the UI directly. Instead the scheduler polls its tasks with
+    root.after and runs every callback (on_update, on_done, on_error) on the
+    Tk thread. At most max_pending tasks may be queued or running at once.
+    The worker threads keep the process alive until their tasks end, so
+    call shutdown() when the window closes.
+    """
+
+    def __init__(self, root, on_update=None, max_workers=2, max_pending=8, poll_interval=100):
+        self.root = root
+        self.on_update = on_update
+        self.max_pending = max_pending
+        self.poll_interval = poll_interval
+        self.executor = ThreadPoolExecutor(max_workers=max_workers,
+                                           thread_name_prefix='file-task')
+        self.tasks = []
+        self.polling = False
+
+    def submit(self, name, func, *args, total_bytes=None, on_done=None, on_error=None):
+        """Run func(task, *args) in the background and return its Task.
+
+        on_done(result) or on_error(exception) is called on the Tk thread when
+        the job finishes. Neither is called if the task was cancelled.
+        """
+        if len(self.tasks) >= self.max_pending:
+            raise TaskQueueFull(f"Too many tasks in progress (limit {self.max_pending})")
+
+        task = Task(name, total_bytes)
+        task.on_done = on_done
+        task.on_error = on_error
+
+        def run():
+            if task.cancelled:
+                raise TaskCancelled(task.name)
+            task.state = RUNNING
+            task.started_at = time.monotonic()
+            try:
+                return func(task, *args)
+            finally:
+                task.finished_at = time.monotonic()
+
+        task.future = self.executor.submit(run)
+        self.tasks.append(task)
+        self.notify(task)
+        if not self.polling:
+            self.polling = True
+            self.root.after(self.poll_interval, self.poll)
+        return task
+
+    def poll(self):
+        for task in list(self.tasks):
+            if task.future.done():
+                self.tasks.remove(task)
+                self.finish(task)
+            self.notify(task)
+
+        if self.tasks:
+            self.root.after(self.poll_interval, self.poll)
+        else:
+            self.polling = False
+
+    def finish(self, task):
+        if task.cancelled:
+            task.state = CANCELLED
+            return
+        error = task.future.exception()
+        if error is None:
+            task.state = DONE
+            if task.on_done:
+                task.on_done(task.future.result())
+        else:
+            task.state = FAILED
+            if task.on_error:
+                task.on_error(error)
+
+    def notify(self, task):
+        if self.on_update:
+            self.on_update(task)
+
+    def cancel_all(self):
+        for task in self.tasks:
+            task.cancel()
+
+    def shutdown(self):
+        """Drop queued tasks and cancel running ones, which stop at their next progress report"""
+        self.cancel_all()
+        self.executor.shutdown(wait=False, cancel_futures=True)
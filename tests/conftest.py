@@ -0,0 +1,22 @@
+import os
+import sys
+import atexit
+
+import pytest
+
+# The modules live at the top of the repository rather than in a package
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+
+@pytest.fixture
+def share_server(tmp_path, monkeypatch):
+    """A fresh import of share_server whose databases and files live in tmp_path"""
+    monkeypatch.chdir(tmp_path)
+    sys.modules.pop('share_server', None)
+    import share_server
+    yield share_server
+    # Write the metrics while the working directory is still tmp_path, not at exit
+    atexit.unregister(share_server.metrics.flush)
+    share_server.metrics.flush()
+    sys.modules.pop('share_server', None)
@@ -0,0 +1,85 @@
+import io
+import os
+
+import pytest
+
+from chunk_store import ChunkStore, MAX_CHUNK_SIZE, iter_chunks
+
+
+@pytest.fixture
+def store(tmp_path):
+    store = ChunkStore(str(tmp_path / 'chunks'), os.urandom(32))
+    yield store
+    store.connections.close()
+
+
+def refcounts(store):
+    return dict(store.connection.execute('SELECT address, refcount FROM chunks'))
+
+
+def chunk_files(store):
+    return sorted(name for _, _, names in os.walk(store.root) for name in names
+                  if name != 'index.db' and not name.startswith('index.db-'))
+
+
+def test_chunks_cover_the_stream_within_the_size_limit():
+    data = os.urandom(5 * MAX_CHUNK_SIZE)
+    chunks = list(iter_chunks(io.BytesIO(data)))
+    assert b''.join(chunks) == data
+    assert len(chunks) > 5
+    assert all(len(chunk) <= MAX_CHUNK_SIZE for chunk in chunks)
+
+
+def test_identical_files_share_their_chunks(store):
+    data = os.urandom(3 * MAX_CHUNK_SIZE)
+    first = store.store(io.BytesIO(data))
+    second = store.store(io.BytesIO(data))
+
+    assert first == second
+    assert set(refcounts(store).values()) == {2}
+    assert len(chunk_files(store)) == len(first['chunks'])
+    assert b''.join(store.iter_file(second)) == data
+    assert store.stats()['dedup_ratio'] > 1.9
+
+
+def test_release_deletes_only_chunks_nothing_else_uses(store):
+    data = os.urandom(3 * MAX_CHUNK_SIZE)
+    shared = store.store(io.BytesIO(data))
+    # An edit at the end leaves the chunks before it unchanged
+    edited = store.store(io.BytesIO(data[:-100] + os.urandom(100)))
+    only_edited = {address for address, _ in edited['chunks']} - {a for a, _ in shared['chunks']}
+    assert only_edited
+
+    store.release(edited)
+
+    assert set(refcounts(store)) == {address for address, _ in shared['chunks']}
+    assert set(refcounts(store).values()) == {1}
+    assert not set(chunk_files(store)) & only_edited
+    assert b''.join(store.iter_file(shared)) == data
+
+    store.release(shared)
+    assert refcounts(store) == {}
+    assert chunk_files(store) == []
+
+
+class FailingReader(io.BytesIO):
+    """Serves its data, then fails like a disk or network error part way through"""
+
+    def read(self, size=-1):
+        data = super().read(size)
+        if not data:
+            raise OSError('read failed')
+        return data
+
+
+def test_a_failed_store_releases_the_chunks_it_added(store):
+    kept = store.store(io.BytesIO(os.urandom(2 * MAX_CHUNK_SIZE)))
+    before = refcounts(store)
+
+    progress = []
+    with pytest.raises(OSError):
+        store.store(FailingReader(os.urandom(4 * MAX_CHUNK_SIZE)), progress=progress.append)
+
+    assert progress  # Some chunks were stored before the failure
+    assert refcounts(store) == before
+    assert sorted(chunk_files(store)) == sorted(address for address, _ in kept['chunks'])
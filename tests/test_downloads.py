@@ -0,0 +1,92 @@
+import io
+import time
+
+import pytest
+
+
+@pytest.fixture
+def client(share_server):
+    share_server.app.config['TESTING'] = True
+    return share_server.app.test_client()
+
+
+def share(client, data, **limits):
+    form = {'file': (io.BytesIO(data), 'data.txt'), 'password': 'secret'}
+    form.update({name: str(value) for name, value in limits.items()})
+    response = client.post('/share', data=form, content_type='multipart/form-data')
+    assert response.status_code == 200, response.data
+    return response.get_json()['link'].rsplit('/', 1)[1]
+
+
+def grant_link(client, file_id):
+    response = client.post(f'/download/{file_id}', data={'password': 'secret'})
+    assert response.status_code == 303
+    return response.headers['Location']
+
+
+def test_a_link_counts_once_however_it_is_fetched(client):
+    data = b'protector' * 1000
+    file_id = share(client, data, max_downloads=1)
+    link = grant_link(client, file_id)
+
+    first = client.get(link, headers={'Range': 'bytes=0-99'})
+    assert first.status_code == 206
+    assert first.data == data[:100]
+    # Resuming, or a download manager fetching the rest in pieces, is the same download
+    assert client.get(link, headers={'Range': 'bytes=100-'}).data == data[100:]
+    assert client.get(link).data == data
+    assert client.get(link, headers={'If-None-Match': first.headers['ETag']}).status_code == 304
+
+    # But it was the only one
+    assert client.post(f'/download/{file_id}', data={'password': 'secret'}).status_code in (404, 410)
+
+
+def test_each_link_is_one_download(share_server, client):
+    data = b'x' * 100
+    file_id = share(client, data, max_downloads=2)
+    first, second = grant_link(client, file_id), grant_link(client, file_id)
+    unused = grant_link(client, file_id)
+    assert client.get(first).status_code == 200
+    assert client.get(second).status_code == 200
+    assert client.get(first).status_code == 200
+    assert client.get(unused).status_code in (404, 410)
+    assert share_server.shared_files.connection.execute(
+        'SELECT downloads FROM shares WHERE file_id = ?', (file_id,)).fetchone()[0] == 2
+
+
+def test_unlimited_shares_still_work(client):
+    file_id = share(client, b'abc')
+    for _ in range(3):
+        assert client.get(grant_link(client, file_id)).data == b'abc'
+
+
+def test_grant_is_bound_to_the_signature(share_server, client):
+    file_id = share(client, b'abc', max_downloads=1)
+    link = grant_link(client, file_id)
+    expires, grant, signature = link.split('token=')[1].split('.')
+    forged = link.replace(f'.{grant}.', f'.{"0" * len(grant)}.')
+    assert client.get(forged).status_code == 403
+    assert share_server.check_download_token(file_id, f'{expires}.{signature}') is None
+
+
+def test_sweeper_forgets_expired_grants(share_server, client):
+    file_id = share(client, b'abc')
+    client.get(grant_link(client, file_id))
+    registry = share_server.shared_files
+    count = lambda: registry.connection.execute('SELECT COUNT(*) FROM download_grants').fetchone()[0]
+    assert count() == 1
+    assert registry.expire_grants(time.time()) == 0
+    assert registry.expire_grants(time.time() + share_server.DOWNLOAD_TOKEN_TTL + 1) == 1
+    assert count() == 0
+
+
+def test_registry_migrates_to_the_current_schema(tmp_path):
+    from share_registry import ShareRegistry
+
+    registry = ShareRegistry(str(tmp_path / 'shares.db'), str(tmp_path / 'uploads'))
+    # Version 5 added download_grants; a lower number reruns that step on every start
+    assert registry.connection.execute('PRAGMA user_version').fetchone()[0] >= 5
+    tables = {row[0] for row in registry.connection.execute(
+        "SELECT name FROM sqlite_master WHERE type = 'table'")}
+    assert 'download_grants' in tables
+    registry.connections.close()
@@ -0,0 +1,74 @@
+import atexit
+import socket
+
+import pytest
+
+from benchmarks import start_smtp_server
+from email_handler import EmailHandler
+
+
+@pytest.fixture
+def make_handler():
+    handlers = []
+
+    def make(port, **options):
+        handler = EmailHandler(host='127.0.0.1', port=port, use_tls=False, retry_delay=0, **options)
+        handler.configure('sender@example.com', 'password')
+        handlers.append(handler)
+        return handler
+
+    yield make
+    for handler in handlers:
+        handler.close(5)
+        atexit.unregister(handler.close)
+
+
+@pytest.fixture
+def smtp_server():
+    servers = []
+
+    def start(**options):
+        server, port = start_smtp_server(**options)
+        servers.append(server)
+        return server, port
+
+    yield start
+    for server in servers:
+        server.shutdown()
+        server.server_close()
+
+
+def test_a_batch_goes_over_one_connection(smtp_server, make_handler):
+    server, port = smtp_server()
+    handler = make_handler(port)
+    for i in range(5):
+        handler.send_otp(f'user{i}@example.com')
+    handler.close(5)
+
+    assert server.messages == 5
+    assert (handler.sent, handler.failed, handler.connections) == (5, 0, 1)
+
+
+def test_sender_reconnects_when_the_server_hangs_up(smtp_server, make_handler):
+    server, port = smtp_server(drop_after=2)
+    handler = make_handler(port)
+    for i in range(5):
+        handler.send_otp(f'user{i}@example.com')
+    handler.close(5)
+
+    assert server.messages == 5
+    assert (handler.sent, handler.failed, handler.connections) == (5, 0, 3)
+
+
+def test_unreachable_server_fails_after_the_retries(make_handler, monkeypatch):
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        port = sock.getsockname()[1]  # Nothing listens here once the socket closes
+    handler = make_handler(port, max_retries=2)
+    attempts = []
+    connect = handler.connect
+    monkeypatch.setattr(handler, 'connect', lambda: attempts.append(1) or connect())
+
+    assert not handler.deliver(handler.build_message('user@example.com', '123456'))
+    assert len(attempts) == 3
+    assert (handler.sent, handler.failed, handler.connections) == (0, 1, 0)
@@ -0,0 +1,197 @@
+import io
+import os
+import json
+import base64
+
+import pytest
+from cryptography.fernet import Fernet
+
+from database import Database
+from file_manager import FileManager
+from key_ring import KeyRing, KeyRingError, WRAPPED_KEY_SIZE
+from secure_container import (ChunkedCipher, ContainerError, container_version, container_flags,
+                              DIRECT_KEY_VERSION, ENVELOPE_VERSION, FLAG_ZLIB, HEADER_SIZE)
+from task_runner import Task
+
+SEGMENT_SIZE = 1024
+
+
+@pytest.fixture
+def key():
+    return Fernet.generate_key()
+
+
+@pytest.fixture
+def ring(tmp_path, key):
+    return KeyRing(str(tmp_path / 'ring.json'), base64.urlsafe_b64decode(key))
+
+
+@pytest.fixture
+def cipher(key, ring):
+    return ChunkedCipher(key, segment_size=SEGMENT_SIZE, key_ring=ring)
+
+
+def write_container(cipher, path, data, compress=False):
+    with open(path, 'wb') as f:
+        cipher.encrypt_stream(io.BytesIO(data), f, compress=compress)
+
+
+def read_container(cipher, path):
+    with open(path, 'rb') as f:
+        return b''.join(cipher.iter_decrypt(f))
+
+
+def test_rewrap_moves_a_file_to_the_current_version(cipher, ring, tmp_path):
+    path, journal = str(tmp_path / 'file'), str(tmp_path / 'journal')
+    data = os.urandom(3 * SEGMENT_SIZE)
+    write_container(cipher, path, data)
+    with open(path, 'rb') as f:
+        body = f.read()[HEADER_SIZE + WRAPPED_KEY_SIZE:]
+
+    assert not cipher.rewrap(path, journal)  # Already current
+    ring.rotate()
+    assert cipher.rewrap(path, journal)
+    assert cipher.key_version(path) == ring.current_version
+    assert read_container(cipher, path) == data
+    assert not os.path.exists(journal)
+    with open(path, 'rb') as f:
+        assert f.read()[HEADER_SIZE + WRAPPED_KEY_SIZE:] == body  # Only the header changed
+
+
+def test_interrupted_rewrap_is_undone(cipher, ring, tmp_path):
+    path, journal = str(tmp_path / 'file'), str(tmp_path / 'journal')
+    data = os.urandom(2 * SEGMENT_SIZE)
+    write_container(cipher, path, data)
+    with open(path, 'rb') as f:
+        f.seek(HEADER_SIZE)
+        wrapped = f.read(WRAPPED_KEY_SIZE)
+
+    # Crash after journaling, half way through writing the new field
+    with open(journal, 'w') as f:
+        json.dump({'path': path, 'wrapped': wrapped.hex()}, f)
+    with open(path, 'r+b') as f:
+        f.seek(HEADER_SIZE + 10)
+        f.write(os.urandom(20))
+    with pytest.raises(ContainerError):
+        read_container(cipher, path)
+
+    assert ChunkedCipher.recover_rewrap(journal)
+    assert not os.path.exists(journal)
+    assert read_container(cipher, path) == data
+    assert not ChunkedCipher.recover_rewrap(journal)
+
+
+def test_journal_torn_before_the_file_was_touched(cipher, tmp_path):
+    path, journal = str(tmp_path / 'file'), str(tmp_path / 'journal')
+    write_container(cipher, path, b'abc')
+    with open(journal, 'w') as f:
+        f.write('{"path": ')
+    assert ChunkedCipher.recover_rewrap(journal)
+    assert not os.path.exists(journal)
+    assert read_container(cipher, path) == b'abc'
+
+
+@pytest.mark.parametrize('compress', [False, True])
+def test_upgrade_reencrypts_version_1_containers(key, cipher, ring, tmp_path, compress):
+    path, partial = str(tmp_path / 'file'), str(tmp_path / '.upgrade_file')
+    data = b'protector ' * 1000
+    write_container(ChunkedCipher(key, segment_size=SEGMENT_SIZE), path, data, compress)
+    assert container_version(path) == DIRECT_KEY_VERSION
+
+    ring.rotate()
+    assert cipher.upgrade(path, partial)
+    assert not os.path.exists(partial)
+    assert container_version(path) == ENVELOPE_VERSION
+    assert cipher.key_version(path) == ring.current_version
+    assert bool(container_flags(path) & FLAG_ZLIB) == compress
+    assert read_container(cipher, path) == data
+    assert not cipher.upgrade(path, partial)
+
+    # Nothing depends on the original key any more
+    ring.retire(keep=set())
+    other = ChunkedCipher(Fernet.generate_key(), segment_size=SEGMENT_SIZE, key_ring=ring)
+    assert read_container(other, path) == data
+
+
+def test_upgrade_leaves_a_replaced_file_alone(key, cipher, tmp_path, monkeypatch):
+    path, partial = str(tmp_path / 'file'), str(tmp_path / '.upgrade_file')
+    write_container(ChunkedCipher(key, segment_size=SEGMENT_SIZE), path, b'old')
+    original_fsync = os.fsync
+
+    def upload_lands_meanwhile(fd):
+        original_fsync(fd)
+        new_path = str(tmp_path / 'new')
+        write_container(cipher, new_path, b'new')
+        os.replace(new_path, path)
+
+    monkeypatch.setattr(os, 'fsync', upload_lands_meanwhile)
+    assert not cipher.upgrade(path, partial)
+    assert read_container(cipher, path) == b'new'
+    assert not os.path.exists(partial)
+
+
+def test_retire_drops_unused_versions(ring, tmp_path, key):
+    first = ring.current_version
+    second = ring.rotate()
+    third = ring.rotate()
+    assert ring.retire(keep={second}) == [first]
+    reloaded = KeyRing(ring.path, base64.urlsafe_b64decode(key))
+    assert set(reloaded.keys) == {second, third}
+    assert reloaded.current_version == third
+    with pytest.raises(KeyRingError):
+        reloaded.wrapping_key(first)
+    assert ring.rotate() == third + 1
+
+
+@pytest.fixture
+def manager(tmp_path, monkeypatch, key, ring, cipher):
+    """A FileManager with just what key rotation needs, without a window"""
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(Database, '_instance', None)
+    manager = FileManager.__new__(FileManager)
+    manager.username = 'alice'
+    manager.key = key
+    manager.cipher = Fernet(key)
+    manager.key_ring = ring
+    manager.stream_cipher = cipher
+    manager.rotation_journal = str(tmp_path / 'rotation.journal')
+    manager.rewrap_rate = 10000
+    manager.user_dir = str(tmp_path / 'files')
+    os.makedirs(manager.user_dir)
+    manager.db = Database()
+    yield manager
+    manager.db.close()
+
+
+def test_rotation_moves_every_file_off_the_old_keys(manager, key, ring):
+    files = {
+        'v1.txt': (ChunkedCipher(key, segment_size=SEGMENT_SIZE), b'direct ' * 500),
+        'v2.txt': (manager.stream_cipher, b'envelope ' * 500),
+    }
+    for name, (writer, data) in files.items():
+        write_container(writer, manager.stored_path(name), data)
+        manager.db.save_file('alice', name, 1, 1, container_version(manager.stored_path(name)))
+    with open(manager.stored_path('legacy.txt'), 'wb') as f:
+        f.write(Fernet(key).encrypt(b'legacy'))
+
+    original = ring.current_version
+    first = manager.rotate_files(Task('rotate'))
+    assert (first['rewrapped'], first['upgraded'], first['legacy']) == (1, 1, 1)
+    assert first['retired'] == []  # The version current before is kept for one more rotation
+    for name, (writer, data) in files.items():
+        assert read_container(manager.stream_cipher, manager.stored_path(name)) == data
+        assert manager.db.get_file_data(name, 'alice')['format_version'] == ENVELOPE_VERSION
+
+    second = manager.rotate_files(Task('rotate'))
+    assert second['retired'] == [original]
+    assert set(ring.keys) == {ring.current_version - 1, ring.current_version}
+    for name, (writer, data) in files.items():
+        assert read_container(manager.stream_cipher, manager.stored_path(name)) == data
+
+
+def test_versions_of_unfinished_uploads_are_kept(manager, ring):
+    old = ring.current_version
+    write_container(manager.stream_cipher, os.path.join(manager.user_dir, '.partial_big.txt'), b'x')
+    ring.rotate()
+    ring.rotate()
+    assert manager.key_versions_in_use() == {old}
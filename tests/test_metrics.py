@@ -0,0 +1,92 @@
+import json
+import time
+import atexit
+import socket
+import subprocess
+import sys
+import threading
+
+import pytest
+import requests
+from flask import Flask, send_file
+
+import wsgi_server
+from metrics import Metrics, MetricsMiddleware, PREFIX
+
+
+def dead_pid():
+    process = subprocess.Popen([sys.executable, '-c', 'pass'])
+    process.wait()
+    return process.pid
+
+
+def counter(text, line_start):
+    for line in text.splitlines():
+        if line.startswith(line_start):
+            return float(line.rsplit(' ', 1)[1])
+    return None
+
+
+def test_render_merges_every_process(tmp_path):
+    metrics = Metrics(str(tmp_path))
+    metrics.request_started('download_file')
+    metrics.request_finished('download_file', 'GET', '200', 0.02, 0, 1000)
+    metrics.request_started('download_file')
+    # An exited worker: its counters and histograms still count, its gauges don't
+    other = {
+        'pid': dead_pid(),
+        'counters': [['requests_total', [['endpoint', 'download_file'], ['method', 'GET'],
+                                         ['status', '200']], 4],
+                     ['response_bytes_total', [['endpoint', 'download_file']], 500]],
+        'gauges': [['requests_in_flight', [['endpoint', 'download_file']], 3]],
+        'histograms': [[[['endpoint', 'download_file']], [1] + [0] * 12 + [0.5, 1]]],
+    }
+    (tmp_path / f"{other['pid']}.json").write_text(json.dumps(other))
+    (tmp_path / 'garbage.json').write_text('{not json')
+
+    text = metrics.render()
+    labels = 'endpoint="download_file"'
+    assert counter(text, f'{PREFIX}requests_total{{{labels},method="GET",status="200"}}') == 5
+    assert counter(text, f'{PREFIX}response_bytes_total{{{labels}}}') == 1500
+    assert counter(text, f'{PREFIX}requests_in_flight{{{labels}}}') == 1
+    assert counter(text, f'{PREFIX}request_duration_seconds_count{{{labels}}}') == 2
+    assert counter(text, f'{PREFIX}request_duration_seconds_bucket{{{labels},le="0.005"}}') == 1
+    assert counter(text, f'{PREFIX}request_duration_seconds_bucket{{{labels},le="0.025"}}') == 2
+    assert counter(text, f'{PREFIX}request_duration_seconds_bucket{{{labels},le="+Inf"}}') == 2
+
+
+def test_sendfile_bodies_are_recorded_when_sent(tmp_path, monkeypatch):
+    data = b'x' * (256 * 1024)
+    path = tmp_path / 'data.bin'
+    path.write_bytes(data)
+    app = Flask(__name__)
+
+    @app.route('/file')
+    def whole_file():
+        return send_file(str(path))
+
+    calls = []
+    original = socket.socket.sendfile
+
+    def recording_sendfile(self, file, offset=0, count=None):
+        calls.append(count)
+        return original(self, file, offset, count)
+
+    monkeypatch.setattr(socket.socket, 'sendfile', recording_sendfile)
+    metrics = Metrics(str(tmp_path / 'metrics'))
+    app.wsgi_app = MetricsMiddleware(app.wsgi_app, app, metrics)
+    server = wsgi_server.PooledWSGIServer('127.0.0.1', 0, app, threads=2)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    try:
+        assert requests.get(f"http://127.0.0.1:{server.server_port}/file").content == data
+        # The server closes the body just after the client has it all
+        deadline = time.monotonic() + 5
+        while not metrics.counters and time.monotonic() < deadline:
+            time.sleep(0.01)
+    finally:
+        server.shutdown()
+        server.drain(timeout=1)
+        atexit.unregister(metrics.flush)
+    assert calls == [len(data)]
+    assert metrics.counters[('response_bytes_total', (('endpoint', 'whole_file'),))] == len(data)
+    assert metrics.gauges[('requests_in_flight', (('endpoint', 'whole_file'),))] == 0
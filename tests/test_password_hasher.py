@@ -0,0 +1,83 @@
+import hashlib
+
+import bcrypt
+import pytest
+
+from database import Database
+from password_hasher import PasswordHasher, MIN_COST
+
+
+def legacy_hash(password):
+    return hashlib.sha256(password.encode()).hexdigest()
+
+
+@pytest.fixture
+def hasher():
+    # A tiny target calibrates to MIN_COST, which keeps the tests quick
+    hasher = PasswordHasher(target_seconds=1e-6)
+    yield hasher
+    hasher.shutdown()
+
+
+def test_legacy_hash_matches_and_asks_for_a_rehash(hasher):
+    assert hasher.verify('hunter2', legacy_hash('hunter2')) == (True, True)
+    assert hasher.verify('hunter3', legacy_hash('hunter2')) == (False, False)
+
+
+def test_bcrypt_hash_at_the_calibrated_cost_is_left_alone(hasher):
+    stored = hasher.hash('hunter2')
+    assert stored.startswith('$2') and int(stored.split('$')[2]) == MIN_COST
+    assert hasher.verify('hunter2', stored) == (True, False)
+    assert hasher.verify('hunter3', stored) == (False, False)
+
+
+def test_weaker_bcrypt_hash_asks_for_a_rehash(hasher):
+    stored = bcrypt.hashpw(b'hunter2', bcrypt.gensalt(MIN_COST - 1)).decode()
+    assert hasher.verify('hunter2', stored) == (True, True)
+
+
+@pytest.fixture
+def db(tmp_path, monkeypatch, hasher):
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(Database, '_instance', None)
+    db = Database()
+    db.hasher = hasher
+    yield db
+    db.close()
+
+
+def stored_password(db, email):
+    return db.connection.execute('SELECT password FROM users WHERE email = ?',
+                                 (email,)).fetchone()[0]
+
+
+def test_login_upgrades_a_legacy_hash_to_bcrypt(db):
+    db.connection.execute('INSERT INTO users (username, email, password) VALUES (?, ?, ?)',
+                          ('alice', 'alice@example.com', legacy_hash('hunter2')))
+    db.connection.commit()
+
+    assert not db.check_login('alice@example.com', 'wrong')
+    assert stored_password(db, 'alice@example.com') == legacy_hash('hunter2')
+
+    assert db.check_login('alice@example.com', 'hunter2')
+    upgraded = stored_password(db, 'alice@example.com')
+    assert upgraded.startswith('$2')
+    assert db.check_login('alice@example.com', 'hunter2')
+    assert stored_password(db, 'alice@example.com') == upgraded
+
+
+def test_share_password_is_upgraded_on_first_correct_entry(share_server):
+    share_server.app.config['TESTING'] = True
+    client = share_server.app.test_client()
+    file_id = 'legacy.txt'
+    with open(f"{share_server.UPLOAD_FOLDER}/{file_id}", 'wb') as f:
+        f.write(b'legacy share')
+    share_server.shared_files.add(file_id, {
+        'filename': file_id, 'username': 'alice', 'password': legacy_hash('hunter2'),
+        'timestamp': '2024-01-01T00:00:00', 'size': 12, 'etag': 'legacy'})
+
+    assert client.post(f'/download/{file_id}', data={'password': 'wrong'}).status_code == 403
+    assert client.post(f'/download/{file_id}', data={'password': 'hunter2'}).status_code == 303
+    upgraded = share_server.shared_files.get(file_id)['password']
+    assert upgraded.startswith('$2')
+    assert client.post(f'/download/{file_id}', data={'password': 'hunter2'}).status_code == 303
@@ -0,0 +1,70 @@
+import pytest
+
+import rate_limiter
+from rate_limiter import RateLimiter
+
+
+class Clock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(rate_limiter.time, 'time', clock)
+    return clock
+
+
+@pytest.fixture
+def make_limiter(tmp_path):
+    limiters = []
+
+    def make(**options):
+        limiter = RateLimiter(str(tmp_path / 'limits.bin'), **options)
+        limiters.append(limiter)
+        return limiter
+
+    yield make
+    for limiter in limiters:
+        limiter.close()
+
+
+def test_bucket_empties_then_refills_at_the_rate(clock, make_limiter):
+    limiter = make_limiter(rate=2, burst=3)
+    assert [limiter.take('10.0.0.1') for _ in range(3)] == [0, 0, 0]
+    assert limiter.take('10.0.0.1') == pytest.approx(0.5)
+    assert limiter.take('10.0.0.2') == 0  # Other keys have their own bucket
+
+    clock.now += 0.5
+    assert limiter.take('10.0.0.1') == 0
+    assert limiter.take('10.0.0.1') == pytest.approx(0.5)
+
+    # Refilling stops at the burst size
+    clock.now += 60
+    assert [limiter.take('10.0.0.1') for _ in range(4)][-1] == pytest.approx(0.5)
+
+
+def test_least_recently_used_key_in_a_full_set_is_evicted(clock, make_limiter):
+    limiter = make_limiter(rate=1, burst=1, sets=1, ways=2)
+    for key in ('a', 'b'):
+        assert limiter.take(key) == 0
+        clock.now += 0.1
+    assert limiter.take('a') > 0  # Refreshes a, leaving b the least recently used
+
+    clock.now += 0.1
+    assert limiter.take('c') == 0  # Takes b's slot
+
+    assert limiter.take('a') > 0  # Still tracked, still empty
+    assert limiter.take('b') == 0  # Evicted, so it starts again with a full bucket
+
+
+def test_limiters_on_the_same_file_share_buckets(clock, make_limiter):
+    # As worker processes do, each opening the table itself
+    first, second = make_limiter(rate=1, burst=2), make_limiter(rate=1, burst=2)
+    assert first.take('10.0.0.1') == 0
+    assert second.take('10.0.0.1') == 0
+    assert first.take('10.0.0.1') == pytest.approx(1)
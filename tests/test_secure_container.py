@@ -0,0 +1,189 @@
+import io
+import os
+
+import pytest
+from cryptography.fernet import Fernet
+
+from secure_container import (ChunkedCipher, ContainerWriter, ContainerError, DecryptingReader,
+                              HEADER_SIZE, TAG_SIZE)
+
+SEGMENT_SIZE = 1024
+SEALED_SIZE = SEGMENT_SIZE + TAG_SIZE
+SIZES = [0, 1, SEGMENT_SIZE - 1, SEGMENT_SIZE, SEGMENT_SIZE + 1, 5 * SEGMENT_SIZE + 7]
+
+
+@pytest.fixture
+def cipher():
+    return ChunkedCipher(Fernet.generate_key(), segment_size=SEGMENT_SIZE)
+
+
+def encrypt(cipher, data, compress=False):
+    dst = io.BytesIO()
+    cipher.encrypt_stream(io.BytesIO(data), dst, compress=compress)
+    return dst.getvalue()
+
+
+def decrypt(cipher, container):
+    return b''.join(cipher.iter_decrypt(io.BytesIO(container)))
+
+
+def segment(container, index):
+    start = HEADER_SIZE + index * SEALED_SIZE
+    return container[start:start + SEALED_SIZE]
+
+
+@pytest.mark.parametrize('size', SIZES)
+def test_round_trip(cipher, size):
+    data = os.urandom(size)
+    container = encrypt(cipher, data)
+    assert len(container) == cipher.container_size(size, SEGMENT_SIZE)
+    assert decrypt(cipher, container) == data
+    assert cipher.plaintext_size(io.BytesIO(container)) == size
+
+
+@pytest.mark.parametrize('size', SIZES)
+def test_compressed_round_trip(cipher, size):
+    data = b'protector ' * (size // 10) + b'x' * (size % 10)
+    container = encrypt(cipher, data, compress=True)
+    assert decrypt(cipher, container) == data
+    assert cipher.plaintext_size(io.BytesIO(container)) == size
+
+
+def test_decompressed_pieces_never_exceed_a_segment(cipher):
+    container = encrypt(cipher, bytes(200 * SEGMENT_SIZE), compress=True)
+    pieces = list(cipher.iter_decrypt(io.BytesIO(container)))
+    assert b''.join(pieces) == bytes(200 * SEGMENT_SIZE)
+    assert max(map(len, pieces)) <= SEGMENT_SIZE
+
+
+def test_writer_matches_encrypt_stream(cipher):
+    data = os.urandom(3 * SEGMENT_SIZE + 100)
+    dst = io.BytesIO()
+    writer = ContainerWriter(cipher, dst)
+    for start in range(0, len(data), 333):
+        writer.write(data[start:start + 333])
+    assert writer.finish() == len(data)
+    assert decrypt(cipher, dst.getvalue()) == data
+
+
+def test_wrong_key_is_rejected(cipher):
+    container = encrypt(cipher, os.urandom(100))
+    other = ChunkedCipher(Fernet.generate_key(), segment_size=SEGMENT_SIZE)
+    with pytest.raises(ContainerError):
+        decrypt(other, container)
+
+
+@pytest.mark.parametrize('size', [3 * SEGMENT_SIZE, 3 * SEGMENT_SIZE + 100])
+def test_dropping_final_segment_is_detected(cipher, size):
+    container = encrypt(cipher, os.urandom(size))
+    segments = (len(container) - HEADER_SIZE) // SEALED_SIZE
+    truncated = container[:HEADER_SIZE + (segments - 1) * SEALED_SIZE] \
+        if (len(container) - HEADER_SIZE) % SEALED_SIZE == 0 \
+        else container[:HEADER_SIZE + segments * SEALED_SIZE]
+    with pytest.raises(ContainerError):
+        decrypt(cipher, truncated)
+
+
+def test_truncation_inside_a_segment_is_detected(cipher):
+    container = encrypt(cipher, os.urandom(2 * SEGMENT_SIZE + 100))
+    with pytest.raises(ContainerError):
+        decrypt(cipher, container[:-10])
+
+
+def test_header_alone_is_rejected(cipher):
+    container = encrypt(cipher, os.urandom(100))
+    with pytest.raises(ContainerError):
+        decrypt(cipher, container[:HEADER_SIZE])
+
+
+def test_reordered_segments_are_detected(cipher):
+    container = encrypt(cipher, os.urandom(3 * SEGMENT_SIZE + 100))
+    swapped = container[:HEADER_SIZE] + segment(container, 1) + segment(container, 0) + \
+        container[HEADER_SIZE + 2 * SEALED_SIZE:]
+    assert len(swapped) == len(container)
+    with pytest.raises(ContainerError):
+        decrypt(cipher, swapped)
+
+
+def test_appended_segment_is_detected(cipher):
+    container = encrypt(cipher, os.urandom(2 * SEGMENT_SIZE + 100))
+    with pytest.raises(ContainerError):
+        decrypt(cipher, container + segment(container, 0))
+
+
+@pytest.mark.parametrize('position', range(HEADER_SIZE))
+def test_flipped_header_byte_is_detected(cipher, position):
+    container = bytearray(encrypt(cipher, os.urandom(2 * SEGMENT_SIZE + 100)))
+    container[position] ^= 0x01
+    with pytest.raises(ContainerError):
+        decrypt(cipher, bytes(container))
+
+
+def test_flipped_ciphertext_byte_is_detected(cipher):
+    container = bytearray(encrypt(cipher, os.urandom(2 * SEGMENT_SIZE + 100)))
+    container[HEADER_SIZE + SEALED_SIZE + 5] ^= 0x80
+    with pytest.raises(ContainerError):
+        decrypt(cipher, bytes(container))
+
+
+SIZE = 5 * SEGMENT_SIZE + 7
+RANGES = [
+    (0, 0),
+    (0, 1),
+    (SEGMENT_SIZE - 1, 2),  # Straddles a segment boundary
+    (SEGMENT_SIZE, SEGMENT_SIZE),  # Exactly one segment
+    (SEGMENT_SIZE - 1, 3 * SEGMENT_SIZE + 2),  # Several segments, partial at both ends
+    (5 * SEGMENT_SIZE, 7),  # Only the short final segment
+    (0, SIZE),
+    (SIZE - 1, 10),  # Runs past the end
+    (SIZE, 5),  # Starts at the end
+    (SIZE + 100, 5),  # Starts past the end
+    (3, 10 ** 12),
+]
+
+
+@pytest.mark.parametrize('compress', [False, True])
+@pytest.mark.parametrize('offset, length', RANGES)
+def test_read_range(cipher, compress, offset, length):
+    data = os.urandom(SIZE)
+    container = io.BytesIO(encrypt(cipher, data, compress=compress))
+    assert cipher.decrypt_range(container, offset, length) == data[offset:offset + length]
+
+
+def test_read_range_of_empty_file(cipher):
+    container = io.BytesIO(encrypt(cipher, b''))
+    assert cipher.decrypt_range(container, 0, 10) == b''
+
+
+@pytest.mark.parametrize('offset, length', [(-1, 5), (0, -1)])
+def test_read_range_rejects_negative_values(cipher, offset, length):
+    container = io.BytesIO(encrypt(cipher, os.urandom(100)))
+    with pytest.raises(ValueError):
+        cipher.decrypt_range(container, offset, length)
+
+
+def test_read_range_only_opens_segments_it_covers(cipher):
+    data = os.urandom(SIZE)
+    container = bytearray(encrypt(cipher, data))
+    container[HEADER_SIZE + 4 * SEALED_SIZE + 5] ^= 0x80  # Corrupt segment 4
+    src = io.BytesIO(bytes(container))
+    assert cipher.decrypt_range(src, SEGMENT_SIZE, 2 * SEGMENT_SIZE) == \
+        data[SEGMENT_SIZE:3 * SEGMENT_SIZE]
+    with pytest.raises(ContainerError):
+        cipher.decrypt_range(src, 4 * SEGMENT_SIZE, 10)
+
+
+@pytest.mark.parametrize('offset, length', RANGES)
+def test_decrypting_reader_seek_and_read(cipher, offset, length):
+    data = os.urandom(SIZE)
+    raw = DecryptingReader(cipher, io.BytesIO(encrypt(cipher, data)))
+    assert raw.size == SIZE
+    # A raw read stops at the end of a segment; buffering joins them up as callers see it
+    with io.BufferedReader(raw) as reader:
+        reader.seek(offset)
+        assert reader.read(min(length, SIZE)) == data[offset:offset + length]
+
+
+def test_decrypting_reader_refuses_compressed_containers(cipher):
+    with pytest.raises(ContainerError):
+        DecryptingReader(cipher, io.BytesIO(encrypt(cipher, b'a' * 5000, compress=True)))
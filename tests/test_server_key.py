@@ -0,0 +1,44 @@
+import io
+import hmac
+import base64
+import time
+import hashlib
+import subprocess
+
+import pytest
+
+from secure_container import ChunkedCipher, ContainerError
+
+
+def test_tokens_are_signed_with_their_own_subkey(share_server):
+    token = share_server.make_download_token('share')
+    assert share_server.check_download_token('share', token)
+    assert not share_server.check_download_token('other', token)
+
+    # A token signed with the secret itself, as the old scheme did, is refused
+    expires = int(time.time()) + 60
+    forged = hmac.new(share_server.server_key, f"share:{expires}".encode(), hashlib.sha256).hexdigest()
+    assert not share_server.check_download_token('share', f"{expires}.{forged}")
+
+
+def test_key_is_created_once_and_private(share_server, tmp_path):
+    path = tmp_path / share_server.SERVER_KEY_FILE
+    assert path.stat().st_mode & 0o077 == 0
+    assert share_server.get_or_create_key() == share_server.server_key
+
+
+def test_tracked_key_is_detected(share_server, tmp_path):
+    assert not share_server.key_is_tracked()
+    subprocess.run(['git', 'init', '-q'], cwd=tmp_path, check=True)
+    assert not share_server.key_is_tracked()
+    subprocess.run(['git', 'add', share_server.SERVER_KEY_FILE], cwd=tmp_path, check=True)
+    assert share_server.key_is_tracked()
+
+
+def test_shares_are_encrypted_with_the_storage_subkey(share_server, tmp_path):
+    dst = io.BytesIO()
+    share_server.cipher.encrypt_stream(io.BytesIO(b'secret contents'), dst)
+    with pytest.raises(ContainerError):
+        leaked = ChunkedCipher(base64.urlsafe_b64encode(share_server.server_key))
+        b''.join(leaked.iter_decrypt(io.BytesIO(dst.getvalue())))
+    assert share_server.cipher.master_key not in (share_server.server_key, share_server.token_key)
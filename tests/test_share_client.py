@@ -0,0 +1,74 @@
+import os
+import threading
+
+import pytest
+import requests
+from werkzeug.serving import make_server
+
+from file_manager import FileManager
+from http_client import HttpClient
+from task_runner import Task
+
+
+@pytest.fixture
+def base_url(share_server):
+    server = make_server('127.0.0.1', 0, share_server.app, threaded=True)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    yield f"http://127.0.0.1:{server.server_port}"
+    server.shutdown()
+
+
+@pytest.fixture
+def manager(base_url):
+    manager = FileManager.__new__(FileManager)
+    manager.username = 'alice'
+    manager.max_retries = 3
+    manager.http = HttpClient(base_url, max_retries=manager.max_retries, retry_delay=0)
+    yield manager
+    manager.http.close()
+
+
+def share_bytes(manager, data):
+    manager.plaintext_size = lambda file_path: len(data)
+    manager.iter_range = lambda file_path, offset, length: iter([data[offset:offset + length]])
+    return manager.upload_share(Task('share'), 'stored', 'data.txt', 'secret')
+
+
+def drop_response(manager, fails, method='PUT'):
+    """Send the first fails matching requests to the server but lose their responses"""
+    sent = []
+    request = manager.http.session.request
+
+    def lossy(method_, url, **kwargs):
+        response = request(method_, url, **kwargs)
+        sent.append((method_, url))
+        if method_ == method and len([m for m, _ in sent if m == method]) <= fails:
+            raise requests.exceptions.ConnectionError('connection reset')
+        return response
+
+    manager.http.session.request = lossy
+    return sent
+
+
+def test_a_lost_chunk_response_is_retried_once_by_the_client(share_server, manager):
+    chunk_size = share_server.upload_sessions.chunk_size
+    data = os.urandom(2 * chunk_size + 10)
+    sent = drop_response(manager, 1)
+
+    link = share_bytes(manager, data)
+
+    file_id = link.rsplit('/', 1)[1]
+    with open(os.path.join(share_server.UPLOAD_FOLDER, file_id), 'rb') as f:
+        assert b''.join(share_server.cipher.iter_decrypt(f)) == data
+    assert manager.http.stats()['retries'] == 1
+    # The client resent the chunk; nothing above it went back to ask the server
+    assert [m for m, _ in sent] == ['POST', 'PUT', 'PUT', 'PUT', 'PUT', 'POST']
+
+
+def test_a_chunk_that_keeps_failing_is_tried_max_retries_times(manager):
+    sent = drop_response(manager, 100)
+
+    with pytest.raises(requests.exceptions.ConnectionError):
+        share_bytes(manager, b'protector')
+
+    assert [m for m, _ in sent].count('PUT') == manager.max_retries + 1
@@ -0,0 +1,117 @@
+import io
+import os
+import hashlib
+import threading
+
+import pytest
+from cryptography.fernet import Fernet
+
+from database import ThreadConnections
+from file_manager import FileManager
+from secure_container import ChunkedCipher
+from upload_pipeline import UploadPipeline, UploadJob
+
+SEGMENT_SIZE = 1024
+
+
+@pytest.fixture
+def cipher():
+    return ChunkedCipher(Fernet.generate_key(), segment_size=SEGMENT_SIZE)
+
+
+def make_jobs(tmp_path, sizes, compress=False):
+    jobs = []
+    for number, size in enumerate(sizes):
+        source = tmp_path / f'source_{number}.txt'
+        source.write_bytes(os.urandom(size))
+        jobs.append(UploadJob(str(source), source.name, str(tmp_path / f'stored_{number}'),
+                              str(tmp_path / f'.partial_{number}'), compress))
+    return jobs
+
+
+def test_round_trip_and_hashes(cipher, tmp_path):
+    jobs = make_jobs(tmp_path, [0, 1, SEGMENT_SIZE, 3 * SEGMENT_SIZE + 5])
+    UploadPipeline(cipher).run(jobs)
+    for job in jobs:
+        with open(job.source_path, 'rb') as f:
+            data = f.read()
+        with open(job.save_path, 'rb') as f:
+            assert b''.join(cipher.iter_decrypt(f)) == data
+        assert job.size == len(data)
+        assert job.content_hash == hashlib.sha256(data).hexdigest()
+        assert job.stored_size == os.path.getsize(job.save_path)
+        assert not os.path.exists(job.partial_path)
+
+
+def test_stored_jobs_are_complete_and_handed_to_the_calling_thread(cipher, tmp_path):
+    jobs = make_jobs(tmp_path, [SEGMENT_SIZE // 2] * 20)
+    seen = []
+
+    def stored(job):
+        seen.append((threading.get_ident(), job.content_hash, os.path.exists(job.save_path)))
+
+    UploadPipeline(cipher, queue_size=1).run(jobs, on_stored=stored)
+    assert len(seen) == len(jobs)
+    for (thread, content_hash, in_place), job in zip(seen, jobs):
+        assert thread == threading.get_ident()
+        assert content_hash is not None and content_hash == job.content_hash
+        assert in_place
+
+
+def test_batches_reuse_the_callers_connection(cipher, tmp_path):
+    connections = ThreadConnections(str(tmp_path / 'catalog.db'))
+    connections.get().execute('CREATE TABLE files (name TEXT)')
+
+    def stored(job):
+        connections.get().execute('INSERT INTO files VALUES (?)', (job.name,))
+
+    for batch in range(20):
+        UploadPipeline(cipher).run(make_jobs(tmp_path, [10, 10]), on_stored=stored)
+    assert len(connections.opened) == 1
+    connections.close()
+
+
+def test_failed_stage_removes_partial_files(cipher, tmp_path):
+    jobs = make_jobs(tmp_path, [3 * SEGMENT_SIZE, 3 * SEGMENT_SIZE])
+    os.remove(jobs[1].source_path)
+    stored = []
+    with pytest.raises(FileNotFoundError):
+        UploadPipeline(cipher).run(jobs, on_stored=stored.append)
+    for job in jobs:
+        assert not os.path.exists(job.partial_path)
+    # Whatever was reported as stored is really in place
+    assert all(os.path.exists(job.save_path) for job in stored)
+    assert not os.path.exists(jobs[1].save_path)
+
+
+def test_failed_callback_stops_the_batch(cipher, tmp_path):
+    jobs = make_jobs(tmp_path, [SEGMENT_SIZE] * 10)
+
+    def stored(job):
+        raise RuntimeError("catalog is gone")
+
+    with pytest.raises(RuntimeError):
+        UploadPipeline(cipher, queue_size=1).run(jobs, on_stored=stored)
+    for job in jobs:
+        assert not os.path.exists(job.partial_path)
+
+
+def test_folder_names_are_flattened_and_numbered(tmp_path):
+    folder = tmp_path / 'docs'
+    for path in ['a/b_c.txt', 'a_b/c.txt', 'A_B/C.TXT', 'top.txt', 'docs_top.txt']:
+        (folder / path).parent.mkdir(parents=True, exist_ok=True)
+        (folder / path).write_text(path)
+    files = FileManager.folder_files(str(folder))
+    names = [name for path, name in files]
+    assert len(files) == 5
+    assert len({name.lower() for name in names}) == 5
+    # A_B/C.TXT, a/b_c.txt and a_b/c.txt all flatten to the same name
+    assert sorted(name.lower() for name in names) == [
+        'docs_a_b_c (2).txt', 'docs_a_b_c (3).txt', 'docs_a_b_c.txt', 'docs_docs_top.txt', 'docs_top.txt']
+    for path, name in files:
+        assert os.path.isfile(path)
+
+
+def test_empty_folder_has_no_files(tmp_path):
+    (tmp_path / 'empty' / 'nested').mkdir(parents=True)
+    assert FileManager.folder_files(str(tmp_path / 'empty')) == []
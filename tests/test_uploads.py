@@ -0,0 +1,170 @@
+import io
+import os
+import hashlib
+
+import pytest
+
+
+def sha256(data):
+    return hashlib.sha256(data).hexdigest()
+
+
+@pytest.fixture
+def client(share_server):
+    share_server.app.config['TESTING'] = True
+    return share_server.app.test_client()
+
+
+def start_upload(client, size, **limits):
+    response = client.post('/uploads', json=dict(filename='data.txt', size=size,
+                                                 username='alice', password='secret', **limits))
+    assert response.status_code == 201
+    return response.get_json()
+
+
+def put_chunk(client, upload_id, index, data, checksum=None, content_length=None):
+    return client.put(f'/uploads/{upload_id}/chunks/{index}',
+                      input_stream=io.BytesIO(data),
+                      content_length=len(data) if content_length is None else content_length,
+                      headers={'X-Chunk-Sha256': checksum or sha256(data)})
+
+
+def download(client, link, password='secret'):
+    file_id = link.rsplit('/', 1)[1]
+    response = client.post(f'/download/{file_id}', data={'password': password})
+    assert response.status_code == 303
+    return client.get(response.headers['Location'])
+
+
+def test_resume_after_partial_put(client):
+    state = start_upload(client, 0)
+    chunk_size = state['chunk_size']
+    data = os.urandom(2 * chunk_size + 1000)
+    state = start_upload(client, len(data))
+    upload_id = state['upload_id']
+    chunks = [data[i:i + chunk_size] for i in range(0, len(data), chunk_size)]
+
+    assert put_chunk(client, upload_id, 0, chunks[0]).status_code == 200
+
+    # The connection drops halfway through chunk 1
+    response = put_chunk(client, upload_id, 1, chunks[1][:chunk_size // 2],
+                         checksum=sha256(chunks[1]), content_length=len(chunks[1]))
+    assert response.status_code == 400
+
+    state = client.get(f'/uploads/{upload_id}').get_json()
+    assert state['next_chunk'] == 1
+    assert state['offset'] == chunk_size
+
+    # Chunks out of order or with the wrong checksum don't move it on either
+    assert put_chunk(client, upload_id, 2, chunks[2]).status_code == 409
+    assert put_chunk(client, upload_id, 1, chunks[1], checksum=sha256(b'other')).status_code == 400
+    assert put_chunk(client, upload_id, 1, chunks[1][:-1]).status_code == 400
+    assert client.post(f'/uploads/{upload_id}/finalize').status_code == 409
+
+    for index in range(state['next_chunk'], len(chunks)):
+        assert put_chunk(client, upload_id, index, chunks[index]).status_code == 200
+    # A retried chunk is acknowledged without being counted twice
+    state = put_chunk(client, upload_id, 0, chunks[0]).get_json()
+    assert state['offset'] == len(data)
+
+    link = client.post(f'/uploads/{upload_id}/finalize').get_json()['link']
+    assert client.post(f'/uploads/{upload_id}/finalize').get_json()['link'] == link
+    assert download(client, link).data == data
+
+
+def test_empty_upload(client):
+    upload_id = start_upload(client, 0)['upload_id']
+    link = client.post(f'/uploads/{upload_id}/finalize').get_json()['link']
+    assert download(client, link).data == b''
+
+
+def complete_upload(client, data):
+    state = start_upload(client, len(data))
+    assert put_chunk(client, state['upload_id'], 0, data).status_code == 200
+    return state['upload_id']
+
+
+def test_finalize_recovers_from_a_failed_publish(share_server, client):
+    data = b'protector' * 100
+    upload_id = complete_upload(client, data)
+
+    def crash(file_id, info):
+        raise RuntimeError("worker died")
+
+    share_server.shared_files.add = crash
+    with pytest.raises(RuntimeError):
+        client.post(f'/uploads/{upload_id}/finalize')
+    del share_server.shared_files.add
+
+    # Until the claim is stale, another request might still be publishing it
+    assert client.post(f'/uploads/{upload_id}/finalize').status_code == 202
+    share_server.upload_sessions.finalize_timeout = -1
+    response = client.post(f'/uploads/{upload_id}/finalize')
+    assert response.status_code == 200
+    assert download(client, response.get_json()['link']).data == data
+
+
+def test_finalize_recovers_from_a_claim_that_never_moved_the_file(share_server, client):
+    data = b'abc' * 100
+    upload_id = complete_upload(client, data)
+    assert share_server.upload_sessions.claim(upload_id, share_server.new_file_id('data.txt'))
+    assert client.post(f'/uploads/{upload_id}/finalize').status_code == 202
+    share_server.upload_sessions.finalize_timeout = -1
+    link = client.post(f'/uploads/{upload_id}/finalize').get_json()['link']
+    assert download(client, link).data == data
+
+
+def test_unpublished_containers_are_removed_with_their_session(share_server, client):
+    upload_id = complete_upload(client, b'abc')
+    file_id = share_server.new_file_id('data.txt')
+    sessions = share_server.upload_sessions
+    assert sessions.claim(upload_id, file_id)
+    # Died just after moving the container into place
+    file_path = os.path.join(share_server.UPLOAD_FOLDER, file_id)
+    os.replace(sessions.data_path(upload_id), file_path)
+
+    sessions.ttl = -1
+    share_server.sweeper.sweep()
+    assert sessions.get(upload_id) is None
+    assert not os.path.exists(file_path)
+
+
+def test_published_shares_outlive_their_session(share_server, client):
+    upload_id = complete_upload(client, b'abc')
+    link = client.post(f'/uploads/{upload_id}/finalize').get_json()['link']
+    share_server.upload_sessions.ttl = -1
+    share_server.sweeper.sweep()
+    assert download(client, link).data == b'abc'
+
+
+def test_finalize_after_the_share_is_gone(share_server, client):
+    upload_id = complete_upload(client, b'abc')
+    file_id = client.post(f'/uploads/{upload_id}/finalize').get_json()['link'].rsplit('/', 1)[1]
+    share_server.shared_files.delete(file_id)
+    os.remove(os.path.join(share_server.UPLOAD_FOLDER, file_id))
+    share_server.upload_sessions.finalize_timeout = -1
+    assert client.post(f'/uploads/{upload_id}/finalize').status_code == 410
+
+
+def test_etag_is_chained_from_the_chunk_checksums(share_server, client):
+    chunk_size = start_upload(client, 0)['chunk_size']
+    data = os.urandom(2 * chunk_size + 10)
+    state = start_upload(client, len(data))
+    chunks = [data[i:i + chunk_size] for i in range(0, len(data), chunk_size)]
+    for index, chunk in enumerate(chunks):
+        assert put_chunk(client, state['upload_id'], index, chunk).status_code == 200
+    link = client.post(f'/uploads/{state["upload_id"]}/finalize').get_json()['link']
+
+    expected = b''
+    for chunk in chunks:
+        expected = hashlib.sha256(expected + hashlib.sha256(chunk).digest()).digest()
+    assert share_server.shared_files.get(link.rsplit('/', 1)[1])['etag'] == expected.hex()
+    response = download(client, link)
+    assert response.data == data
+    assert response.headers['ETag'] == f'"{expected.hex()}"'
+
+
+def test_empty_upload_etag(share_server, client):
+    upload_id = start_upload(client, 0)['upload_id']
+    file_id = client.post(f'/uploads/{upload_id}/finalize').get_json()['link'].rsplit('/', 1)[1]
+    assert share_server.shared_files.get(file_id)['etag'] == hashlib.sha256().hexdigest()
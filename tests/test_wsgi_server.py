@@ -0,0 +1,67 @@
+import io
+import socket
+import threading
+
+import pytest
+import requests
+from flask import Flask, Response, request, send_file
+from werkzeug.wsgi import wrap_file
+
+import wsgi_server
+
+
+@pytest.fixture
+def served(tmp_path, monkeypatch):
+    """Serve a small app from PooledWSGIServer; yields (base_url, file contents, sendfile calls)"""
+    data = bytes(range(256)) * 4096
+    path = tmp_path / 'data.bin'
+    path.write_bytes(data)
+
+    app = Flask(__name__)
+
+    @app.route('/file')
+    def whole_file():
+        return send_file(str(path), conditional=True)
+
+    @app.route('/memory')
+    def in_memory():
+        return Response(wrap_file(request.environ, io.BytesIO(data)), direct_passthrough=True,
+                        headers={'Content-Length': str(len(data))})
+
+    calls = []
+    original = socket.socket.sendfile
+
+    def recording_sendfile(self, file, offset=0, count=None):
+        calls.append((offset, count))
+        return original(self, file, offset, count)
+
+    monkeypatch.setattr(socket.socket, 'sendfile', recording_sendfile)
+    server = wsgi_server.PooledWSGIServer('127.0.0.1', 0, app, threads=2)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield f"http://127.0.0.1:{server.server_port}", data, calls
+    server.shutdown()
+    server.drain(timeout=1)
+
+
+def test_whole_files_are_sent_with_sendfile(served):
+    base_url, data, calls = served
+    response = requests.get(f"{base_url}/file")
+    assert response.status_code == 200
+    assert response.content == data
+    assert calls == [(0, len(data))]
+
+
+def test_ranges_are_sliced_without_sendfile(served):
+    base_url, data, calls = served
+    response = requests.get(f"{base_url}/file", headers={'Range': 'bytes=1000-1999'})
+    assert response.status_code == 206
+    assert response.content == data[1000:2000]
+    assert calls == []
+
+
+def test_files_without_a_descriptor_are_read_in_blocks(served):
+    base_url, data, calls = served
+    response = requests.get(f"{base_url}/memory")
+    assert response.content == data
+    assert calls == []
@@ -0,0 +1,218 @@
+import os
+import queue
+import hashlib
+import threading
+from secure_container import seal_segment, FLAG_ZLIB
+from compression import should_compress, PrefixedReader, CompressingReader
+
+QUEUE_SIZE = 8  # Blocks or segments buffered between two stages
+
+
+class PipelineStopped(Exception):
+    """Raised inside a stage when another stage has failed"""
+
+
+class UploadJob:
+    """One file in a batch: where to read it from and where to store it"""
+
+    def __init__(self, source_path, name, save_path, partial_path, compress=False):
+        self.source_path = source_path
+        self.name = name
+        self.save_path = save_path
+        self.partial_path = partial_path
+        self.compress = compress
+        self.size = 0
+        self.stored_size = 0
+        self.content_hash = None
+        self.compressed = False
+        self.mtime = None
+
+
+class BlockReader:
+    """File-like view of one job's blocks as they arrive from the read stage"""
+
+    def __init__(self, pipeline):
+        self.pipeline = pipeline
+        self.buffer = b''
+        self.eof = False
+
+    def read(self, size):
+        while len(self.buffer) < size and not self.eof:
+            block = self.pipeline.get(self.pipeline.blocks)
+            if block:
+                self.buffer += block
+            else:
+                self.eof = True
+        data, self.buffer = self.buffer[:size], self.buffer[size:]
+        return data
+
+
+class UploadPipeline:
+    """Encrypts a batch of files into containers with overlapping stages.
+
+    Each stage runs on its own thread and hands its output to the next
+    through a bounded queue:
+
+        read -> segment (and compress) -> seal -> write
+
+    so the disk reads of one file overlap the CPU work and writes of the
+    ones before it, and memory stays bounded however large the batch is.
+    Segments are sealed on the cipher's worker pool when it has more than
+    one worker. If any stage fails, every stage stops and the partially
+    written files are removed.
+    """
+
+    def __init__(self, cipher, queue_size=QUEUE_SIZE):
+        self.cipher = cipher
+        self.queue_size = queue_size
+
+    def run(self, jobs, progress=None, on_stored=None):
+        """Store every job, calling progress with the running count of bytes read.
+
+        on_stored is called with each job as soon as its container is in
+        place, so files finished before a failure can still be recorded. It
+        runs on the calling thread rather than a pipeline thread, so anything
+        it opens per thread (such as a database connection) is reused across
+        batches. Returns the jobs with their sizes, hashes and mtimes filled in.
+        """
+        self.jobs = jobs
+        self.progress = progress
+        self.blocks = queue.Queue(self.queue_size)
+        self.segments = queue.Queue(self.queue_size)
+        self.sealed = queue.Queue(self.queue_size)
+        self.stored = queue.Queue()
+        self.stop = threading.Event()
+        self.error = None
+
+        stages = [self.read_stage, self.segment_stage, self.seal_stage, self.write_stage]
+        threads = [threading.Thread(target=self.run_stage, args=(stage,),
+                                    name=f'upload-{stage.__name__}', daemon=True)
+                   for stage in stages]
+        for thread in threads:
+            thread.start()
+        # Jobs stored before a stage fails are still handed over
+        try:
+            while any(thread.is_alive() for thread in threads) or not self.stored.empty():
+                try:
+                    job = self.stored.get(timeout=0.1)
+                except queue.Empty:
+                    continue
+                if on_stored:
+                    on_stored(job)
+        except BaseException as e:
+            if self.error is None:
+                self.error = e
+            self.stop.set()
+        for thread in threads:
+            thread.join()
+
+        if self.error is not None:
+            for job in jobs:
+                if os.path.exists(job.partial_path):
+                    os.remove(job.partial_path)
+            raise self.error
+        return jobs
+
+    def run_stage(self, stage):
+        try:
+            stage()
+        except PipelineStopped:
+            pass
+        except BaseException as e:
+            if self.error is None:
+                self.error = e
+            self.stop.set()
+
+    def put(self, channel, item):
+        while True:
+            if self.stop.is_set():
+                raise PipelineStopped()
+            try:
+                channel.put(item, timeout=0.1)
+                return
+            except queue.Full:
+                pass
+
+    def get(self, channel):
+        while True:
+            if self.stop.is_set():
+                raise PipelineStopped()
+            try:
+                return channel.get(timeout=0.1)
+            except queue.Empty:
+                pass
+
+    def read_stage(self):
+        """Read each file in segment-sized blocks, hashing as it goes"""
+        total = 0
+        for job in self.jobs:
+            digest = hashlib.sha256()
+            with open(job.source_path, 'rb') as f:
+                while True:
+                    block = f.read(self.cipher.segment_size)
+                    if not block:
+                        break
+                    digest.update(block)
+                    job.size += len(block)
+                    total += len(block)
+                    self.put(self.blocks, block)
+                    if self.progress:
+                        self.progress(total)
+            # The hash is set before the end marker, so it's there by the time the job is stored
+            job.content_hash = digest.hexdigest()
+            self.put(self.blocks, b'')
+
+    def segment_stage(self):
+        """Decide on compression per file and cut each one into numbered segments"""
+        size = self.cipher.segment_size
+        for job in self.jobs:
+            reader = BlockReader(self)
+            source = reader
+            if job.compress:
+                sample = reader.read(size)
+                job.compressed = should_compress(job.name, sample)
+                source = PrefixedReader(sample, reader)
+                if job.compressed:
+                    source = CompressingReader(source)
+            header, key = self.cipher.new_header(FLAG_ZLIB if job.compressed else 0)
+            self.put(self.segments, ('header', header, key))
+            for segment in self.cipher.split_segments(source, size):
+                self.put(self.segments, ('segment', header, key) + segment)
+            # split_segments stops at the first short read; drain the end marker
+            while not reader.eof:
+                reader.read(size)
+            self.put(self.segments, ('end',))
+
+    def seal_stage(self):
+        """Seal segments in order, fanning them out to the cipher's worker pool"""
+        executor = self.cipher.get_executor() if self.cipher.workers > 1 else None
+        for job in self.jobs:
+            while True:
+                item = self.get(self.segments)
+                if item[0] == 'segment':
+                    kind, header, key, index, final, data = item
+                    if executor is not None:
+                        item = ('sealed', executor.submit(seal_segment, key, header, index, final, data))
+                    else:
+                        item = ('sealed', seal_segment(key, header, index, final, data))
+                self.put(self.sealed, item)
+                if item[0] == 'end':
+                    break
+
+    def write_stage(self):
+        """Write each container to its partial file and move it into place"""
+        for job in self.jobs:
+            with open(job.partial_path, 'wb') as f:
+                while True:
+                    item = self.get(self.sealed)
+                    if item[0] == 'header':
+                        f.write(item[1])
+                    elif item[0] == 'sealed':
+                        sealed = item[1]
+                        f.write(sealed if isinstance(sealed, bytes) else sealed.result())
+                    else:
+                        break
+            os.replace(job.partial_path, job.save_path)
+            stat = os.stat(job.save_path)
+            job.stored_size, job.mtime = stat.st_size, stat.st_mtime
+            self.stored.put(job)
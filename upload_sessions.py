@@ -0,0 +1,168 @@
+import os
+import time
+import uuid
+import hashlib
+import sqlite3
+from database import ThreadConnections
+
+UPLOAD_CHUNK_SIZE = 1024 * 1024  # Bytes per chunk of a resumable upload
+UPLOAD_SESSION_TTL = 60 * 60  # Seconds an upload may sit idle before it is abandoned
+FINALIZE_TIMEOUT = 60  # Seconds a finalize may run before another request may take it over
+
+
+class UploadSessions:
+    """Resumable share uploads in progress, shared by every worker process.
+
+    A session's chunks are written in order into <folder>/.session_<id>,
+    and the session row records how many have been acknowledged, so any
+    worker can take the next chunk and a client that lost its connection
+    can ask where to resume. The row is updated only if it still expects
+    the chunk being acknowledged, so a chunk retried on two connections at
+    once is only counted once. Sessions idle for longer than ttl are
+    removed, along with their data, by expire().
+    """
+
+    def __init__(self, db_path, folder, chunk_size=UPLOAD_CHUNK_SIZE, ttl=UPLOAD_SESSION_TTL,
+                 finalize_timeout=FINALIZE_TIMEOUT):
+        self.db_path = db_path
+        self.folder = folder
+        self.chunk_size = chunk_size
+        self.ttl = ttl
+        self.finalize_timeout = finalize_timeout
+        self.connections = ThreadConnections(db_path, row_factory=sqlite3.Row)
+        self.connection.execute('''
+            CREATE TABLE IF NOT EXISTS upload_sessions (
+                upload_id TEXT PRIMARY KEY,
+                filename TEXT NOT NULL,
+                username TEXT NOT NULL,
+                password TEXT,
+                size INTEGER NOT NULL,
+                chunk_size INTEGER NOT NULL,
+                next_chunk INTEGER NOT NULL DEFAULT 0,
+                received INTEGER NOT NULL DEFAULT 0,
+                file_id TEXT,
+                updated_at REAL NOT NULL,
+                expires_in INTEGER,
+                max_downloads INTEGER,
+                owner TEXT,
+                content_hash TEXT
+            )
+        ''')
+        self.connection.execute('CREATE INDEX IF NOT EXISTS idx_upload_sessions_updated_at '
+                                'ON upload_sessions (updated_at)')
+        self.add_share_limits()
+
+    def add_share_limits(self):
+        """Add the share limit, owner and content hash columns to tables created without them"""
+        connection = self.connection
+        connection.execute('BEGIN IMMEDIATE')
+        try:
+            columns = {row['name'] for row in connection.execute('PRAGMA table_info(upload_sessions)')}
+            for column, kind in (('expires_in', 'INTEGER'), ('max_downloads', 'INTEGER'),
+                                 ('owner', 'TEXT'), ('content_hash', 'TEXT')):
+                if column not in columns:
+                    connection.execute(f'ALTER TABLE upload_sessions ADD COLUMN {column} {kind}')
+            connection.execute('COMMIT')
+        except Exception:
+            connection.execute('ROLLBACK')
+            raise
+
+    @property
+    def connection(self):
+        return self.connections.get()
+
+    def data_path(self, upload_id):
+        return os.path.join(self.folder, f'.session_{upload_id}')
+
+    def create(self, filename, username, password, size, expires_in=None, max_downloads=None,
+               owner=None):
+        """Start a session and return it.
+
+        expires_in and max_downloads apply to the finished share, and its
+        size counts against owner's quota until then.
+        """
+        upload_id = uuid.uuid4().hex
+        open(self.data_path(upload_id), 'wb').close()
+        self.connection.execute(
+            'INSERT INTO upload_sessions (upload_id, filename, username, password, size, chunk_size, '
+            'updated_at, expires_in, max_downloads, owner) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+            (upload_id, filename, username, password, size, self.chunk_size, time.time(),
+             expires_in, max_downloads, owner))
+        return self.get(upload_id)
+
+    def reserved(self, owner):
+        """Bytes set aside for owner's uploads that are still in progress"""
+        return self.connection.execute(
+            'SELECT COALESCE(SUM(size), 0) FROM upload_sessions '
+            'WHERE owner = ? AND file_id IS NULL AND updated_at >= ?',
+            (owner, time.time() - self.ttl)).fetchone()[0]
+
+    def get(self, upload_id):
+        """Return the session, or None if it doesn't exist or has been abandoned"""
+        row = self.connection.execute('SELECT * FROM upload_sessions WHERE upload_id = ?',
+                                      (upload_id,)).fetchone()
+        if row is None or row['updated_at'] < time.time() - self.ttl:
+            return None
+        return dict(row)
+
+    def expected_length(self, session, index):
+        return min(session['chunk_size'], session['size'] - index * session['chunk_size'])
+
+    @staticmethod
+    def chain_hash(session, chunk_digest):
+        """The session's content hash once the chunk with SHA-256 chunk_digest is added.
+
+        Each chunk's digest is folded into a running SHA-256, so the hash of
+        the whole upload is ready when the last chunk arrives, without
+        reading the file again.
+        """
+        previous = bytes.fromhex(session['content_hash'] or '')
+        return hashlib.sha256(previous + chunk_digest).hexdigest()
+
+    def acknowledge(self, upload_id, index, length, content_hash):
+        """Record chunk index as received. Returns False if it wasn't the one expected"""
+        return self.connection.execute(
+            'UPDATE upload_sessions SET next_chunk = next_chunk + 1, received = received + ?, '
+            'content_hash = ?, updated_at = ? '
+            'WHERE upload_id = ? AND next_chunk = ? AND file_id IS NULL',
+            (length, content_hash, time.time(), upload_id, index)).rowcount == 1
+
+    def claim(self, upload_id, file_id):
+        """Mark a complete session as finalized into file_id. Returns False if it already was"""
+        return self.connection.execute(
+            'UPDATE upload_sessions SET file_id = ?, updated_at = ? '
+            'WHERE upload_id = ? AND file_id IS NULL AND received = size',
+            (file_id, time.time(), upload_id)).rowcount == 1
+
+    def reclaim(self, upload_id, file_id):
+        """Take over finalizing a session whose claim is older than finalize_timeout.
+
+        That means the request that claimed it died or failed before the
+        share was published. Returns False if the claim is still recent.
+        """
+        now = time.time()
+        return self.connection.execute(
+            'UPDATE upload_sessions SET updated_at = ? '
+            'WHERE upload_id = ? AND file_id = ? AND updated_at < ?',
+            (now, upload_id, file_id, now - self.finalize_timeout)).rowcount == 1
+
+    def expire(self, published=None):
+        """Remove abandoned sessions and their data. Returns how many were removed.
+
+        A session that was claimed but never published may have left its
+        container in the folder under its file_id; with published, a function
+        saying whether a file_id's share exists, those are removed too.
+        """
+        cutoff = time.time() - self.ttl
+        expired = self.connection.execute(
+            'SELECT upload_id, file_id FROM upload_sessions WHERE updated_at < ?', (cutoff,)).fetchall()
+        for row in expired:
+            paths = [self.data_path(row['upload_id'])]
+            if row['file_id'] is not None and published is not None and not published(row['file_id']):
+                paths.append(os.path.join(self.folder, row['file_id']))
+            for path in paths:
+                if os.path.exists(path):
+                    os.remove(path)
+            self.connection.execute('DELETE FROM upload_sessions WHERE upload_id = ? AND updated_at < ?',
+                                    (row['upload_id'], cutoff))
+        return len(expired)
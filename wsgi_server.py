@@ -0,0 +1,248 @@
+import os
+import sys
+import time
+import signal
+import socket
+import threading
+import subprocess
+from concurrent.futures import ThreadPoolExecutor
+from werkzeug.serving import BaseWSGIServer, WSGIRequestHandler
+from werkzeug.wsgi import FileWrapper
+
+DEFAULT_WORKERS = os.cpu_count() or 1
+DEFAULT_THREADS = 8
+KEEPALIVE_TIMEOUT = 15  # Seconds an idle keep-alive connection may hold a thread
+SHUTDOWN_TIMEOUT = 30  # Seconds workers get to finish in-flight requests
+RESTART_DELAY = 1  # Seconds to wait before replacing a crashed worker
+
+
+class SendfileWrapper(FileWrapper):
+    """wsgi.file_wrapper that sends a whole file with socket.sendfile.
+
+    SendfileMiddleware gives it the connection when it is the entire body of
+    a response with a Content-Length and the file has a descriptor. Anything
+    else, such as a Range response that slices it or a decrypting reader, is
+    read in blocks just like Werkzeug's own FileWrapper.
+    """
+
+    socket = None
+    length = None
+
+    def has_descriptor(self):
+        try:
+            self.file.fileno()
+        except (AttributeError, OSError, ValueError):
+            return False
+        return True
+
+    def __iter__(self):
+        if self.socket is None:
+            return self
+        return self.send()
+
+    def send(self):
+        # Writing nothing makes the handler send the headers; the file then
+        # goes from the page cache to the socket without passing through Python
+        yield b''
+        self.socket.sendfile(self.file, self.file.tell(), self.length)
+
+
+class SendfileMiddleware:
+    """Hands SendfileWrapper bodies the client connection so they can use sendfile"""
+
+    def __init__(self, app):
+        self.app = app
+
+    def __call__(self, environ, start_response):
+        content_length = []
+
+        def record_length(status, headers, exc_info=None):
+            content_length[:] = [value for name, value in headers if name.lower() == 'content-length']
+            return start_response(status, headers, exc_info)
+
+        body = self.app(environ, record_length)
+        connection = environ.get('werkzeug.socket')
+        # Without a Content-Length the handler would chunk the body, which sendfile can't do
+        if isinstance(body, SendfileWrapper) and content_length and connection is not None \
+                and body.has_descriptor():
+            body.socket, body.length = connection, int(content_length[0])
+        return body
+
+
+class KeepAliveRequestHandler(WSGIRequestHandler):
+    timeout = KEEPALIVE_TIMEOUT
+
+    def make_environ(self):
+        environ = super().make_environ()
+        environ['wsgi.file_wrapper'] = SendfileWrapper
+        return environ
+
+
+class PooledWSGIServer(BaseWSGIServer):
+    """Werkzeug WSGI server that handles connections on a fixed pool of threads.
+
+    When every thread is busy the accept loop waits for one to free up, so
+    further connections queue in the listen backlog instead of piling up
+    threads. Files returned through wsgi.file_wrapper are sent with sendfile
+    (see SendfileWrapper).
+    """
+
+    multithread = True
+
+    def __init__(self, host, port, app, threads=DEFAULT_THREADS, fd=None):
+        super().__init__(host, port, SendfileMiddleware(app), handler=KeepAliveRequestHandler, fd=fd)
+        self.threads = threads
+        self.executor = ThreadPoolExecutor(max_workers=threads, thread_name_prefix='wsgi')
+        self.slots = threading.BoundedSemaphore(threads)
+
+    def process_request(self, request, client_address):
+        self.slots.acquire()
+        self.executor.submit(self.process_request_thread, request, client_address)
+
+    def process_request_thread(self, request, client_address):
+        try:
+            self.finish_request(request, client_address)
+        except Exception:
+            self.handle_error(request, client_address)
+        finally:
+            self.shutdown_request(request)
+            self.slots.release()
+
+    def drain(self, timeout=SHUTDOWN_TIMEOUT):
+        """Wait up to timeout seconds for in-flight requests to finish"""
+        deadline = time.monotonic() + timeout
+        for _ in range(self.threads):
+            if not self.slots.acquire(timeout=max(0, deadline - time.monotonic())):
+                break
+        self.executor.shutdown(wait=False, cancel_futures=True)
+
+
+def bind_socket(host, ports):
+    """Bind a listening socket to the first free port in ports. Returns (socket, port)"""
+    for port in ports:
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        try:
+            sock.bind((host, port))
+        except OSError:
+            sock.close()
+            print(f"Port {port} is in use, trying next port...")
+            continue
+        sock.listen(socket.SOMAXCONN)
+        sock.set_inheritable(True)
+        return sock, port
+    raise OSError(f"None of the ports {list(ports)} are free")
+
+
+def serve_socket(app, sock, threads=DEFAULT_THREADS):
+    """Serve app on an already listening socket until SIGTERM or SIGINT.
+
+    On either signal the worker stops accepting, lets in-flight requests
+    finish and returns.
+    """
+    host, port = sock.getsockname()[:2]
+    server = PooledWSGIServer(host, port, app, threads=threads, fd=sock.fileno())
+
+    def stop(signum, frame):
+        # shutdown() waits for serve_forever, so it can't run on this thread
+        threading.Thread(target=server.shutdown, daemon=True).start()
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+    try:
+        server.serve_forever()
+    finally:
+        server.drain()
+
+
+class Supervisor:
+    """Multi-process manager for a WSGI app.
+
+    The supervisor binds the listening socket once and starts workers as
+    fresh interpreters running worker_command(fd), which should call
+    serve_socket() on the inherited descriptor. The kernel spreads incoming
+    connections across the workers.
+
+    Signals:
+        SIGTERM/SIGINT  stop accepting, let workers finish in-flight requests, exit
+        SIGHUP          graceful reload: start a new set of workers (picking up
+                        code changes), then retire the old ones
+    Crashed workers are replaced.
+    """
+
+    def __init__(self, worker_command, sock, workers=DEFAULT_WORKERS):
+        self.worker_command = worker_command
+        self.sock = sock
+        self.workers = max(1, workers)
+        self.processes = []
+        self.stopping = False
+        self.reloading = False
+
+    def spawn(self):
+        fd = self.sock.fileno()
+        return subprocess.Popen(self.worker_command(fd), pass_fds=(fd,))
+
+    def run(self):
+        signal.signal(signal.SIGTERM, self.request_stop)
+        signal.signal(signal.SIGINT, self.request_stop)
+        signal.signal(signal.SIGHUP, self.request_reload)
+        self.processes = [self.spawn() for _ in range(self.workers)]
+        try:
+            while not self.stopping:
+                if self.reloading:
+                    self.reloading = False
+                    self.reload()
+                for i, process in enumerate(self.processes):
+                    if process.poll() is not None and not self.stopping:
+                        print(f"Worker {process.pid} exited with {process.returncode}, restarting")
+                        time.sleep(RESTART_DELAY)
+                        self.processes[i] = self.spawn()
+                time.sleep(0.5)
+        finally:
+            self.stop_workers(self.processes)
+            self.sock.close()
+
+    def request_stop(self, signum, frame):
+        self.stopping = True
+
+    def request_reload(self, signum, frame):
+        self.reloading = True
+
+    def reload(self):
+        old = self.processes
+        self.processes = [self.spawn() for _ in range(self.workers)]
+        self.stop_workers(old)
+
+    @staticmethod
+    def stop_workers(processes):
+        for process in processes:
+            if process.poll() is None:
+                process.terminate()
+        deadline = time.monotonic() + SHUTDOWN_TIMEOUT
+        for process in processes:
+            try:
+                process.wait(timeout=max(0, deadline - time.monotonic()))
+            except subprocess.TimeoutExpired:
+                process.kill()
+                process.wait()
+
+
+def supports_workers():
+    """Worker processes need to inherit the listening socket, which Windows can't do"""
+    return os.name == 'posix'
+
+
+def serve(app, worker_command, host='localhost', ports=(5000,), workers=DEFAULT_WORKERS,
+          threads=DEFAULT_THREADS):
+    """Serve app in production mode on the first free port in ports.
+
+    With workers > 1 (and a POSIX system) connections are spread over that
+    many worker processes; otherwise app is served from this process.
+    """
+    sock, port = bind_socket(host, ports)
+    print(f"Serving on http://{host}:{port} with {workers} workers x {threads} threads")
+    sys.stdout.flush()
+    if workers > 1 and supports_workers():
+        Supervisor(worker_command, sock, workers).run()
+    else:
+        serve_socket(app, sock, threads)